@@ -13,6 +13,12 @@ Pipeline stages:
 
 Usage:
     python run_capstone.py --input data.csv --output_dir output --model llama3.1
+    python run_capstone.py --input data.csv --model llama3.1 --budget 90
+    python run_capstone.py --input data.csv --model qwen2.5-7b --provider openai --host http://localhost:8000
+
+With --budget, every stage shares one end-to-end deadline: the LLM call's
+retries and backoff are sized to what is left, and a run that cannot finish
+in time stops early and records how far it got.
 
 Output artifacts:
     - output/profile.json
@@ -27,6 +33,7 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import importlib.util
 import json
 import logging
 import os
@@ -35,45 +42,65 @@ import sys
 import time
 from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-try:
+if TYPE_CHECKING:
     import pandas as pd
-except ImportError:
-    pd = None
-    print("Error: pandas is required. Install with: pip install pandas")
-    sys.exit(1)
-
-# Try to import llm_client from week_04, with fallback options
-LLMClient = None
-LLMRequest = None
-LLMResponse = None
-
-# Option 1: Try importing from installed package (if llm_client is in the same directory)
-try:
-    from llm_client import LLMClient, LLMRequest, LLMResponse
-except ImportError:
-    pass
-
-# Option 2: Try importing from week_04 relative path
-if LLMClient is None:
-    week_04_path = Path(__file__).parent.parent / "week_04"
-    if week_04_path.exists():
-        sys.path.insert(0, str(week_04_path))
-        try:
-            from llm_client import LLMClient, LLMRequest, LLMResponse
-        except ImportError:
-            pass
+    from llm_client import Cassette, Deadline, LLMClient
+
+# pandas and llm_client are imported when a stage first needs them, so
+# --help, argument errors and other early exits don't pay for them.
+_llm_client: Any = None
+_llm_client_probed = False
+
 
-# Option 3: Check if llm_client.py exists in current directory
-if LLMClient is None:
-    local_llm_client = Path(__file__).parent / "llm_client.py"
-    if local_llm_client.exists():
+def load_pandas() -> Any:
+    """Import pandas (needed from the load stage on)."""
+    try:
+        import pandas
+    except ImportError:
+        raise RuntimeError("pandas is required. Install with: pip install pandas") from None
+    return pandas
+
+
+def load_llm_client() -> Any:
+    """
+    The llm_client module, or None if it isn't available.
+    
+    Probed once: the import path first, then the current course week_04,
+    then the copy archived next to this runner. Optional features
+    (Cassette, Deadline, make_provider) are looked up on the module, since
+    the archived client predates them.
+    """
+    global _llm_client, _llm_client_probed
+    if _llm_client_probed:
+        return _llm_client
+    _llm_client_probed = True
+    # The current client imports requests lazily; without it no call can run
+    if importlib.util.find_spec("requests") is None:
+        return None
+    for week_04_path in (
+        None,
+        Path(__file__).resolve().parents[2] / "week_04",
+        Path(__file__).parent.parent / "week_04",
+    ):
+        if week_04_path is not None:
+            if not week_04_path.exists():
+                continue
+            sys.path.insert(0, str(week_04_path))
         try:
-            from llm_client import LLMClient, LLMRequest, LLMResponse
+            import llm_client
         except ImportError:
-            pass
+            if week_04_path is not None:
+                sys.path.remove(str(week_04_path))
+            continue
+        _llm_client = llm_client
+        break
+    return _llm_client
+
 
+# Seconds of the --budget held back from the LLM call for the report stage
+REPORT_RESERVE_S = 1.0
 
 logger = logging.getLogger(__name__)
 
@@ -93,6 +120,12 @@ class Config:
     sample_n: int
     timeout_s: float
     max_retries: int
+    record_path: Optional[Path] = None
+    replay_path: Optional[Path] = None
+    replay_latency: str = "zero"
+    budget_s: Optional[float] = None
+    provider: str = "ollama"
+    host: Optional[str] = None
     
     @classmethod
     def from_args(cls, args: argparse.Namespace) -> "Config":
@@ -104,6 +137,12 @@ class Config:
             sample_n=args.sample_n,
             timeout_s=args.timeout,
             max_retries=args.max_retries,
+            record_path=Path(args.record) if args.record else None,
+            replay_path=Path(args.replay) if args.replay else None,
+            replay_latency=args.replay_latency,
+            budget_s=args.budget,
+            provider=args.provider,
+            host=args.host,
         )
 
 
@@ -119,7 +158,7 @@ def load_csv(path: Path) -> pd.DataFrame:
     if path.stat().st_size == 0:
         raise ValueError(f"Input file is empty: {path}")
     
-    df = pd.read_csv(path)
+    df = load_pandas().read_csv(path)
     if df.empty:
         raise ValueError(f"CSV has no rows: {path}")
     
@@ -317,44 +356,61 @@ def call_llm(
     timeout_s: float = 60.0,
     max_retries: int = 3,
     output_dir: Path = Path("output"),
+    client: Optional["LLMClient"] = None,
+    deadline: Optional["Deadline"] = None,
 ) -> Tuple[str, Dict[str, Any]]:
-    """Call LLM with compressed table and return raw + validated output."""
+    """
+    Call LLM with compressed table and return raw + validated output.
+    
+    Pass `client` to reuse its connection pool; otherwise a short-lived
+    client is created and closed after the call. With a `deadline`, the
+    call's attempts and backoff sleeps stop when it runs out.
+    """
     prompt = build_prompt(compressed)
     
     # Save raw prompt
     (output_dir / "llm_prompt.txt").write_text(prompt, encoding="utf-8")
     
-    if LLMClient is None:
+    llm = load_llm_client()
+    if llm is None:
         # Fallback: return placeholder
         logger.warning("llm_client not available, returning placeholder")
         raw = "LLM client not available. Install dependencies and ensure Ollama is running."
         validated = {"summary": raw, "error": "llm_client_unavailable"}
     else:
-        client = LLMClient(
-            timeout_s=timeout_s,
-            max_retries=max_retries,
-            output_dir=output_dir,
-        )
-        response = client.call(LLMRequest(
-            model=model,
-            prompt=prompt,
-            temperature=0.0,
-        ))
-        
-        if response.ok:
-            raw = response.text
-            validated = {
-                "summary": raw[:500] + "..." if len(raw) > 500 else raw,
-                "model": model,
-                "latency_s": response.latency_s,
-            }
-        else:
-            raw = ""
-            validated = {
-                "error": response.error,
-                "error_type": response.error_type,
-            }
-            client.persist_failure(LLMRequest(model=model, prompt=prompt), response)
+        owns_client = client is None
+        if owns_client:
+            client = llm.LLMClient(
+                timeout_s=timeout_s,
+                max_retries=max_retries,
+                output_dir=output_dir,
+            )
+        try:
+            response = client.call(
+                llm.LLMRequest(model=model, prompt=prompt, temperature=0.0),
+                timeout_s=timeout_s,
+                max_retries=max_retries,
+                **({"deadline": deadline} if deadline is not None else {}),
+            )
+            
+            if response.ok:
+                raw = response.text
+                validated = {
+                    "summary": raw[:500] + "..." if len(raw) > 500 else raw,
+                    "model": model,
+                    "latency_s": response.latency_s,
+                }
+            else:
+                raw = ""
+                validated = {
+                    "error": response.error,
+                    "error_type": response.error_type,
+                }
+                client.persist_failure(llm.LLMRequest(model=model, prompt=prompt), response)
+        finally:
+            # close() also flushes the failure journal
+            if owns_client:
+                client.close()
     
     # Save outputs
     (output_dir / "llm_raw.txt").write_text(raw, encoding="utf-8")
@@ -450,21 +506,75 @@ def generate_report(
 # ============================================================================
 
 
+def open_cassette(config: Config) -> Optional["Cassette"]:
+    """Cassette for --record/--replay, or None for live calls."""
+    if config.record_path is None and config.replay_path is None:
+        return None
+    cassette_type = getattr(load_llm_client(), "Cassette", None)
+    if cassette_type is None:
+        raise RuntimeError("--record/--replay need the week_04 llm_client with Cassette support")
+    if config.replay_path is not None:
+        return cassette_type(config.replay_path, mode="replay", latency=config.replay_latency)
+    return cassette_type(config.record_path, mode="record")
+
+
+def client_options(config: Config) -> Dict[str, Any]:
+    """LLMClient keyword arguments for --host/--provider (empty for the defaults)."""
+    options: Dict[str, Any] = {}
+    if config.host is not None:
+        options["host"] = config.host
+    if config.provider != "ollama":
+        make_provider = getattr(load_llm_client(), "make_provider", None)
+        if make_provider is None:
+            raise RuntimeError("--provider needs the week_04 llm_client with provider support")
+        options["provider"] = make_provider(config.provider)
+    return options
+
+
+def open_deadline(config: Config) -> Optional["Deadline"]:
+    """End-to-end Deadline for --budget, or None for an unbounded run."""
+    if config.budget_s is None:
+        return None
+    deadline_type = getattr(load_llm_client(), "Deadline", None)
+    if deadline_type is None:
+        raise RuntimeError("--budget needs the week_04 llm_client with Deadline support")
+    return deadline_type(config.budget_s)
+
+
 def run_pipeline(config: Config) -> Dict[str, Any]:
     """Run the full pipeline."""
     config.output_dir.mkdir(parents=True, exist_ok=True)
     
-    results: Dict[str, Any] = {"config": asdict(config)}
+    results: Dict[str, Any] = {"config": asdict(config), "timings": {}}
     results["config"]["input_path"] = str(config.input_path)
     results["config"]["output_dir"] = str(config.output_dir)
+    for key in ("record_path", "replay_path"):
+        if results["config"][key] is not None:
+            results["config"][key] = str(results["config"][key])
+    
+    stage = "load"
+    stage_started = time.monotonic()
+    deadline = None
+    
+    def begin(name: str) -> None:
+        # Close out the previous stage's timing; refuse to start past the deadline
+        nonlocal stage, stage_started
+        now = time.monotonic()
+        results["timings"][stage] = round(now - stage_started, 3)
+        stage, stage_started = name, now
+        if deadline is not None:
+            deadline.check(name)
     
     try:
+        deadline = open_deadline(config)
+        
         # Stage 1: Load
         print(f"[1/5] Loading data from {config.input_path}...")
         df = load_csv(config.input_path)
         results["load"] = {"rows": len(df), "columns": list(df.columns)}
         
         # Stage 2: Profile
+        begin("profile")
         print("[2/5] Profiling data...")
         profile = profile_data(df, config.seed)
         (config.output_dir / "profile.json").write_text(
@@ -473,6 +583,7 @@ def run_pipeline(config: Config) -> Dict[str, Any]:
         results["profile"] = profile.to_dict()
         
         # Stage 3: Compress
+        begin("compress")
         print("[3/5] Compressing data...")
         compressed = compress_table(df, sample_n=config.sample_n, seed=config.seed)
         (config.output_dir / "compressed_input.json").write_text(
@@ -481,17 +592,49 @@ def run_pipeline(config: Config) -> Dict[str, Any]:
         results["compressed"] = {"sample_rows": len(compressed.sample_rows)}
         
         # Stage 4: LLM
+        begin("llm")
+        # With no more than the report's reserve left, the call would get a
+        # zero budget; stop here so the timeout is charged to this stage
+        if deadline is not None and deadline.remaining() <= REPORT_RESERVE_S:
+            raise load_llm_client().DeadlineExceeded(deadline, stage="llm")
         print(f"[4/5] Calling LLM ({config.model})...")
-        raw, validated = call_llm(
-            compressed,
-            config.model,
-            timeout_s=config.timeout_s,
-            max_retries=config.max_retries,
-            output_dir=config.output_dir,
-        )
+        client = None
+        cassette = None
+        llm = load_llm_client()
+        if llm is not None:
+            cassette = open_cassette(config)
+            client = llm.LLMClient(
+                timeout_s=config.timeout_s,
+                max_retries=config.max_retries,
+                output_dir=config.output_dir,
+                **({"cassette": cassette} if cassette is not None else {}),
+                **client_options(config),
+            )
+        try:
+            raw, validated = call_llm(
+                compressed,
+                config.model,
+                timeout_s=config.timeout_s,
+                max_retries=config.max_retries,
+                output_dir=config.output_dir,
+                client=client,
+                deadline=deadline.child(reserve_s=REPORT_RESERVE_S) if deadline else None,
+            )
+            if client is not None:
+                results["llm_pool"] = client.pool_stats()
+            if cassette is not None:
+                results["llm_cassette"] = cassette.stats()
+        finally:
+            if client is not None:
+                client.close()
+            if cassette is not None:
+                cassette.close()
         results["llm"] = validated
+        if deadline is not None and validated.get("error_type") == "DeadlineExceeded":
+            raise load_llm_client().DeadlineExceeded(deadline, stage="llm")
         
         # Stage 5: Report
+        begin("report")
         print("[5/5] Generating report...")
         report = generate_report(
             config.input_path,
@@ -501,6 +644,7 @@ def run_pipeline(config: Config) -> Dict[str, Any]:
             config.output_dir,
         )
         results["report"] = report.to_dict()
+        begin("done")
         
         results["success"] = True
         print(f"\n✓ Pipeline completed successfully!")
@@ -510,6 +654,16 @@ def run_pipeline(config: Config) -> Dict[str, Any]:
         results["success"] = False
         results["error"] = str(e)
         results["error_type"] = type(e).__name__
+        results["stage"] = stage
+        results["timings"][stage] = round(time.monotonic() - stage_started, 3)
+        # A deadline exists only if llm_client (with DeadlineExceeded) loaded
+        timed_out = deadline is not None and isinstance(e, load_llm_client().DeadlineExceeded)
+        if timed_out:
+            # Stages finished so far stay in results as the partial result
+            results["timed_out"] = True
+            results["partial"] = True
+            results["elapsed_s"] = round(deadline.elapsed(), 3)
+            results["budget_s"] = config.budget_s
         
         # Save failure record
         failure_path = config.output_dir / "pipeline_failure.json"
@@ -517,13 +671,19 @@ def run_pipeline(config: Config) -> Dict[str, Any]:
             json.dumps({
                 "error": str(e),
                 "error_type": type(e).__name__,
-                "stage": list(results.keys())[-1] if len(results) > 1 else "unknown",
+                "stage": stage,
+                "timed_out": timed_out,
+                "completed_stages": [s for s in results["timings"] if s != stage],
             }, indent=2),
             encoding="utf-8"
         )
         
-        print(f"\n✗ Pipeline failed: {e}")
-        logger.error(f"Pipeline failed: {e}", exc_info=True)
+        if timed_out:
+            print(f"\n✗ Pipeline stopped at the {config.budget_s}s budget in stage {stage}")
+            logger.warning(f"Pipeline out of time: {e}")
+        else:
+            print(f"\n✗ Pipeline failed: {e}")
+            logger.error(f"Pipeline failed: {e}", exc_info=True)
     
     return results
 
@@ -543,6 +703,10 @@ def build_parser() -> argparse.ArgumentParser:
 Examples:
   python run_capstone.py --input data.csv --model llama3.1
   python run_capstone.py --input data.csv --output_dir results --model gpt-4
+  python run_capstone.py --input data.csv --model llama3.1 --record runs/llm.jsonl.gz
+  python run_capstone.py --input data.csv --model llama3.1 --replay runs/llm.jsonl.gz
+  python run_capstone.py --input data.csv --model llama3.1 --budget 90
+  python run_capstone.py --input data.csv --model qwen2.5-7b --provider openai --host http://localhost:8000
 
 Output artifacts:
   - output/profile.json        Data profile
@@ -596,6 +760,43 @@ Output artifacts:
         dest="max_retries",
         help="Maximum LLM retry attempts (default: 3)",
     )
+    parser.add_argument(
+        "--provider",
+        choices=["ollama", "openai"],
+        default="ollama",
+        help="API the LLM server speaks: Ollama or OpenAI-compatible, e.g. vLLM (default: ollama)",
+    )
+    parser.add_argument(
+        "--host",
+        default=None,
+        help="LLM server URL (default: http://localhost:11434); "
+             "the openai provider reads OPENAI_API_KEY",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="End-to-end time budget for all stages; stop early with a partial result",
+    )
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        "--record",
+        metavar="PATH",
+        help="Record LLM replies (with timings) to a cassette file (.gz to compress)",
+    )
+    cassette.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Serve LLM replies from a recorded cassette; no model server needed",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        choices=["zero", "recorded"],
+        default="zero",
+        dest="replay_latency",
+        help="Replay instantly or with the recorded latency (default: zero)",
+    )
     parser.add_argument(
         "--verbose", "-v",
         action="store_true",
@@ -623,6 +824,12 @@ def validate_args(args: argparse.Namespace) -> None:
     
     if args.timeout <= 0:
         raise ValueError("Timeout must be positive")
+    
+    if args.budget is not None and args.budget <= 0:
+        raise ValueError("Budget must be positive")
+    
+    if args.replay and not Path(args.replay).expanduser().exists():
+        raise FileNotFoundError(f"Cassette not found: {args.replay}")
 
 
 def main() -> int:
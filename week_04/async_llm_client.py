@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Asyncio counterpart of LLMClient.
+
+Same caching, retry, classification and rate-limit semantics as
+LLMClient.call, but every call is a coroutine, so a single event loop can
+keep many requests in flight without threads.
+
+Requires httpx (pip install httpx).
+
+Usage:
+    import asyncio
+    from async_llm_client import AsyncLLMClient
+    from llm_client import LLMRequest
+
+    async def main(prompts):
+        async with AsyncLLMClient(max_concurrency=32) as client:
+            return await asyncio.gather(*(
+                client.call(LLMRequest(model="llama3.1", prompt=p))
+                for p in prompts
+            ))
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import replace
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+from llm_client import (
+    Cassette,
+    CircuitBreaker,
+    EndpointPool,
+    HostRouter,
+    LLMRequest,
+    LLMMetrics,
+    LLMProvider,
+    LLMResponse,
+    LRUCache,
+    MetricsRegistry,
+    OllamaProvider,
+    ProviderReply,
+    ResponseCache,
+    TokenBucket,
+    Deadline,
+    FailureJournal,
+    TransientError,
+    cache_store,
+    cache_value,
+    classify_exception,
+    error_for_status,
+    failed_response,
+    log_deadline_exhausted,
+    make_cache_key,
+    plan_retry,
+    reply_from_cache,
+)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLLMClient:
+    """
+    Asyncio LLM client with bounded concurrency.
+
+    At most `max_concurrency` provider requests are in flight at once;
+    further calls wait on a semaphore (backoff sleeps do not hold a slot).
+    Retries follow the same plan_retry() policy as LLMClient, including
+    failover between the hosts of an EndpointPool.
+
+    Example:
+        async with AsyncLLMClient(host="http://localhost:11434") as client:
+            response = await client.call(LLMRequest(model="llama3.1", prompt="Hi"))
+    """
+
+    def __init__(
+        self,
+        host: str = "http://localhost:11434",
+        *,
+        timeout_s: float = 30.0,
+        max_retries: int = 3,
+        max_concurrency: int = 16,
+        cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        output_dir: Optional[Path] = None,
+        coalesce: bool = True,
+        rate_limit_cost: Optional[Callable[[LLMRequest], float]] = None,
+        deadline_s: Optional[float] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        endpoints: Optional[EndpointPool] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        cassette: Optional[Cassette] = None,
+        failure_journal: Optional[FailureJournal] = None,
+        keep_alive: Optional[Union[str, float]] = None,
+        provider: Optional[LLMProvider] = None,
+    ) -> None:
+        if httpx is None:
+            raise ImportError("AsyncLLMClient requires httpx. Install with: pip install httpx")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        # With an endpoint pool, `host` is only used as a label/fallback.
+        if endpoints is not None:
+            host = endpoints.hosts[0]
+        self.host = host
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        # Budget for all attempts + backoff sleeps of one call (None = unbounded)
+        self.deadline_s = deadline_s
+        # Request/reply format; `keep_alive` configures the default Ollama provider
+        self._provider = provider if provider is not None else OllamaProvider(keep_alive=keep_alive)
+        # How long Ollama keeps a model loaded after each request (None = server default)
+        self.keep_alive = keep_alive if keep_alive is not None else getattr(provider, "keep_alive", None)
+        self.max_concurrency = max_concurrency
+        self._cache = cache if cache is not None else LRUCache()
+        self._rate_limiter = rate_limiter
+        # Optional per-host breaker; share one instance across clients
+        self._breaker = circuit_breaker
+        # Optional set of hosts to balance across and fail over between
+        self._endpoints = endpoints
+        self._router = HostRouter(host, endpoints=endpoints, breaker=circuit_breaker)
+        # Optional counters/histograms; share one registry across clients
+        self._metrics = LLMMetrics(metrics) if metrics is not None else None
+        # Optional record/replay of provider replies (replay skips the network)
+        self._cassette = cassette
+        # Tokens charged per request; defaults to a flat 1 per request.
+        self._rate_limit_cost = rate_limit_cost
+        self._output_dir = output_dir or Path("output")
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+        # persist_failure() appends here; flushed on aclose()
+        self._journal = failure_journal or FailureJournal(self._output_dir)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+            headers=self._provider.headers(),
+        )
+        self._in_flight = 0
+        # cache key -> task of the first caller; duplicates await the same task
+        self._inflight: Optional[Dict[str, "asyncio.Task[LLMResponse]"]] = {} if coalesce else None
+
+    def stats(self) -> Dict[str, Any]:
+        """Current concurrency usage."""
+        return {"max_concurrency": self.max_concurrency, "in_flight": self._in_flight}
+
+    def endpoint_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-endpoint health, outstanding requests and EWMA latency."""
+        if self._endpoints is None:
+            return {}
+        return self._endpoints.stats()
+
+    async def aclose(self) -> None:
+        """Flush the failure journal and close pooled connections."""
+        self._journal.flush()
+        await self._http.aclose()
+
+    async def __aenter__(self) -> "AsyncLLMClient":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def _attempt(self, req: LLMRequest, *, timeout_s: float, host: str) -> ProviderReply:
+        """One provider call to `host` behind the circuit breaker, if set."""
+        if self._cassette is not None and self._cassette.replaying:
+            reply, entry = self._cassette.next_reply(
+                req, key=make_cache_key(req, provider=self._provider)
+            )
+            delay_s = self._cassette.delay_s(entry)
+            if delay_s:
+                await asyncio.sleep(delay_s)
+            return reply
+        if self._breaker is None and self._endpoints is None:
+            return await self._recorded_call(req, timeout_s=timeout_s, host=host)
+        if self._breaker is not None:
+            self._breaker.before_call(host)
+        if self._endpoints is not None:
+            self._endpoints.begin(host)
+        t0 = time.monotonic()
+        reason: Optional[str] = "cancelled"
+        try:
+            reply = await self._recorded_call(req, timeout_s=timeout_s, host=host)
+            reason = None
+            return reply
+        except Exception as e:
+            reason = classify_exception(e).reason
+            raise
+        finally:
+            if self._breaker is not None:
+                self._breaker.record(host, reason)
+            if self._endpoints is not None:
+                self._endpoints.end(host, latency_s=time.monotonic() - t0, reason=reason)
+
+    async def _recorded_call(self, req: LLMRequest, *, timeout_s: float, host: str) -> ProviderReply:
+        t0 = time.monotonic()
+        # Like LLMClient, `host` is only passed with an EndpointPool, so
+        # overrides written before it existed keep working
+        if self._endpoints is None:
+            reply = await self._provider_call(req, timeout_s=timeout_s)
+        else:
+            reply = await self._provider_call(req, timeout_s=timeout_s, host=host)
+        if self._cassette is not None:
+            self._cassette.record(
+                req, reply, time.monotonic() - t0, key=make_cache_key(req, provider=self._provider)
+            )
+        return reply
+
+    async def _provider_call(
+        self, req: LLMRequest, *, timeout_s: float, host: Optional[str] = None
+    ) -> ProviderReply:
+        """Make the HTTP call to the provider; errors are mapped like LLMClient's."""
+        host = host or self.host
+        url, payload = self._provider.request(req, host)
+
+        # Wait for the rate limiter without blocking the event loop; the
+        # request gets what is left of the timeout
+        if self._rate_limiter is not None:
+            t0 = time.monotonic()
+            cost = self._rate_limit_cost(req) if self._rate_limit_cost else 1.0
+            admitted = await self._rate_limiter.acquire_async(cost, timeout_s=timeout_s)
+            timeout_s -= time.monotonic() - t0
+            if not admitted or timeout_s <= 0:
+                raise TransientError("Rate limit exceeded (client-side)", reason="client_rate_limit")
+
+        async with self._semaphore:
+            self._in_flight += 1
+            try:
+                resp = await self._http.post(url, json=payload, timeout=timeout_s)
+            except httpx.TimeoutException as e:
+                raise TransientError(f"Request timed out after {timeout_s}s", reason="timeout") from e
+            except httpx.TransportError as e:
+                raise TransientError(f"Connection failed: {host}", reason="connection") from e
+            finally:
+                self._in_flight -= 1
+
+        if resp.status_code >= 400:
+            raise error_for_status(resp.status_code, resp.headers)
+        return self._provider.parse(resp.json())
+
+    async def call(
+        self,
+        req: LLMRequest,
+        *,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        deadline_s: Optional[float] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> LLMResponse:
+        """
+        Call the LLM with caching, retries, and logging.
+
+        Args:
+            req: The LLM request payload
+            timeout_s: Override default per-attempt timeout
+            max_retries: Override default max retries
+            deadline_s: Override default total budget across all attempts
+            deadline: Caller's Deadline; attempts are sized to what is left of it
+
+        Returns:
+            LLMResponse with result or error details
+        """
+        t0 = time.monotonic()
+        deadline_s = deadline_s if deadline_s is not None else self.deadline_s
+        if deadline is not None and deadline_s is not None:
+            deadline = deadline.child(deadline_s)
+        elif deadline is None and deadline_s is not None:
+            deadline = Deadline(deadline_s)
+        response = await self._call(
+            req, timeout_s=timeout_s, max_retries=max_retries, deadline=deadline
+        )
+        if self._metrics is not None:
+            self._metrics.observe_call(response, time.monotonic() - t0)
+        return response
+
+    async def _call(
+        self,
+        req: LLMRequest,
+        *,
+        timeout_s: Optional[float],
+        max_retries: Optional[int],
+        deadline: Optional[Deadline],
+    ) -> LLMResponse:
+        request_id = str(uuid.uuid4())[:8]
+        timeout_s = timeout_s or self.timeout_s
+        max_retries = max_retries if max_retries is not None else self.max_retries
+
+        # Check cache
+        cache_key = make_cache_key(req, provider=self._provider)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            logger.info(
+                "llm_cache_hit",
+                extra={"request_id": request_id, "model": req.model}
+            )
+            reply = reply_from_cache(req, cached)
+            return LLMResponse(
+                ok=True,
+                text=reply.text,
+                model=req.model,
+                latency_s=0.0,
+                request_id=request_id,
+                cached=True,
+                choices=reply.choices,
+            )
+
+        if self._inflight is None:
+            return await self._call_uncached(
+                req,
+                request_id=request_id,
+                cache_key=cache_key,
+                timeout_s=timeout_s,
+                max_retries=max_retries,
+                deadline=deadline,
+            )
+
+        while True:
+            task = self._inflight.get(cache_key)
+            shared = task is not None
+            if task is None:
+                task = asyncio.ensure_future(self._call_uncached(
+                    req,
+                    request_id=request_id,
+                    cache_key=cache_key,
+                    timeout_s=timeout_s,
+                    max_retries=max_retries,
+                    deadline=deadline,
+                ))
+                self._inflight[cache_key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+
+            # shield: a cancelled caller must not cancel the call others wait on;
+            # each caller waits no longer than its own deadline allows
+            try:
+                response = await asyncio.wait_for(
+                    asyncio.shield(task), deadline.remaining() if deadline else None
+                )
+            except asyncio.TimeoutError as e:
+                return failed_response(req, request_id, e, deadline)
+            # The leader ran out of its own budget (or was cancelled); that
+            # says nothing about ours, so go again rather than share it
+            if not (shared and response.error_type == "DeadlineExceeded"):
+                break
+        if shared:
+            logger.info(
+                "llm_call_coalesced",
+                extra={"request_id": request_id, "model": req.model, "leader_id": response.request_id}
+            )
+            return replace(response, request_id=request_id, coalesced=True)
+        return response
+
+    async def _call_uncached(
+        self,
+        req: LLMRequest,
+        *,
+        request_id: str,
+        cache_key: str,
+        timeout_s: float,
+        max_retries: int,
+        deadline: Optional[Deadline] = None,
+    ) -> LLMResponse:
+        """Run the retry loop against the provider and cache a success."""
+        # Retry loop
+        last_err: Optional[Exception] = None
+        out_of_time = False
+        failed_hosts: set = set()
+        for attempt in range(max_retries + 1):
+            if deadline is not None and deadline.expired():
+                out_of_time = True
+                log_deadline_exhausted(request_id, req, deadline, 0.0, attempt)
+                break
+            if attempt and self._metrics is not None and last_err is not None:
+                self._metrics.observe_retry(req.model, classify_exception(last_err).reason)
+            t0 = time.time()
+            host = self._router.pick(failed_hosts)
+            try:
+                attempt_timeout_s = deadline.clamp(timeout_s) if deadline else timeout_s
+                reply = await self._attempt(req, timeout_s=attempt_timeout_s, host=host)
+                latency_s = time.time() - t0
+
+                logger.info(
+                    "llm_call_ok",
+                    extra={
+                        "request_id": request_id,
+                        "model": req.model,
+                        "host": host,
+                        "latency_s": latency_s,
+                        "attempt": attempt,
+                        **(reply.usage.log_fields() if reply.usage else {}),
+                    }
+                )
+                if self._metrics is not None:
+                    self._metrics.observe_attempt(req.model, host, latency_s)
+
+                # Cache successful response
+                cache_store(self._cache, cache_key, cache_value(req, reply), model=req.model)
+
+                return LLMResponse(
+                    ok=True,
+                    text=reply.text,
+                    model=req.model,
+                    latency_s=latency_s,
+                    request_id=request_id,
+                    usage=reply.usage,
+                    choices=reply.choices,
+                )
+
+            except Exception as e:
+                last_err = e
+                latency_s = time.time() - t0
+                step = plan_retry(
+                    e,
+                    attempt=attempt,
+                    max_retries=max_retries,
+                    deadline=deadline,
+                    router=self._router,
+                    host=host,
+                    failed_hosts=failed_hosts,
+                )
+                decision = step.decision
+
+                logger.warning(
+                    "llm_call_failed",
+                    extra={
+                        "request_id": request_id,
+                        "model": req.model,
+                        "host": host,
+                        "latency_s": latency_s,
+                        "attempt": attempt,
+                        "error_type": type(e).__name__,
+                        "reason": decision.reason,
+                        "retryable": decision.should_retry,
+                    }
+                )
+                if self._metrics is not None:
+                    self._metrics.observe_attempt(req.model, host, latency_s, decision.reason)
+
+                if step.action == "stop":
+                    if step.out_of_time:
+                        out_of_time = True
+                        log_deadline_exhausted(request_id, req, deadline, step.delay_s, attempt)
+                    break
+                if step.action == "backoff":
+                    # deadline.sleep_async() wakes up on Deadline.cancel()
+                    if deadline is not None:
+                        await deadline.sleep_async(step.delay_s)
+                    else:
+                        await asyncio.sleep(step.delay_s)
+
+        # All retries exhausted
+        # An attempt cut short by the deadline clamp is the deadline's doing too
+        out_of_time = out_of_time or (deadline is not None and deadline.expired())
+        return failed_response(req, request_id, last_err, deadline if out_of_time else None)
+
+    def persist_failure(self, req: LLMRequest, response: LLMResponse) -> Path:
+        """Append a failure record to the journal; returns the journal file."""
+        return self._journal.append(req, response)
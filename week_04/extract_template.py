@@ -10,6 +10,8 @@ This script demonstrates:
 
 Usage:
     python extract_template.py --input "John Smith, email: john@example.com, phone: 555-1234"
+    python extract_template.py --input "..." --record runs/extract.jsonl   # then --replay
+    python extract_template.py --input "..." --provider openai --host http://localhost:8000 --model qwen2.5-7b
 """
 
 from __future__ import annotations
@@ -18,14 +20,19 @@ import argparse
 import json
 import re
 import sys
+import time
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional
 
-try:
-    import requests
-except ImportError:
-    print("Error: requests is required. Install with: pip install requests")
-    sys.exit(1)
+from llm_client import (
+    Cassette,
+    GenerationStats,
+    LLMProvider,
+    LLMRequest,
+    OpenAICompatibleProvider,
+    ProviderReply,
+    make_cache_key,
+)
 
 
 # ============================================================================
@@ -104,21 +111,53 @@ def call_ollama(
     prompt: str,
     model: str = "llama3.1",
     host: str = "http://localhost:11434",
-    timeout_s: float = 60.0
+    timeout_s: float = 60.0,
+    cassette: Optional[Cassette] = None,
+    provider: Optional[LLMProvider] = None,
 ) -> str:
-    """Call Ollama API."""
-    url = f"{host}/api/generate"
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False,
-        "format": "json"  # Request JSON output
-    }
+    """
+    Call Ollama API (or replay/record through `cassette`).
     
-    resp = requests.post(url, json=payload, timeout=timeout_s)
+    Pass `provider` to talk to another API instead, e.g. an
+    OpenAICompatibleProvider for a vLLM server at `host`.
+    """
+    req = LLMRequest(model=model, prompt=prompt)
+    # Keyed by provider too, so recordings against different APIs stay apart
+    cassette_key = make_cache_key(req, provider=provider)
+    if cassette is not None and cassette.replaying:
+        return cassette.play(req, key=cassette_key).text
+    
+    # Imported here so --help and cassette replays start without it
+    try:
+        import requests
+    except ImportError:
+        print("Error: requests is required. Install with: pip install requests")
+        sys.exit(1)
+    
+    if provider is None:
+        url = f"{host}/api/generate"
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": False,
+            "format": "json"  # Request JSON output
+        }
+        headers = None
+    else:
+        url, payload = provider.request(req, host)
+        headers = provider.headers()
+    
+    t0 = time.monotonic()
+    resp = requests.post(url, json=payload, headers=headers, timeout=timeout_s)
     resp.raise_for_status()
     data = resp.json()
-    return data.get("response", "")
+    if provider is None:
+        reply = ProviderReply(data.get("response", ""), GenerationStats.from_ollama(data))
+    else:
+        reply = provider.parse(data)
+    if cassette is not None:
+        cassette.record(req, reply, time.monotonic() - t0, key=cassette_key)
+    return reply.text
 
 
 def validate_json_output(text: str, schema: Dict[str, Any]) -> Dict[str, Any]:
@@ -170,7 +209,10 @@ def extract_with_retry(
     text: str,
     schema: Dict[str, Any],
     model: str = "llama3.1",
-    max_retries: int = 3
+    max_retries: int = 3,
+    cassette: Optional[Cassette] = None,
+    host: str = "http://localhost:11434",
+    provider: Optional[LLMProvider] = None,
 ) -> Dict[str, Any]:
     """Extract structured data with retry logic."""
     prompt = build_extraction_prompt(text, schema)
@@ -179,7 +221,9 @@ def extract_with_retry(
         print(f"Attempt {attempt + 1}/{max_retries}...")
         
         try:
-            raw_output = call_ollama(prompt, model=model)
+            raw_output = call_ollama(
+                prompt, model=model, host=host, cassette=cassette, provider=provider
+            )
             print(f"  Raw output: {raw_output[:100]}...")
             
             result = validate_json_output(raw_output, schema)
@@ -286,6 +330,33 @@ def main():
         "--output", "-o",
         help="Output JSON file path"
     )
+    parser.add_argument(
+        "--provider",
+        choices=["ollama", "openai"],
+        default="ollama",
+        help="API the LLM server speaks: Ollama or OpenAI-compatible (vLLM etc.)"
+    )
+    parser.add_argument(
+        "--host",
+        help="LLM server URL (default: localhost:11434 for ollama, localhost:8000 for openai)"
+    )
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record",
+        metavar="PATH",
+        help="Record LLM replies (with timings) to a cassette file"
+    )
+    cassette_group.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Serve LLM replies from a recorded cassette instead of Ollama"
+    )
+    parser.add_argument(
+        "--replay-latency",
+        choices=["zero", "recorded"],
+        default="zero",
+        help="Replay instantly or with the recorded latency"
+    )
     
     args = parser.parse_args()
     
@@ -293,13 +364,33 @@ def main():
     schema = CONTACT_SCHEMA if args.schema == "contact" else PRODUCT_SCHEMA
     print(f"Using schema: {args.schema}")
     
+    provider = None
+    host = args.host or "http://localhost:11434"
+    if args.provider == "openai":
+        # JSON mode is the chat-completions counterpart of Ollama's format=json
+        provider = OpenAICompatibleProvider(extra={"response_format": {"type": "json_object"}})
+        host = args.host or "http://localhost:8000"
+    
+    cassette = None
+    if args.replay:
+        cassette = Cassette(args.replay, mode="replay", latency=args.replay_latency)
+    elif args.record:
+        cassette = Cassette(args.record, mode="record")
+    
     # Extract
-    result = extract_with_retry(
-        args.input,
-        schema,
-        model=args.model,
-        max_retries=args.max_retries
-    )
+    try:
+        result = extract_with_retry(
+            args.input,
+            schema,
+            model=args.model,
+            max_retries=args.max_retries,
+            cassette=cassette,
+            host=host,
+            provider=provider,
+        )
+    finally:
+        if cassette is not None:
+            cassette.close()
     
     # Output
     output_json = json.dumps(result, indent=2)
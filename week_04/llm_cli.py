@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Command-line entry point for llm_client.
+
+A script run directly is compiled afresh on every start, while an
+imported module loads from cached bytecode, so this file stays tiny and
+the CLI itself lives in llm_client.main().
+
+Usage:
+    python llm_cli.py --model llama3.1 --prompt "Hello"
+    python llm_cli.py --model llama3.1 --prompt "Hello" --stream
+"""
+
+import sys
+
+from llm_client import main
+
+if __name__ == "__main__":
+    sys.exit(main())
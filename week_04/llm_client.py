@@ -4,40 +4,95 @@ Production-ready LLM Client with reliability features.
 
 Features:
 - Timeouts (connect and read)
-- Retries with exponential backoff and jitter
-- Rate limit handling (429)
-- Response caching
+- Retries with exponential backoff and jitter, honoring Retry-After
+- Total deadline budget across retries; callers can pass one Deadline through a whole pipeline
+- Rate limit handling (429) and a thread-safe client-side token bucket
+- Response caching (bounded LRU memory, JSON file or SQLite), compressed and size-capped
 - Structured logging
+- Pooled keep-alive HTTP connections
+- Concurrent batch calls (call_many / iter_many)
+- Coalescing of identical in-flight requests
+- Streaming generation with time-to-first-token timing
+- Adaptive (AIMD) concurrency limit
+- Per-host circuit breaker
+- Load balancing and failover across several endpoints
+- Opt-in hedged requests to trim tail latency
+- Token counts and prefill/decode throughput from the provider
+- Metrics registry (counters, latency histograms) with Prometheus export
+- Record/replay cassettes for deterministic offline runs
+- Buffered, rotating failure journal with bulk replay
+- Resumable bulk cache warmup
+- Model preload/keep_alive and model-grouped batch scheduling
+- Ollama and OpenAI-compatible providers (with n > 1 choices) behind one client
+- Opt-in prompt packing of many small requests into one
+- Priority classes with weighted fair queueing and admission control
+- Lazy imports of requests/asyncio/http.server so CLIs start fast
 
 Usage:
+    python llm_cli.py --model llama3.1 --prompt "Hello" [--stream]
+    
     from llm_client import LLMClient, LLMRequest
     
-    client = LLMClient()
-    response = client.call(LLMRequest(
-        model="llama3.1",
-        prompt="Hello, world!",
-        temperature=0.0
-    ))
+    with LLMClient() as client:
+        response = client.call(LLMRequest(
+            model="llama3.1",
+            prompt="Hello, world!",
+            temperature=0.0
+        ))
 """
 
 from __future__ import annotations
 
+import atexit
+import base64
+import bisect
+import gzip
 import hashlib
+import heapq
 import json
 import logging
+import math
 import os
 import random
+import sqlite3
+import sys
+import threading
 import time
 import uuid
-from dataclasses import asdict, dataclass
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from dataclasses import asdict, dataclass, field, replace
 from pathlib import Path
-from typing import Any, Callable, Dict, Optional, Tuple
+from typing import (
+    TYPE_CHECKING, Any, Callable, Collection, Dict, Generic, Iterable, Iterator, List, Mapping,
+    Optional, Protocol, Sequence, Tuple, TypeVar, Union, runtime_checkable,
+)
 
-import requests
-from requests.exceptions import ConnectionError, Timeout, HTTPError, RequestException
+# requests, asyncio and http.server cost more to import than the rest of
+# this module; they are imported where first needed so --help, cache
+# tools and cassette replays start fast.
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+    
+    import requests
 
 logger = logging.getLogger(__name__)
 
+# Objects holding buffered writes; flush() is called on them at exit so
+# clients that are never closed don't lose what they buffered.
+_FLUSH_AT_EXIT: "weakref.WeakSet[Any]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    for obj in list(_FLUSH_AT_EXIT):
+        try:
+            obj.flush()
+        except Exception as e:
+            logger.warning("flush_at_exit_failed", extra={"type": type(obj).__name__, "error": str(e)})
+
 
 # ============================================================================
 # Data Classes
@@ -52,6 +107,91 @@ class LLMRequest:
     system_prompt: str = ""
     temperature: float = 0.0
     max_tokens: int = 1024
+    # Completions to sample server-side (OpenAI-compatible providers only)
+    n: int = 1
+
+
+@dataclass(frozen=True)
+class GenerationStats:
+    """
+    Token counts and server-side timings reported by the provider.
+    
+    Ollama reports durations in nanoseconds; they are stored in seconds.
+    `load_duration_s` is the time spent loading the model into memory, so a
+    large value flags a cold start rather than slow generation.
+    """
+    prompt_eval_count: Optional[int] = None
+    eval_count: Optional[int] = None
+    load_duration_s: Optional[float] = None
+    prompt_eval_duration_s: Optional[float] = None
+    eval_duration_s: Optional[float] = None
+    total_duration_s: Optional[float] = None
+    
+    @property
+    def prefill_tokens_per_s(self) -> Optional[float]:
+        """Prompt processing throughput."""
+        if not self.prompt_eval_count or not self.prompt_eval_duration_s:
+            return None
+        return self.prompt_eval_count / self.prompt_eval_duration_s
+    
+    @property
+    def decode_tokens_per_s(self) -> Optional[float]:
+        """Generation throughput."""
+        if not self.eval_count or not self.eval_duration_s:
+            return None
+        return self.eval_count / self.eval_duration_s
+    
+    @classmethod
+    def from_ollama(cls, data: Mapping[str, Any]) -> Optional["GenerationStats"]:
+        """Build from an Ollama /api/generate body (or final stream chunk)."""
+        def seconds(name: str) -> Optional[float]:
+            value = data.get(name)
+            return value / 1e9 if isinstance(value, (int, float)) else None
+        
+        if "eval_count" not in data and "total_duration" not in data:
+            return None
+        return cls(
+            prompt_eval_count=data.get("prompt_eval_count"),
+            eval_count=data.get("eval_count"),
+            load_duration_s=seconds("load_duration"),
+            prompt_eval_duration_s=seconds("prompt_eval_duration"),
+            eval_duration_s=seconds("eval_duration"),
+            total_duration_s=seconds("total_duration"),
+        )
+    
+    @classmethod
+    def from_openai(cls, data: Mapping[str, Any]) -> Optional["GenerationStats"]:
+        """Build from the `usage` object of an OpenAI-style completion."""
+        usage = data.get("usage")
+        if not usage:
+            return None
+        return cls(
+            prompt_eval_count=usage.get("prompt_tokens"),
+            eval_count=usage.get("completion_tokens"),
+        )
+    
+    def log_fields(self) -> Dict[str, Any]:
+        """Flat fields for structured log records."""
+        return {
+            "prompt_eval_count": self.prompt_eval_count,
+            "eval_count": self.eval_count,
+            "load_duration_s": self.load_duration_s,
+            "prefill_tokens_per_s": self.prefill_tokens_per_s,
+            "decode_tokens_per_s": self.decode_tokens_per_s,
+        }
+
+
+@dataclass(frozen=True)
+class ProviderReply:
+    """
+    What a provider call returns: the text plus any usage counters.
+    
+    With LLMRequest.n > 1, `choices` holds every completion in order and
+    `text` is the first of them.
+    """
+    text: str
+    usage: Optional[GenerationStats] = None
+    choices: Tuple[str, ...] = ()
 
 
 @dataclass
@@ -65,6 +205,33 @@ class LLMResponse:
     cached: bool = False
     error: Optional[str] = None
     error_type: Optional[str] = None
+    coalesced: bool = False
+    # Streaming only: time to first token and gaps between streamed chunks
+    ttft_s: Optional[float] = None
+    inter_token_mean_s: Optional[float] = None
+    inter_token_max_s: Optional[float] = None
+    # Provider-reported token counts and timings (None when cached)
+    usage: Optional[GenerationStats] = None
+    # Every completion when the request asked for n > 1 (text is the first)
+    choices: Tuple[str, ...] = ()
+    # Answered as one item of a packed prompt (see PromptPacker)
+    packed: bool = False
+
+
+class LLMStream:
+    """
+    Iterator over streamed text chunks.
+    
+    `response` is None until the stream has been fully consumed, then holds
+    the final LLMResponse (full text, TTFT and inter-token timing).
+    """
+    
+    def __init__(self) -> None:
+        self.response: Optional[LLMResponse] = None
+        self._chunks: Iterator[str] = iter(())
+    
+    def __iter__(self) -> Iterator[str]:
+        return self._chunks
 
 
 # ============================================================================
@@ -74,12 +241,27 @@ class LLMResponse:
 
 class TransientError(Exception):
     """Errors worth retrying (network blip, temporary overload)."""
-    pass
+    
+    def __init__(
+        self,
+        message: str = "",
+        *,
+        reason: str = "transient",
+        retry_after_s: Optional[float] = None,
+    ) -> None:
+        super().__init__(message)
+        # RetryDecision.reason label, e.g. "timeout" or "rate_limit"
+        self.reason = reason
+        # Server-requested wait (Retry-After) before the next attempt, if any
+        self.retry_after_s = retry_after_s
 
 
 class PermanentError(Exception):
     """Errors that will always fail (bad request, auth error)."""
-    pass
+    
+    def __init__(self, message: str = "", *, reason: str = "permanent") -> None:
+        super().__init__(message)
+        self.reason = reason
 
 
 @dataclass(frozen=True)
@@ -88,17 +270,27 @@ class RetryDecision:
     reason: str
 
 
+def http_errors() -> Any:
+    """The requests.exceptions module, imported on first use."""
+    from requests import exceptions
+    return exceptions
+
+
 def classify_exception(exc: BaseException) -> RetryDecision:
     """Classify an exception as retryable or permanent."""
     if isinstance(exc, TransientError):
-        return RetryDecision(True, "transient")
+        return RetryDecision(True, exc.reason)
     if isinstance(exc, PermanentError):
-        return RetryDecision(False, "permanent")
-    if isinstance(exc, Timeout):
+        return RetryDecision(False, exc.reason)
+    # Nothing can have raised a requests error before requests was imported
+    errors = sys.modules.get("requests.exceptions")
+    if errors is None:
+        return RetryDecision(False, "unknown")
+    if isinstance(exc, errors.Timeout):
         return RetryDecision(True, "timeout")
-    if isinstance(exc, ConnectionError):
+    if isinstance(exc, errors.ConnectionError):
         return RetryDecision(True, "connection")
-    if isinstance(exc, HTTPError):
+    if isinstance(exc, errors.HTTPError):
         if exc.response is not None:
             status = exc.response.status_code
             if status == 429:
@@ -115,58 +307,805 @@ def classify_exception(exc: BaseException) -> RetryDecision:
 # ============================================================================
 
 
+class ResponseCache(Protocol):
+    """Interface LLMClient expects from a cache."""
+    
+    def get(self, key: str) -> Optional[str]: ...
+    
+    def set(self, key: str, value: str) -> None: ...
+    
+    def has(self, key: str) -> bool: ...
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    """Metadata for one cached response (the value itself is not loaded)."""
+    key: str
+    size_bytes: int
+    model: Optional[str] = None
+    created_at: Optional[float] = None
+    accessed_at: Optional[float] = None
+    hits: int = 0
+
+
+@runtime_checkable
+class MaintainableCache(Protocol):
+    """
+    A ResponseCache that can be inspected and pruned.
+    
+    All built-in caches implement it; cache_report() and prune_cache() work
+    on any object that does. `set` also accepts the request's model so
+    entries can be pruned per model.
+    """
+    
+    def set(self, key: str, value: str, *, model: Optional[str] = None) -> None: ...
+    
+    def entries(self) -> Iterator[CacheEntry]: ...
+    
+    def delete(self, keys: Iterable[str]) -> int: ...
+    
+    def compact(self) -> None: ...
+
+
+def cache_store(cache: ResponseCache, key: str, value: str, *, model: str) -> None:
+    """Store a response, recording its model when the cache keeps metadata."""
+    if isinstance(cache, MaintainableCache):
+        cache.set(key, value, model=model)
+    else:
+        cache.set(key, value)
+
+
+# Values shorter than this are stored as plain text; zlib can't shrink them.
+COMPRESS_MIN_BYTES = 256
+
+
+def compress_text(text: str) -> Union[str, bytes]:
+    """zlib-compressed UTF-8 bytes, or the text itself if that isn't smaller."""
+    raw = text.encode("utf-8")
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return text
+    packed = zlib.compress(raw, 6)
+    return packed if len(packed) < len(raw) else text
+
+
+def decompress_text(value: Union[str, bytes]) -> str:
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def _stored_size(value: Union[str, bytes]) -> int:
+    return len(value) if isinstance(value, bytes) else len(value.encode("utf-8"))
+
+
 class SimpleMemoryCache:
     """In-memory cache for LLM responses."""
     
     def __init__(self) -> None:
         self._store: Dict[str, str] = {}
+        # key -> (model, created_at)
+        self._meta: Dict[str, Tuple[Optional[str], float]] = {}
     
     def get(self, key: str) -> Optional[str]:
         return self._store.get(key)
     
-    def set(self, key: str, value: str) -> None:
+    def set(self, key: str, value: str, *, model: Optional[str] = None) -> None:
         self._store[key] = value
+        self._meta[key] = (model, time.time())
     
     def has(self, key: str) -> bool:
         return key in self._store
+    
+    def entries(self) -> Iterator[CacheEntry]:
+        for key, value in list(self._store.items()):
+            model, created_at = self._meta.get(key, (None, None))
+            yield CacheEntry(key, len(value.encode("utf-8")), model, created_at)
+    
+    def delete(self, keys: Iterable[str]) -> int:
+        removed = 0
+        for key in keys:
+            if self._store.pop(key, None) is not None:
+                self._meta.pop(key, None)
+                removed += 1
+        return removed
+    
+    def compact(self) -> None:
+        pass
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache with LRU eviction and optional TTL.
+    
+    Limits both the number of entries and the total UTF-8 size of cached
+    text, so long-running workers don't grow without bound. All operations
+    are O(1).
+    """
+    
+    def __init__(
+        self,
+        *,
+        max_entries: int = 10_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_s: Optional[float] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        # key -> (value, size_bytes, expires_at, model, created_at)
+        self._store: "OrderedDict[str, Tuple[str, int, Optional[float], Optional[str], float]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _pop(self, key: str) -> None:
+        size = self._store.pop(key)[1]
+        self._bytes -= size
+    
+    def _live_entry(
+        self, key: str
+    ) -> Optional[Tuple[str, int, Optional[float], Optional[str], float]]:
+        """Return the entry for key, dropping it first if it has expired."""
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        expires_at = entry[2]
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._pop(key)
+            self.expirations += 1
+            return None
+        return entry
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(
+        self,
+        key: str,
+        value: str,
+        *,
+        ttl_s: Optional[float] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return  # Would evict everything else and still not fit.
+        ttl_s = ttl_s if ttl_s is not None else self.ttl_s
+        expires_at = time.monotonic() + ttl_s if ttl_s is not None else None
+        with self._lock:
+            if key in self._store:
+                self._pop(key)
+            self._store[key] = (value, size, expires_at, model, time.time())
+            self._bytes += size
+            while len(self._store) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._store))
+                self._pop(oldest)
+                self.evictions += 1
+    
+    def has(self, key: str) -> bool:
+        with self._lock:
+            return self._live_entry(key) is not None
+    
+    def __len__(self) -> int:
+        return len(self._store)
+    
+    def entries(self) -> Iterator[CacheEntry]:
+        """Entries from least to most recently used."""
+        with self._lock:
+            items = list(self._store.items())
+        for key, (_, size, _, model, created_at) in items:
+            yield CacheEntry(key, size, model, created_at)
+    
+    def delete(self, keys: Iterable[str]) -> int:
+        removed = 0
+        with self._lock:
+            for key in keys:
+                if key in self._store:
+                    self._pop(key)
+                    removed += 1
+        return removed
+    
+    def compact(self) -> None:
+        """Drop expired entries."""
+        with self._lock:
+            for key in list(self._store):
+                self._live_entry(key)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._store),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
 
 
 class SimpleFileCache:
-    """File-backed cache that persists across runs."""
+    """
+    File-backed cache that persists across runs.
+    
+    The file is compact JSON; long values are zlib-compressed (base64) and
+    each entry records its model, creation/access time and hit count.
+    Files written by older versions (key -> plain text) are still read. The
+    parsed file is kept in memory and only re-read when it changes on disk.
+    With `max_bytes`, the least recently used entries are evicted on write.
+    """
     
-    def __init__(self, path: Path) -> None:
-        self.path = path
+    def __init__(self, path: Path, *, max_bytes: Optional[int] = None) -> None:
+        self.path = Path(path)
+        self.max_bytes = max_bytes
         self.path.parent.mkdir(parents=True, exist_ok=True)
         if not self.path.exists():
             self.path.write_text("{}", encoding="utf-8")
+        self._data: Dict[str, Any] = {}
+        self._signature: Optional[Tuple[int, int]] = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
-    def _read(self) -> Dict[str, str]:
+    def _read(self) -> Dict[str, Any]:
         try:
-            return json.loads(self.path.read_text(encoding="utf-8"))
-        except json.JSONDecodeError:
+            st = self.path.stat()
+        except FileNotFoundError:
             return {}
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature != self._signature:
+            try:
+                self._data = json.loads(self.path.read_text(encoding="utf-8"))
+            except json.JSONDecodeError:
+                self._data = {}
+            self._signature = signature
+        return self._data
     
-    def _write(self, data: Dict[str, str]) -> None:
-        self.path.write_text(
-            json.dumps(data, ensure_ascii=False, sort_keys=True, indent=2),
+    def _write(self, data: Dict[str, Any]) -> None:
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        tmp.write_text(
+            json.dumps(data, ensure_ascii=False, separators=(",", ":")),
             encoding="utf-8"
         )
+        os.replace(tmp, self.path)
+        st = self.path.stat()
+        self._data = data
+        self._signature = (st.st_mtime_ns, st.st_size)
+    
+    @staticmethod
+    def _entry(key: str, raw: Any) -> CacheEntry:
+        if isinstance(raw, str):  # written before metadata existed
+            return CacheEntry(key, len(raw.encode("utf-8")))
+        size = len(raw["z"]) * 3 // 4 if "z" in raw else len(raw["t"].encode("utf-8"))
+        return CacheEntry(key, size, raw.get("m"), raw.get("c"), raw.get("a"), raw.get("h", 0))
+    
+    @staticmethod
+    def _decode(raw: Any) -> str:
+        if isinstance(raw, str):
+            return raw
+        if "z" in raw:
+            return decompress_text(base64.b64decode(raw["z"]))
+        return raw["t"]
+    
+    @staticmethod
+    def _encode(value: str, **meta: Any) -> Dict[str, Any]:
+        stored = compress_text(value)
+        if isinstance(stored, bytes):
+            return {"z": base64.b64encode(stored).decode("ascii"), **meta}
+        return {"t": stored, **meta}
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            raw = self._read().get(key)
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if isinstance(raw, dict):
+                # Access stats are persisted with the next write.
+                raw["a"] = time.time()
+                raw["h"] = raw.get("h", 0) + 1
+            return self._decode(raw)
+    
+    def set(self, key: str, value: str, *, model: Optional[str] = None) -> None:
+        with self._lock:
+            data = dict(self._read())
+            now = time.time()
+            data[key] = self._encode(value, m=model, c=now, a=now, h=0)
+            if self.max_bytes is not None:
+                self.evictions += self._evict(data, self.max_bytes)
+            self._write(data)
+    
+    def has(self, key: str) -> bool:
+        with self._lock:
+            return key in self._read()
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._read())
+    
+    def _evict(self, data: Dict[str, Any], max_bytes: int) -> int:
+        entries = [self._entry(k, v) for k, v in data.items()]
+        total = sum(e.size_bytes for e in entries)
+        evicted = 0
+        for entry in sorted(entries, key=lambda e: e.accessed_at or e.created_at or 0.0):
+            if total <= max_bytes:
+                break
+            del data[entry.key]
+            total -= entry.size_bytes
+            evicted += 1
+        return evicted
+    
+    def entries(self) -> Iterator[CacheEntry]:
+        with self._lock:
+            items = list(self._read().items())
+        for key, raw in items:
+            yield self._entry(key, raw)
+    
+    def delete(self, keys: Iterable[str]) -> int:
+        with self._lock:
+            data = dict(self._read())
+            removed = sum(1 for key in keys if data.pop(key, None) is not None)
+            if removed:
+                self._write(data)
+            return removed
+    
+    def compact(self) -> None:
+        """Rewrite the file, compressing entries stored by older versions."""
+        with self._lock:
+            data = {}
+            for key, raw in self._read().items():
+                if isinstance(raw, str):
+                    raw = self._encode(raw, m=None, c=None, a=None, h=0)
+                elif "t" in raw:
+                    raw = self._encode(raw["t"], **{k: v for k, v in raw.items() if k != "t"})
+                data[key] = raw
+            self._write(data)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "file_bytes": self.path.stat().st_size if self.path.exists() else 0,
+        }
+
+
+class SQLiteCache:
+    """
+    SQLite-backed cache that persists across runs.
+    
+    Each lookup is a primary-key read instead of a full-file parse. The
+    database runs in WAL mode, so readers don't block while another thread
+    or process writes, and several workers can share one cache file.
+    
+    Long values are stored zlib-compressed. Each row records its model,
+    access time and hit count; with `max_bytes` the least recently used
+    rows are evicted once the stored values exceed the budget.
+    
+    Lookups stay read-only: access times and hit counts are buffered in
+    memory and written in one batch every `touch_interval_s` (or
+    `touch_batch` lookups), before eviction and reports, on close() and
+    at interpreter exit.
+    """
+    
+    # Columns added after the first release; old databases are migrated on open.
+    _ADDED_COLUMNS = {
+        "model": "TEXT",
+        "size_bytes": "INTEGER",
+        "accessed_at": "REAL",
+        "hits": "INTEGER NOT NULL DEFAULT 0",
+    }
+    
+    def __init__(
+        self,
+        path: Path,
+        *,
+        timeout_s: float = 30.0,
+        max_bytes: Optional[int] = None,
+        touch_interval_s: float = 5.0,
+        touch_batch: int = 256,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.touch_interval_s = touch_interval_s
+        self.touch_batch = touch_batch
+        self._timeout_s = timeout_s
+        # key -> (last access time, hits) not yet written to the database
+        self._touches: Dict[str, Tuple[float, int]] = {}
+        self._touch_lock = threading.Lock()
+        self._touched_at = time.monotonic()
+        _FLUSH_AT_EXIT.add(self)
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        # Approximate total of size_bytes; recounted before any eviction
+        self._bytes: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(responses)")}
+            missing = [name for name in self._ADDED_COLUMNS if name not in columns]
+            for name in missing:
+                conn.execute(f"ALTER TABLE responses ADD COLUMN {name} {self._ADDED_COLUMNS[name]}")
+            if missing:
+                conn.execute(
+                    "UPDATE responses SET size_bytes = length(CAST(value AS BLOB)), "
+                    "accessed_at = created_at WHERE size_bytes IS NULL"
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+            )
+    
+    def _conn(self) -> sqlite3.Connection:
+        """One connection per thread; sqlite3 connections aren't thread-safe."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                str(self.path), timeout=self._timeout_s, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
     
     def get(self, key: str) -> Optional[str]:
-        return self._read().get(key)
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._touch_lock:
+            _, hits = self._touches.get(key, (0.0, 0))
+            self._touches[key] = (time.time(), hits + 1)
+            due = (
+                len(self._touches) >= self.touch_batch
+                or time.monotonic() - self._touched_at >= self.touch_interval_s
+            )
+        if due:
+            self.flush()
+        return decompress_text(row[0])
+    
+    def flush(self) -> None:
+        """Write buffered access times and hit counts in one transaction."""
+        with self._touch_lock:
+            touches, self._touches = self._touches, {}
+            self._touched_at = time.monotonic()
+        if not touches:
+            return
+        with self._conn() as conn:
+            conn.executemany(
+                "UPDATE responses SET accessed_at = MAX(COALESCE(accessed_at, 0), ?), "
+                "hits = hits + ? WHERE key = ?",
+                [(at, hits, key) for key, (at, hits) in touches.items()],
+            )
     
-    def set(self, key: str, value: str) -> None:
-        data = self._read()
-        data[key] = value
-        self._write(data)
+    def set(self, key: str, value: str, *, model: Optional[str] = None) -> None:
+        stored = compress_text(value)
+        size = _stored_size(stored)
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, value, created_at, model, size_bytes, accessed_at, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, stored, now, model, size, now),
+            )
+        if self.max_bytes is not None:
+            if self._bytes is not None:
+                self._bytes += size
+            if self._bytes is None or self._bytes > self.max_bytes:
+                self.evictions += self.evict_to(self.max_bytes)
     
     def has(self, key: str) -> bool:
-        return key in self._read()
+        row = self._conn().execute(
+            "SELECT 1 FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None
+    
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    
+    def total_bytes(self) -> int:
+        """Size of all stored (compressed) values."""
+        row = self._conn().execute("SELECT COALESCE(SUM(size_bytes), 0) FROM responses").fetchone()
+        return row[0]
+    
+    def evict_to(self, max_bytes: int) -> int:
+        """Delete least recently used rows until values fit in max_bytes."""
+        self.flush()
+        conn = self._conn()
+        total = self.total_bytes()
+        victims: List[Tuple[str]] = []
+        if total > max_bytes:
+            for key, size in conn.execute(
+                "SELECT key, size_bytes FROM responses ORDER BY accessed_at"
+            ):
+                if total <= max_bytes:
+                    break
+                victims.append((key,))
+                total -= size
+            with conn:
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self._bytes = total
+        return len(victims)
+    
+    def entries(self) -> Iterator[CacheEntry]:
+        self.flush()
+        rows = self._conn().execute(
+            "SELECT key, size_bytes, model, created_at, accessed_at, hits FROM responses"
+        ).fetchall()
+        for row in rows:
+            yield CacheEntry(*row)
+    
+    def delete(self, keys: Iterable[str]) -> int:
+        with self._conn() as conn:
+            before = conn.total_changes
+            conn.executemany("DELETE FROM responses WHERE key = ?", ((k,) for k in keys))
+            removed = conn.total_changes - before
+        self._bytes = None
+        return removed
+    
+    def compact(self) -> None:
+        """Compress rows stored as plain text, then VACUUM to return free pages."""
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT key, value FROM responses WHERE typeof(value) = 'text' "
+            "AND length(CAST(value AS BLOB)) >= ?",
+            (COMPRESS_MIN_BYTES,),
+        ).fetchall()
+        updates = []
+        for key, value in rows:
+            stored = compress_text(value)
+            if isinstance(stored, bytes):
+                updates.append((stored, len(stored), key))
+        with conn:
+            conn.executemany(
+                "UPDATE responses SET value = ?, size_bytes = ? WHERE key = ?", updates
+            )
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._bytes = None
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        file_bytes = sum(
+            p.stat().st_size
+            for p in (self.path, Path(f"{self.path}-wal"))
+            if p.exists()
+        )
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "file_bytes": file_bytes,
+        }
+    
+    def import_json(self, json_path: Path) -> int:
+        """
+        Copy entries from a SimpleFileCache JSON file.
+        
+        Existing keys are kept. Returns the number of entries imported.
+        """
+        json_path = Path(json_path)
+        if not json_path.exists():
+            return 0
+        source = SimpleFileCache(json_path)
+        now = time.time()
+        rows = []
+        for key, raw in source._read().items():
+            entry = SimpleFileCache._entry(str(key), raw)
+            stored = compress_text(SimpleFileCache._decode(raw))
+            created_at = entry.created_at or now
+            rows.append((
+                entry.key, stored, created_at, entry.model, _stored_size(stored),
+                entry.accessed_at or created_at, entry.hits,
+            ))
+        with self._conn() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO responses "
+                "(key, value, created_at, model, size_bytes, accessed_at, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._bytes = None
+            return conn.total_changes - before
+    
+    @classmethod
+    def from_json(cls, json_path: Path, db_path: Path) -> "SQLiteCache":
+        """Create (or open) a SQLite cache and migrate a JSON cache file into it."""
+        cache = cls(db_path)
+        imported = cache.import_json(json_path)
+        logger.info("cache_migrated", extra={"source": str(json_path), "imported": imported})
+        return cache
+    
+    def close(self) -> None:
+        self.flush()
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+        self._local = threading.local()
+
+
+# Upper bounds (seconds) of the age buckets in cache_report()
+CACHE_AGE_BUCKETS: Tuple[Tuple[str, float], ...] = (
+    ("<1h", 3600.0),
+    ("<1d", 86400.0),
+    ("<7d", 7 * 86400.0),
+    ("<30d", 30 * 86400.0),
+    (">=30d", math.inf),
+)
+
+
+def _require_maintainable(cache: Any) -> MaintainableCache:
+    if not isinstance(cache, MaintainableCache):
+        raise TypeError(
+            f"{type(cache).__name__} does not support maintenance "
+            "(needs set(..., model=), entries(), delete() and compact())"
+        )
+    return cache
+
+
+def cache_report(cache: ResponseCache, *, now: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Size, hit and age summary of a cache.
+    
+    Entries with no recorded creation time (written before metadata was
+    kept) are counted under "unknown" age and model.
+    """
+    cache = _require_maintainable(cache)
+    now = time.time() if now is None else now
+    ages = {label: 0 for label, _ in CACHE_AGE_BUCKETS}
+    ages["unknown"] = 0
+    models: Dict[str, Dict[str, int]] = {}
+    entries = total_bytes = total_hits = never_hit = 0
+    for entry in cache.entries():
+        entries += 1
+        total_bytes += entry.size_bytes
+        total_hits += entry.hits
+        never_hit += entry.hits == 0
+        per_model = models.setdefault(entry.model or "unknown", {"entries": 0, "bytes": 0})
+        per_model["entries"] += 1
+        per_model["bytes"] += entry.size_bytes
+        if entry.created_at is None:
+            ages["unknown"] += 1
+            continue
+        age_s = now - entry.created_at
+        for label, bound in CACHE_AGE_BUCKETS:
+            if age_s < bound:
+                ages[label] += 1
+                break
+    report: Dict[str, Any] = {
+        "entries": entries,
+        "bytes": total_bytes,
+        "recorded_hits": total_hits,
+        "never_hit": never_hit,
+        "age_histogram": ages,
+        "models": models,
+    }
+    if hasattr(cache, "stats"):
+        report["stats"] = cache.stats()
+    return report
+
+
+def prune_cache(
+    cache: ResponseCache,
+    *,
+    model: Optional[str] = None,
+    older_than_s: Optional[float] = None,
+    max_bytes: Optional[int] = None,
+    now: Optional[float] = None,
+) -> int:
+    """
+    Delete entries and return how many were removed.
+    
+    `model` and `older_than_s` select entries to drop (both must match when
+    both are given). `max_bytes` then evicts the least recently used of the
+    rest until the cache fits the budget.
+    """
+    cache = _require_maintainable(cache)
+    now = time.time() if now is None else now
+    entries = list(cache.entries())
+    doomed: List[str] = []
+    if model is not None or older_than_s is not None:
+        for entry in entries:
+            if model is not None and entry.model != model:
+                continue
+            if older_than_s is not None and (
+                entry.created_at is None or now - entry.created_at < older_than_s
+            ):
+                continue
+            doomed.append(entry.key)
+    if max_bytes is not None:
+        dropped = set(doomed)
+        kept = [e for e in entries if e.key not in dropped]
+        total = sum(e.size_bytes for e in kept)
+        for entry in sorted(kept, key=lambda e: e.accessed_at or e.created_at or 0.0):
+            if total <= max_bytes:
+                break
+            doomed.append(entry.key)
+            total -= entry.size_bytes
+    removed = cache.delete(doomed) if doomed else 0
+    logger.info("cache_pruned", extra={"removed": removed})
+    return removed
+
+
+def build_generate_payload(
+    req: LLMRequest, *, keep_alive: Optional[Union[str, float]] = None
+) -> Dict[str, Any]:
+    """
+    Build the Ollama /api/generate JSON body for a request.
+    
+    `keep_alive` is how long the server keeps the model loaded afterwards
+    ("10m", seconds, -1 for always); None leaves the server default (5m).
+    """
+    payload: Dict[str, Any] = {
+        "model": req.model,
+        "prompt": req.prompt,
+        "system": req.system_prompt,
+        "stream": False,
+        "options": {
+            "temperature": req.temperature,
+            "num_predict": req.max_tokens,
+        },
+    }
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    return payload
 
 
-def make_cache_key(req: LLMRequest) -> str:
-    """Generate a stable cache key from request parameters."""
-    raw = json.dumps(asdict(req), sort_keys=True, ensure_ascii=False)
+def make_cache_key(req: LLMRequest, *, provider: Optional[Any] = None) -> str:
+    """
+    Generate a stable cache key from request parameters.
+    
+    A non-default `provider` and its `extra` body parameters (seed, top_p,
+    response_format, ...) are part of the key, since they change the answer.
+    """
+    params: Dict[str, Any] = asdict(req)
+    # n=1 and the default Ollama provider are left out so keys written
+    # before they existed stay valid
+    if params["n"] == 1:
+        del params["n"]
+    name = getattr(provider, "name", "ollama")
+    if name != "ollama":
+        params["provider"] = name
+    extra = getattr(provider, "extra", None)
+    if extra:
+        params["provider_extra"] = extra
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
     return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 
@@ -187,148 +1126,2699 @@ def add_jitter(delay_s: float) -> float:
 
 
 def parse_retry_after(value: str) -> Optional[float]:
-    """Parse Retry-After HTTP header into seconds."""
+    """Parse Retry-After HTTP header (delta-seconds or HTTP-date) into seconds."""
     v = value.strip()
     if not v:
         return None
     try:
-        seconds = int(v)
-        return max(0.0, float(seconds))
+        return max(0.0, float(v))
     except ValueError:
+        pass
+    import email.utils
+    try:
+        when = email.utils.parsedate_to_datetime(v)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
         return None
+    return max(0.0, when.timestamp() - time.time())
 
 
-# ============================================================================
-# Rate Limiter (Token Bucket)
-# ============================================================================
+def error_for_status(status_code: int, headers: Mapping[str, str]) -> Exception:
+    """Map an HTTP error status to a TransientError or PermanentError."""
+    retry_after = headers.get("Retry-After")
+    wait_s = parse_retry_after(retry_after) if retry_after else None
+    if status_code == 429:
+        if wait_s is not None:
+            return TransientError(
+                f"Rate limited, retry after {wait_s}s", reason="rate_limit", retry_after_s=wait_s
+            )
+        return TransientError("Rate limited (429)", reason="rate_limit")
+    if 500 <= status_code < 600:
+        return TransientError(
+            f"Server error: {status_code}", reason="server_error", retry_after_s=wait_s
+        )
+    return PermanentError(f"HTTP error: {status_code}", reason="client_error")
 
 
-@dataclass
-class TokenBucket:
-    """Token bucket rate limiter for client-side rate limiting."""
-    capacity: float
-    refill_per_s: float
-    tokens: float
-    last_refill_s: float
-    
-    @classmethod
-    def create(cls, *, capacity: float, refill_per_s: float) -> "TokenBucket":
-        now = time.time()
-        return cls(
-            capacity=capacity,
-            refill_per_s=refill_per_s,
-            tokens=capacity,
-            last_refill_s=now
-        )
-    
-    def _refill(self) -> None:
-        now = time.time()
-        dt = max(0.0, now - self.last_refill_s)
-        self.tokens = min(self.capacity, self.tokens + dt * self.refill_per_s)
-        self.last_refill_s = now
+def next_retry_delay(attempt: int, exc: BaseException, *, max_server_wait_s: float = 60.0) -> float:
+    """
+    Seconds to sleep before retry number `attempt`.
     
-    def allow(self, cost: float = 1.0) -> bool:
-        """Check if request is allowed and deduct tokens if so."""
-        self._refill()
-        if self.tokens >= cost:
-            self.tokens -= cost
-            return True
-        return False
+    Uses the server's Retry-After hint when the error carries one (capped
+    at max_server_wait_s), otherwise exponential backoff with full jitter.
+    """
+    hint = getattr(exc, "retry_after_s", None)
+    if hint is not None:
+        return min(float(hint), max_server_wait_s)
+    return add_jitter(backoff_delay(attempt))
 
 
-# ============================================================================
-# LLM Client
-# ============================================================================
+# Smallest timeout Deadline.clamp() hands out; an attempt this short simply times out
+MIN_ATTEMPT_TIMEOUT_S = 0.001
 
 
-class LLMClient:
-    """
-    Production-ready LLM client with reliability features.
+class _CancelScope:
+    """Cancellation flag shared by a Deadline and its children."""
     
-    Features:
-    - Configurable timeouts (connect and read)
-    - Automatic retries with exponential backoff and jitter
-    - Rate limit handling (respects Retry-After header)
-    - Response caching (memory or file-backed)
-    - Structured logging with request IDs
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.reason: Optional[str] = None
+
+
+class Deadline:
+    """
+    Total time budget shared by every attempt and sleep of one call.
     
-    Example:
-        client = LLMClient(host="http://localhost:11434")
-        response = client.call(LLMRequest(
-            model="llama3.1",
-            prompt="Hello!",
-            temperature=0.0
-        ))
-        if response.ok:
-            print(response.text)
+    The same object can bound a whole pipeline: create one from the total
+    budget, pass it through each stage (child() carves out a sub-budget,
+    optionally reserving time for later stages), call check() between
+    steps, and cancel() to stop everything waiting on it early. A deadline
+    and its children share one cancellation flag.
     """
     
-    def __init__(
-        self,
-        host: str = "http://localhost:11434",
-        *,
+    def __init__(self, budget_s: float) -> None:
+        self.budget_s = budget_s
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget_s
+        self._scope = _CancelScope()
+    
+    def remaining(self) -> float:
+        if self._scope.event.is_set():
+            return 0.0
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+    
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+    
+    def clamp(self, timeout_s: float) -> float:
+        """
+        Shorten a per-attempt timeout so it ends by the deadline.
+        
+        Raises DeadlineExceeded once nothing is left, rather than returning
+        a zero timeout that requests/urllib3 would reject as invalid.
+        """
+        remaining = self.remaining()
+        if remaining <= 0.0:
+            raise DeadlineExceeded(self, stage="attempt")
+        return max(MIN_ATTEMPT_TIMEOUT_S, min(timeout_s, remaining))
+    
+    def child(self, budget_s: Optional[float] = None, *, reserve_s: float = 0.0) -> "Deadline":
+        """
+        A deadline that ends no later than this one, minus `reserve_s`.
+        
+        Example: stage = total.child(reserve_s=2.0) leaves two seconds of
+        the total budget for whatever runs after the stage.
+        """
+        available = max(0.0, self.remaining() - reserve_s)
+        child = Deadline(available if budget_s is None else min(budget_s, available))
+        child._scope = self._scope
+        return child
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._scope.event.is_set()
+    
+    @property
+    def cancel_reason(self) -> Optional[str]:
+        return self._scope.reason
+    
+    def cancel(self, reason: str = "cancelled") -> None:
+        """Expire now; sleeping retries wake up and stop."""
+        if not self._scope.event.is_set():
+            self._scope.reason = reason
+            self._scope.event.set()
+    
+    def sleep(self, delay_s: float) -> bool:
+        """Sleep up to delay_s, waking early if cancelled. False if time ran out."""
+        self._scope.event.wait(min(delay_s, self.remaining()))
+        return not self.expired()
+    
+    async def sleep_async(self, delay_s: float, *, poll_s: float = 0.05) -> bool:
+        """sleep() for coroutines; notices cancel() within `poll_s`."""
+        import asyncio
+        
+        wake_at = time.monotonic() + min(delay_s, self.remaining())
+        while not self._scope.event.is_set():
+            left_s = wake_at - time.monotonic()
+            if left_s <= 0:
+                break
+            await asyncio.sleep(min(poll_s, left_s))
+        return not self.expired()
+    
+    def check(self, stage: str = "") -> None:
+        """Raise DeadlineExceeded if the budget is spent or was cancelled."""
+        if self.expired():
+            raise DeadlineExceeded(self, stage=stage)
+
+
+class DeadlineExceeded(PermanentError):
+    """A Deadline ran out (or was cancelled) at `stage`."""
+    
+    def __init__(self, deadline: Deadline, *, stage: str = "") -> None:
+        if deadline.cancelled:
+            what = f"Cancelled ({deadline.cancel_reason})"
+        else:
+            what = f"Deadline of {deadline.budget_s}s exceeded"
+        super().__init__(f"{what} at {stage}" if stage else what, reason="deadline")
+        self.stage = stage
+        self.elapsed_s = deadline.elapsed()
+
+
+def log_deadline_exhausted(
+    request_id: str, req: LLMRequest, deadline: Deadline, delay_s: float, attempt: int
+) -> None:
+    logger.warning(
+        "llm_deadline_exhausted",
+        extra={
+            "request_id": request_id,
+            "model": req.model,
+            "attempt": attempt,
+            "delay_s": delay_s,
+            "remaining_s": deadline.remaining(),
+            "budget_s": deadline.budget_s,
+        }
+    )
+
+
+def failed_response(
+    req: LLMRequest,
+    request_id: str,
+    last_err: Optional[BaseException],
+    exhausted: Optional[Deadline] = None,
+    text: str = "",
+) -> LLMResponse:
+    """Build the ok=False response returned once retries stop."""
+    if exhausted is not None:
+        return LLMResponse(
+            ok=False,
+            text=text,
+            model=req.model,
+            latency_s=0.0,
+            request_id=request_id,
+            error=(
+                (f"Cancelled ({exhausted.cancel_reason})" if exhausted.cancelled
+                 else f"Deadline of {exhausted.budget_s}s exhausted")
+                + (f": {last_err}" if last_err is not None else "")
+            ),
+            error_type="DeadlineExceeded",
+        )
+    return LLMResponse(
+        ok=False,
+        text=text,
+        model=req.model,
+        latency_s=0.0,
+        request_id=request_id,
+        error=str(last_err),
+        error_type=type(last_err).__name__ if last_err else "unknown",
+    )
+
+
+# ============================================================================
+# Rate Limiter (Token Bucket)
+# ============================================================================
+
+
+@dataclass
+class TokenBucket:
+    """
+    Token bucket rate limiter for client-side rate limiting.
+    
+    Safe to share across threads and asyncio tasks. Uses a monotonic clock,
+    so wall-clock adjustments can't grant or withhold tokens.
+    """
+    capacity: float
+    refill_per_s: float
+    tokens: float
+    last_refill_s: float
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+    
+    def __post_init__(self) -> None:
+        if self.refill_per_s < 0:
+            raise ValueError(f"refill_per_s must be >= 0, got {self.refill_per_s}")
+    
+    @classmethod
+    def create(cls, *, capacity: float, refill_per_s: float) -> "TokenBucket":
+        now = time.monotonic()
+        return cls(
+            capacity=capacity,
+            refill_per_s=refill_per_s,
+            tokens=capacity,
+            last_refill_s=now
+        )
+    
+    def _refill(self) -> None:
+        now = time.monotonic()
+        dt = max(0.0, now - self.last_refill_s)
+        self.tokens = min(self.capacity, self.tokens + dt * self.refill_per_s)
+        self.last_refill_s = now
+    
+    def _take(self, cost: float) -> float:
+        """
+        Deduct cost if available and return 0.0, else return seconds to wait.
+        
+        A cost above capacity is admitted once the bucket is full and leaves
+        it in debt, so large requests are slowed rather than refused forever.
+        """
+        with self._lock:
+            self._refill()
+            need = min(cost, self.capacity)
+            if self.tokens >= need:
+                self.tokens -= cost
+                return 0.0
+            if self.refill_per_s <= 0:
+                return math.inf
+            return (need - self.tokens) / self.refill_per_s
+    
+    def allow(self, cost: float = 1.0) -> bool:
+        """Check if request is allowed and deduct tokens if so."""
+        return self._take(cost) == 0.0
+    
+    def acquire(self, cost: float = 1.0, *, timeout_s: Optional[float] = None) -> bool:
+        """
+        Block until cost tokens are available; False if that exceeds
+        timeout_s, or never happens (refill_per_s=0 and the bucket is empty).
+        """
+        deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        while True:
+            wait_s = self._take(cost)
+            if wait_s == 0.0:
+                return True
+            # A bucket that never refills can't admit this by waiting
+            if wait_s == math.inf or (deadline is not None and time.monotonic() + wait_s > deadline):
+                return False
+            time.sleep(wait_s)
+    
+    async def acquire_async(self, cost: float = 1.0, *, timeout_s: Optional[float] = None) -> bool:
+        """Awaitable acquire() that sleeps without blocking the event loop."""
+        deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        while True:
+            wait_s = self._take(cost)
+            if wait_s == 0.0:
+                return True
+            # A bucket that never refills can't admit this by waiting
+            if wait_s == math.inf or (deadline is not None and time.monotonic() + wait_s > deadline):
+                return False
+            await _asyncio().sleep(wait_s)
+
+
+def _asyncio() -> Any:
+    import asyncio
+    return asyncio
+
+
+def estimate_text_tokens(*texts: str) -> int:
+    """Rough token count of some text (~4 chars per token)."""
+    return math.ceil(sum(len(text) for text in texts) / 4)
+
+
+def estimate_request_tokens(req: LLMRequest) -> float:
+    """
+    Rough token cost of a request: prompt + system (~4 chars per token)
+    plus max_tokens for the completion. Use as `rate_limit_cost=`.
+    """
+    return float(estimate_text_tokens(req.prompt, req.system_prompt) + req.max_tokens)
+
+
+# ============================================================================
+# Adaptive Concurrency (AIMD)
+# ============================================================================
+
+
+# RetryDecision reasons that mean the endpoint is overloaded
+OVERLOAD_REASONS = frozenset({"rate_limit", "timeout", "server_error"})
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Concurrency limit that adapts to the endpoint's capacity (AIMD).
+    
+    Every healthy completion raises the limit by `increase / limit` (about
+    +increase per round of requests); an overload signal (rate_limit,
+    timeout, server_error, or latency above target_latency_s) multiplies
+    it by `decrease_factor`. Only requests started after the last cut can
+    trigger another, so one burst of failures counts as a single signal.
+    """
+    
+    def __init__(
+        self,
+        *,
+        initial_limit: float = 4.0,
+        min_limit: float = 1.0,
+        max_limit: float = 64.0,
+        increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        target_latency_s: Optional[float] = None,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.target_latency_s = target_latency_s
+        self._limit = max(min_limit, min(max_limit, initial_limit))
+        self._in_flight = 0
+        self._last_decrease_at = 0.0
+        self._cond = threading.Condition()
+        self.increases = 0
+        self.decreases = 0
+    
+    @property
+    def limit(self) -> int:
+        """Current number of requests allowed in flight."""
+        return max(1, int(self._limit))
+    
+    def acquire(self, *, timeout_s: Optional[float] = None) -> Optional[float]:
+        """Wait for a slot; returns the start timestamp, or None on timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._in_flight < self.limit, timeout=timeout_s):
+                return None
+            self._in_flight += 1
+            return time.monotonic()
+    
+    def release(self, started_at: float, *, reason: Optional[str] = None) -> None:
+        """
+        Free a slot and feed back the outcome.
+        
+        Args:
+            started_at: Value returned by acquire()
+            reason: RetryDecision.reason of the failure, or None on success
+        """
+        now = time.monotonic()
+        latency_s = now - started_at
+        overloaded = reason in OVERLOAD_REASONS or (
+            reason is None
+            and self.target_latency_s is not None
+            and latency_s > self.target_latency_s
+        )
+        with self._cond:
+            self._in_flight -= 1
+            before = self.limit
+            if overloaded:
+                if started_at >= self._last_decrease_at:
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease_at = now
+                    self.decreases += 1
+            elif reason is None:
+                self._limit = min(self.max_limit, self._limit + self.increase / self._limit)
+                self.increases += 1
+            after = self.limit
+            self._cond.notify_all()
+        if after != before:
+            logger.info(
+                "llm_concurrency_changed",
+                extra={"limit": after, "previous_limit": before, "reason": reason or "latency"}
+            )
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "increases": self.increases,
+                "decreases": self.decreases,
+            }
+
+
+# ============================================================================
+# Circuit Breaker
+# ============================================================================
+
+
+class CircuitOpenError(PermanentError):
+    """Raised without calling the provider while a host's circuit is open."""
+    
+    def __init__(self, message: str = "") -> None:
+        super().__init__(message, reason="circuit_open")
+
+
+# Outcomes that say the host itself is unhealthy
+HOST_FAILURE_REASONS = frozenset({"connection", "timeout", "server_error"})
+# Outcomes decided on our side, which say nothing about the host
+NEUTRAL_REASONS = frozenset({"client_rate_limit", "concurrency", "cancelled"})
+
+
+@dataclass
+class _Circuit:
+    state: str = "closed"
+    failures: int = 0
+    opened_at: float = 0.0
+    trial_calls: int = 0
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open circuit per host.
+    
+    After `failure_threshold` consecutive host failures the circuit opens
+    and calls fail fast with CircuitOpenError. Once `recovery_timeout_s`
+    has passed it goes half-open and lets `half_open_max_calls` trial calls
+    through: a success closes it, a failure opens it again.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = 5,
+        recovery_timeout_s: float = 30.0,
+        half_open_max_calls: int = 1,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout_s = recovery_timeout_s
+        self.half_open_max_calls = half_open_max_calls
+        self._circuits: Dict[str, _Circuit] = {}
+        self._lock = threading.Lock()
+    
+    def _transition(self, key: str, circuit: _Circuit, state: str) -> None:
+        logger.warning(
+            "llm_circuit_state",
+            extra={
+                "host": key,
+                "from_state": circuit.state,
+                "to_state": state,
+                "failures": circuit.failures,
+            }
+        )
+        circuit.state = state
+        if state == self.OPEN:
+            circuit.opened_at = time.monotonic()
+            circuit.trial_calls = 0
+        elif state == self.CLOSED:
+            circuit.failures = 0
+    
+    def before_call(self, key: str) -> None:
+        """Raise CircuitOpenError if a call to key must not be attempted now."""
+        with self._lock:
+            circuit = self._circuits.setdefault(key, _Circuit())
+            if circuit.state == self.OPEN:
+                wait_s = self.recovery_timeout_s - (time.monotonic() - circuit.opened_at)
+                if wait_s > 0:
+                    raise CircuitOpenError(f"Circuit open for {key}, retry in {wait_s:.1f}s")
+                self._transition(key, circuit, self.HALF_OPEN)
+            if circuit.state == self.HALF_OPEN:
+                if circuit.trial_calls >= self.half_open_max_calls:
+                    raise CircuitOpenError(f"Circuit half-open for {key}, trial call in progress")
+                circuit.trial_calls += 1
+    
+    def allows(self, key: str) -> bool:
+        """True if before_call(key) would let a call through right now."""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit.state == self.CLOSED:
+                return True
+            if circuit.state == self.OPEN:
+                return time.monotonic() - circuit.opened_at >= self.recovery_timeout_s
+            return circuit.trial_calls < self.half_open_max_calls
+    
+    def record(self, key: str, reason: Optional[str]) -> None:
+        """Record an attempt outcome: None on success, else RetryDecision.reason."""
+        if reason == "circuit_open":
+            return
+        with self._lock:
+            circuit = self._circuits.setdefault(key, _Circuit())
+            if circuit.state == self.HALF_OPEN:
+                circuit.trial_calls = max(0, circuit.trial_calls - 1)
+            if reason in NEUTRAL_REASONS:
+                return
+            if reason in HOST_FAILURE_REASONS:
+                circuit.failures += 1
+                if circuit.state == self.HALF_OPEN or (
+                    circuit.state == self.CLOSED and circuit.failures >= self.failure_threshold
+                ):
+                    self._transition(key, circuit, self.OPEN)
+            else:
+                # The host answered (even with a 4xx/429), so it is reachable.
+                if circuit.state != self.CLOSED:
+                    self._transition(key, circuit, self.CLOSED)
+                circuit.failures = 0
+    
+    def state(self, key: str) -> str:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit.state if circuit else self.CLOSED
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                key: {"state": c.state, "failures": c.failures}
+                for key, c in self._circuits.items()
+            }
+
+
+# ============================================================================
+# Endpoint Pool (Load Balancing)
+# ============================================================================
+
+
+@dataclass
+class Endpoint:
+    """One model server and its live routing stats."""
+    host: str
+    outstanding: int = 0
+    ewma_latency_s: Optional[float] = None
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+
+
+class EndpointPool:
+    """
+    Routes each attempt to one of several hosts.
+    
+    strategy="least_outstanding" picks the host with the fewest requests in
+    flight; strategy="ewma" picks the lowest EWMA latency weighted by load.
+    Hosts whose circuit would refuse a call (when a CircuitBreaker is
+    given), or that keep failing, are only used when nothing healthier is
+    left.
+    """
+    
+    STRATEGIES = ("least_outstanding", "ewma")
+    
+    def __init__(
+        self,
+        hosts: Sequence[str],
+        *,
+        strategy: str = "least_outstanding",
+        ewma_alpha: float = 0.3,
+        unhealthy_after: int = 3,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        if not hosts:
+            raise ValueError("EndpointPool needs at least one host")
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"strategy must be one of {self.STRATEGIES}")
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.unhealthy_after = unhealthy_after
+        self._breaker = circuit_breaker
+        self._endpoints = {host: Endpoint(host) for host in hosts}
+        self._lock = threading.Lock()
+    
+    @property
+    def hosts(self) -> List[str]:
+        return list(self._endpoints)
+    
+    def _healthy(self, ep: Endpoint) -> bool:
+        if self._breaker is not None and not self._breaker.allows(ep.host):
+            return False
+        return ep.consecutive_failures < self.unhealthy_after
+    
+    def _score(self, ep: Endpoint) -> Tuple[float, float]:
+        if self.strategy == "ewma":
+            # Unmeasured hosts score 0 so they get probed early.
+            return ((ep.ewma_latency_s or 0.0) * (ep.outstanding + 1), ep.outstanding)
+        return (ep.outstanding, ep.ewma_latency_s or 0.0)
+    
+    def pick(self, exclude: Collection[str] = ()) -> str:
+        """Choose a host, avoiding `exclude` and unhealthy hosts when possible."""
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+            candidates = [ep for ep in endpoints if ep.host not in exclude and self._healthy(ep)]
+            if not candidates:
+                candidates = [ep for ep in endpoints if ep.host not in exclude] or endpoints
+            return min(candidates, key=self._score).host
+    
+    def has_alternative(self, exclude: Collection[str]) -> bool:
+        """True if a healthy host outside `exclude` is available."""
+        with self._lock:
+            return any(
+                ep.host not in exclude and self._healthy(ep)
+                for ep in self._endpoints.values()
+            )
+    
+    def begin(self, host: str) -> None:
+        with self._lock:
+            self._endpoints[host].outstanding += 1
+    
+    def end(self, host: str, *, latency_s: float, reason: Optional[str]) -> None:
+        """Record an attempt outcome: reason None on success."""
+        with self._lock:
+            ep = self._endpoints[host]
+            ep.outstanding -= 1
+            if reason is None:
+                ep.successes += 1
+                ep.consecutive_failures = 0
+                if ep.ewma_latency_s is None:
+                    ep.ewma_latency_s = latency_s
+                else:
+                    a = self.ewma_alpha
+                    ep.ewma_latency_s = a * latency_s + (1 - a) * ep.ewma_latency_s
+            elif reason in HOST_FAILURE_REASONS:
+                ep.failures += 1
+                ep.consecutive_failures += 1
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-host health, load and latency."""
+        with self._lock:
+            return {
+                ep.host: {**asdict(ep), "healthy": self._healthy(ep)}
+                for ep in self._endpoints.values()
+            }
+
+
+class HostRouter:
+    """
+    Picks the host for each attempt and whether a retry can move elsewhere.
+    
+    Without an EndpointPool every attempt goes to `host`. With one, hosts
+    that already failed this call, or that `breaker` would refuse, are
+    avoided while a healthy alternative exists.
+    """
+    
+    def __init__(
+        self,
+        host: str,
+        *,
+        endpoints: Optional[EndpointPool] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.host = host
+        self.endpoints = endpoints
+        self.breaker = breaker
+    
+    def _avoid(self, failed_hosts: Collection[str]) -> Collection[str]:
+        """Hosts to route around: those that failed plus those our breaker would refuse."""
+        if self.breaker is None or self.endpoints is None:
+            return failed_hosts
+        refused = {h for h in self.endpoints.hosts if not self.breaker.allows(h)}
+        return set(failed_hosts) | refused
+    
+    def pick(self, failed_hosts: Collection[str] = ()) -> str:
+        if self.endpoints is None:
+            return self.host
+        return self.endpoints.pick(exclude=self._avoid(failed_hosts))
+    
+    def can_fail_over(self, failed_hosts: Collection[str]) -> bool:
+        return self.endpoints is not None and self.endpoints.has_alternative(
+            self._avoid(failed_hosts)
+        )
+
+
+# ============================================================================
+# Retry Planning
+# ============================================================================
+
+
+@dataclass(frozen=True)
+class RetryStep:
+    """
+    What follows a failed attempt, as decided by plan_retry().
+    
+    action is "failover" (retry at once on another host), "backoff" (retry
+    after delay_s) or "stop"; out_of_time is set when the backoff would
+    have run past the deadline.
+    """
+    action: str
+    decision: RetryDecision
+    delay_s: float = 0.0
+    out_of_time: bool = False
+
+
+def plan_retry(
+    exc: BaseException,
+    *,
+    attempt: int,
+    max_retries: int,
+    deadline: Optional[Deadline] = None,
+    router: Optional[HostRouter] = None,
+    host: Optional[str] = None,
+    failed_hosts: Optional[set] = None,
+    partial: bool = False,
+) -> RetryStep:
+    """
+    Decide whether and how to retry after attempt `attempt` raised `exc`.
+    
+    The one retry policy behind LLMClient.call(), LLMClient.stream() and
+    AsyncLLMClient.call(). A host that failed (or refused through its
+    circuit) is added to `failed_hosts`; if `router` has another healthy
+    host the retry goes there without a backoff. `partial` says the caller
+    already handed out text, which a retry would repeat.
+    """
+    decision = classify_exception(exc)
+    if failed_hosts is not None and (
+        decision.reason in HOST_FAILURE_REASONS or decision.reason == "circuit_open"
+    ):
+        failed_hosts.add(host)
+    last = attempt >= max_retries
+    can_fail_over = (
+        not last and router is not None and router.can_fail_over(failed_hosts or ())
+    )
+    # A refused host says nothing about the request; try another
+    if decision.reason == "circuit_open" and can_fail_over:
+        return RetryStep("failover", decision)
+    if partial or not decision.should_retry or last:
+        return RetryStep("stop", decision)
+    # Another host can take the retry right away
+    if can_fail_over:
+        return RetryStep("failover", decision)
+    delay_s = next_retry_delay(attempt + 1, exc)
+    # Stop early rather than sleep past the deadline
+    if deadline is not None and delay_s >= deadline.remaining():
+        return RetryStep("stop", decision, delay_s, out_of_time=True)
+    return RetryStep("backoff", decision, delay_s)
+
+
+# ============================================================================
+# Hedged Requests
+# ============================================================================
+
+
+class HedgePolicy:
+    """
+    When to send a backup copy of a slow attempt.
+    
+    Once `min_samples` successful latencies have been seen, an attempt still
+    running after the `percentile` of recent latencies gets a second,
+    identical request (to another endpoint when the client has several).
+    The first success wins. Counters show how much extra load this adds.
+    """
+    
+    def __init__(
+        self,
+        *,
+        percentile: float = 95.0,
+        min_samples: int = 20,
+        window: int = 200,
+        min_delay_s: float = 0.05,
+    ) -> None:
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay_s = min_delay_s
+        self._latencies: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self.hedges_sent = 0
+        self.hedge_wins = 0
+    
+    def observe(self, latency_s: float) -> None:
+        with self._lock:
+            self._latencies.append(latency_s)
+    
+    def delay_s(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None while still warming up."""
+        with self._lock:
+            self.attempts += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            samples = list(self._latencies)
+        return max(self.min_delay_s, percentile(samples, self.percentile))
+    
+    def record_hedge(self, *, won: bool) -> None:
+        with self._lock:
+            self.hedges_sent += 1
+            if won:
+                self.hedge_wins += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "attempts": self.attempts,
+                "hedges_sent": self.hedges_sent,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges_sent / self.attempts if self.attempts else 0.0,
+                "samples": len(self._latencies),
+            }
+
+
+# ============================================================================
+# Connection Pool
+# ============================================================================
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP session with a bounded number of connections per host.
+    
+    Reusing one pool across calls avoids a TCP handshake per request and
+    keeps the number of sockets (and ephemeral ports) bounded under load.
+    """
+    
+    def __init__(
+        self,
+        *,
+        maxsize: int = 10,
+        max_hosts: int = 4,
+        block: bool = True,
+    ) -> None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        
+        self.maxsize = maxsize
+        self._adapter = HTTPAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=maxsize,
+            pool_block=block,
+        )
+        self._session = requests.Session()
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._total_requests = 0
+        self._closed = False
+    
+    def post(self, url: str, **kwargs: Any) -> "requests.Response":
+        """POST through the shared session, tracking in-flight requests."""
+        if self._closed:
+            raise RuntimeError("ConnectionPool is closed")
+        with self._lock:
+            self._in_flight += 1
+            self._total_requests += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        try:
+            return self._session.post(url, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return pool occupancy: in-flight requests and per-host connections."""
+        hosts: Dict[str, Dict[str, int]] = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                if pool.pool is not None else 0,
+            }
+        with self._lock:
+            return {
+                "maxsize": self.maxsize,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "total_requests": self._total_requests,
+                "hosts": hosts,
+            }
+    
+    def close(self) -> None:
+        """Close all pooled connections."""
+        self._closed = True
+        self._session.close()
+    
+    def __enter__(self) -> "ConnectionPool":
+        return self
+    
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+_shared_pool: Optional[ConnectionPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool() -> ConnectionPool:
+    """Process-wide pool used by one-off helpers such as call_ollama()."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None or _shared_pool._closed:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
+
+
+# ============================================================================
+# In-flight Coalescing
+# ============================================================================
+
+
+T = TypeVar("T")
+
+
+class _Flight(Generic[T]):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[T]):
+    """
+    Run at most one call per key at a time.
+    
+    The first caller for a key executes fn; callers arriving while it runs
+    block and receive the same result (or exception) instead of repeating
+    the work. A waiting caller gives up with TimeoutError after
+    `timeout_s`; the leader is unaffected.
+    """
+    
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight[T]] = {}
+    
+    def do(
+        self, key: str, fn: Callable[[], T], *, timeout_s: Optional[float] = None
+    ) -> Tuple[T, bool]:
+        """Return (result, shared); shared is True for callers that waited."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        
+        if not leader:
+            if not flight.done.wait(timeout_s):
+                raise TimeoutError(f"Gave up waiting on in-flight call after {timeout_s}s")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        
+        try:
+            flight.result = fn()
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+    
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+# ============================================================================
+# Batch Results
+# ============================================================================
+
+
+def schedule_by_model(reqs: Sequence[LLMRequest], *, max_run: Optional[int] = 32) -> List[int]:
+    """
+    Indices of `reqs` reordered to run each model's requests back to back.
+    
+    Every model switch can make the server unload one model and load
+    another. Models take turns in order of first appearance, each sending
+    up to `max_run` requests per turn, so no model waits behind more than
+    `max_run` requests of each other model. max_run=None groups fully.
+    """
+    if max_run is not None and max_run < 1:
+        raise ValueError(f"max_run must be >= 1 or None, got {max_run!r}")
+    queues: "OrderedDict[str, deque[int]]" = OrderedDict()
+    for i, req in enumerate(reqs):
+        queues.setdefault(req.model, deque()).append(i)
+    order: List[int] = []
+    while queues:
+        for model in list(queues):
+            queue = queues[model]
+            take = len(queue) if max_run is None else min(max_run, len(queue))
+            order.extend(queue.popleft() for _ in range(take))
+            if not queue:
+                del queues[model]
+    return order
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of values (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct * len(ordered) / 100.0) - 1))
+    return ordered[rank]
+
+
+@dataclass
+class BatchStats:
+    """Aggregate throughput and latency for one call_many() batch."""
+    total: int
+    unique: int
+    ok: int
+    failed: int
+    cached: int
+    wall_s: float
+    throughput_rps: float
+    latency_p50_s: float
+    latency_p95_s: float
+    latency_max_s: float
+    
+    @classmethod
+    def from_responses(
+        cls, responses: List[LLMResponse], *, unique: int, wall_s: float
+    ) -> "BatchStats":
+        latencies = [r.latency_s for r in responses if r.ok and not r.cached]
+        return cls(
+            total=len(responses),
+            unique=unique,
+            ok=sum(1 for r in responses if r.ok),
+            failed=sum(1 for r in responses if not r.ok),
+            cached=sum(1 for r in responses if r.cached),
+            wall_s=wall_s,
+            throughput_rps=len(responses) / wall_s if wall_s > 0 else 0.0,
+            latency_p50_s=percentile(latencies, 50),
+            latency_p95_s=percentile(latencies, 95),
+            latency_max_s=max(latencies, default=0.0),
+        )
+
+
+@dataclass
+class BatchResult:
+    """Responses in input order plus aggregate stats."""
+    responses: List[LLMResponse]
+    stats: BatchStats
+
+
+# ============================================================================
+# Record / Replay
+# ============================================================================
+
+
+class Cassette:
+    """
+    Recorded provider replies for deterministic offline runs.
+    
+    In "record" mode every successful provider reply is appended to `path`
+    as one compact JSON line (gzip-compressed when the name ends in .gz)
+    with its latency, time to first token and usage counters. In "replay"
+    mode the client never touches the network: replies are served from the
+    file by request key, either at once (latency="zero") or after the
+    recorded latency (latency="recorded"). Identical requests recorded more
+    than once replay in recorded order, wrapping around. The key defaults
+    to make_cache_key(req); clients pass their provider-aware cache key, so
+    an OpenAI-compatible and an Ollama recording of one request stay apart.
+    
+    Example:
+        with Cassette("runs/llm.jsonl.gz", mode="record") as cassette:
+            LLMClient(cassette=cassette).call(req)
+        
+        replay = Cassette("runs/llm.jsonl.gz", mode="replay", latency="recorded")
+    """
+    
+    MODES = ("record", "replay")
+    LATENCIES = ("zero", "recorded")
+    
+    def __init__(self, path: Path, *, mode: str = "replay", latency: str = "zero") -> None:
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}, got {mode!r}")
+        if latency not in self.LATENCIES:
+            raise ValueError(f"latency must be one of {self.LATENCIES}, got {latency!r}")
+        self.path = Path(path)
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        self._file: Optional[Any] = None
+        self.recorded = 0
+        self.played = 0
+        self.misses = 0
+        if mode == "replay":
+            self._load()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+    
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+    
+    def _open(self, mode: str) -> Any:
+        if self.path.suffix == ".gz":
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return self.path.open(mode, encoding="utf-8")
+    
+    def _load(self) -> None:
+        with self._open("r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+    
+    def record(
+        self,
+        req: LLMRequest,
+        reply: ProviderReply,
+        latency_s: float,
+        *,
+        ttft_s: Optional[float] = None,
+        key: Optional[str] = None,
+    ) -> None:
+        """Append one successful reply (no-op unless in record mode)."""
+        if self.mode != "record":
+            return
+        entry: Dict[str, Any] = {
+            "key": key or make_cache_key(req),
+            "model": req.model,
+            "text": reply.text,
+            "latency_s": round(latency_s, 6),
+        }
+        if ttft_s is not None:
+            entry["ttft_s"] = round(ttft_s, 6)
+        if reply.usage is not None:
+            entry["usage"] = {k: v for k, v in asdict(reply.usage).items() if v is not None}
+        if reply.choices:
+            entry["choices"] = list(reply.choices)
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                self._file = self._open("a")
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.recorded += 1
+    
+    def next_reply(
+        self, req: LLMRequest, *, key: Optional[str] = None
+    ) -> Tuple[ProviderReply, Dict[str, Any]]:
+        """
+        The next recorded reply for `req` (or `key`) and its raw entry.
+        
+        Raises PermanentError(reason="cassette_miss") if nothing was
+        recorded for this request.
+        """
+        key = key or make_cache_key(req)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise PermanentError(
+                    f"No cassette entry for {req.model} request {key[:12]}", reason="cassette_miss"
+                )
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            self.played += 1
+        entry = entries[index % len(entries)]
+        usage = GenerationStats(**entry["usage"]) if "usage" in entry else None
+        return ProviderReply(entry["text"], usage, tuple(entry.get("choices", ()))), entry
+    
+    def delay_s(self, entry: Mapping[str, Any]) -> float:
+        """How long replay should take for `entry` under the latency setting."""
+        return entry["latency_s"] if self.latency == "recorded" else 0.0
+    
+    def play(self, req: LLMRequest, *, key: Optional[str] = None) -> ProviderReply:
+        reply, entry = self.next_reply(req, key=key)
+        delay_s = self.delay_s(entry)
+        if delay_s:
+            time.sleep(delay_s)
+        return reply
+    
+    def play_stream(
+        self,
+        req: LLMRequest,
+        *,
+        key: Optional[str] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """Replay as a stream: one chunk at the recorded TTFT, then the rest."""
+        reply, entry = self.next_reply(req, key=key)
+        total_s = self.delay_s(entry)
+        ttft_s = min(total_s, entry.get("ttft_s", total_s))
+        if ttft_s:
+            time.sleep(ttft_s)
+        if reply.text:
+            yield reply.text
+        if total_s > ttft_s:
+            time.sleep(total_s - ttft_s)
+        if meta is not None:
+            meta["usage"] = reply.usage
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "entries": sum(len(v) for v in self._entries.values()),
+                "recorded": self.recorded,
+                "played": self.played,
+                "misses": self.misses,
+            }
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+    
+    def __enter__(self) -> "Cassette":
+        return self
+    
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+
+# ============================================================================
+# Metrics
+# ============================================================================
+
+
+# Seconds; covers a fast cached-model reply up to a slow long generation
+DEFAULT_LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+    
+    kind = "counter"
+    
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        """Add `amount`; label values are positional, in `labelnames` order."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+    
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}"
+            for labels, v in items
+        ]
+
+
+class Gauge:
+    """Value that can go up and down (a current level, not a running total)."""
+    
+    kind = "gauge"
+    
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+    
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}"
+            for labels, v in items
+        ]
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram (Prometheus semantics: cumulative `le` buckets).
+    
+    Buckets are chosen up front, so observe() is a bisect plus two adds and
+    quantiles are estimated from bucket counts at query time.
+    """
+    
+    kind = "histogram"
+    
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            series = self._series.get(labels)
+            return series[2] if series else 0
+    
+    def quantile(self, q: float, *labels: str) -> Optional[float]:
+        """Estimate the q-quantile (0..1) by interpolating within its bucket."""
+        with self._lock:
+            series = self._series.get(labels)
+            if not series or not series[2]:
+                return None
+            counts, total = list(series[0]), series[2]
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+    
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            rendered = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{rendered} {_format_value(total)}")
+            lines.append(f"{self.name}_count{rendered} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Named counters, gauges and histograms with Prometheus text-format export.
+    
+    counter()/gauge()/histogram() return the existing metric when the name is
+    already registered, so several clients can share one registry.
+    
+    Example:
+        registry = MetricsRegistry()
+        client = LLMClient(metrics=registry)
+        serve_metrics(registry, port=9464)      # or:
+        registry.write_textfile("metrics/llm.prom")
+    """
+    
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+    
+    def _get_or_create(self, cls: type, name: str, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name!r} already registered as a {metric.kind}")
+            return metric
+    
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+    
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+    
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+    
+    def get(self, name: str) -> Any:
+        with self._lock:
+            return self._metrics.get(name)
+    
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+    
+    def write_textfile(self, path: Path) -> Path:
+        """Write render() atomically (for node_exporter's textfile collector)."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(self.render(), encoding="utf-8")
+        os.replace(tmp, path)
+        return path
+
+
+def serve_metrics(
+    registry: MetricsRegistry, *, host: str = "127.0.0.1", port: int = 9464
+) -> "ThreadingHTTPServer":
+    """
+    Serve registry.render() at /metrics from a daemon thread.
+    
+    Returns the server; call .shutdown() to stop it. Port 0 picks a free
+    port (see server.server_address).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+    
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="llm-metrics", daemon=True).start()
+    return server
+
+
+class LLMMetrics:
+    """
+    The metric families LLMClient updates, registered on a MetricsRegistry.
+    
+    llm_attempts_total / llm_attempt_latency_seconds: one per provider
+    attempt, by model, host, outcome ("ok" or "error") and RetryDecision
+    reason. llm_calls_total / llm_call_latency_seconds: one per call(), by
+    model and outcome ("ok", "error", "cache_hit", "coalesced"). Also retries
+    by reason, prompt/completion tokens from the provider's usage, and the
+    adaptive concurrency limit (llm_concurrency_limit) when one is set.
+    """
+    
+    def __init__(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+        self.attempts = registry.counter(
+            "llm_attempts_total", "Provider attempts.", ("model", "host", "outcome", "reason")
+        )
+        self.attempt_latency = registry.histogram(
+            "llm_attempt_latency_seconds", "Provider attempt latency.", ("model", "host", "outcome")
+        )
+        self.calls = registry.counter(
+            "llm_calls_total", "Client calls by final outcome.", ("model", "outcome")
+        )
+        self.call_latency = registry.histogram(
+            "llm_call_latency_seconds", "End-to-end call latency.", ("model", "outcome")
+        )
+        self.retries = registry.counter(
+            "llm_retries_total", "Retries after a failed attempt.", ("model", "reason")
+        )
+        self.tokens = registry.counter(
+            "llm_tokens_total", "Provider-reported tokens.", ("model", "kind")
+        )
+        self.concurrency_limit = registry.gauge(
+            "llm_concurrency_limit", "Current adaptive concurrency limit."
+        )
+    
+    def observe_concurrency(self, limit: int) -> None:
+        self.concurrency_limit.set(limit)
+    
+    def observe_attempt(
+        self, model: str, host: str, latency_s: float, reason: Optional[str] = None
+    ) -> None:
+        outcome = "ok" if reason is None else "error"
+        self.attempts.inc(model, host, outcome, reason or "")
+        self.attempt_latency.observe(latency_s, model, host, outcome)
+    
+    def observe_retry(self, model: str, reason: str) -> None:
+        self.retries.inc(model, reason)
+    
+    def observe_call(self, response: LLMResponse, latency_s: float) -> None:
+        if response.cached:
+            outcome = "cache_hit"
+        elif response.coalesced:
+            outcome = "coalesced"
+        else:
+            outcome = "ok" if response.ok else "error"
+        self.calls.inc(response.model, outcome)
+        self.call_latency.observe(latency_s, response.model, outcome)
+        usage = response.usage
+        if usage is not None and not response.coalesced:
+            if usage.prompt_eval_count:
+                self.tokens.inc(response.model, "prompt", amount=usage.prompt_eval_count)
+            if usage.eval_count:
+                self.tokens.inc(response.model, "completion", amount=usage.eval_count)
+
+
+# ============================================================================
+# Failure Journal
+# ============================================================================
+
+
+class FailureJournal:
+    """
+    Append-only JSONL log of failed calls, buffered and size-rotated.
+    
+    Records are held in memory and written in one go every `flush_every`
+    records or `flush_interval_s` seconds (and on flush()/close()), so an
+    outage costs one open file and a few writes instead of a file per
+    failure. A background timer writes records no later append picks up,
+    and anything still buffered is written at interpreter exit, so a
+    client that is never closed keeps its failures.
+    
+    The active file is `<directory>/<name>.jsonl`; when it grows past
+    `max_bytes` it is renamed to `<name>.<epoch_ms>.jsonl` and a new one is
+    started. Rotated files are kept until compact() rewrites them.
+    """
+    
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        name: str = "failures",
+        max_bytes: int = 16 * 1024 * 1024,
+        flush_every: int = 100,
+        flush_interval_s: float = 1.0,
+        fsync: bool = False,
+    ) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.name = name
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+        self._buffer: List[str] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        _FLUSH_AT_EXIT.add(self)
+    
+    @property
+    def path(self) -> Path:
+        """The file currently being appended to."""
+        return self.directory / f"{self.name}.jsonl"
+    
+    def paths(self) -> List[Path]:
+        """All journal files, oldest first."""
+        # Rotated names embed a fixed-width epoch_ms, so name order is age order
+        rotated = sorted(self.directory.glob(f"{self.name}.*.jsonl"))
+        return rotated + ([self.path] if self.path.exists() else [])
+    
+    def append(self, req: LLMRequest, response: LLMResponse) -> Path:
+        """Buffer one failed call; returns the journal file it will land in."""
+        record = {
+            "ts": time.time(),
+            "cache_key": make_cache_key(req),
+            "request": asdict(req),
+            "response": {
+                "ok": response.ok,
+                "error": response.error,
+                "error_type": response.error_type,
+                "request_id": response.request_id,
+            },
+        }
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._buffer.append(line)
+            if (
+                len(self._buffer) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval_s
+            ):
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval_s, self._flush_due)
+                self._timer.daemon = True
+                self._timer.start()
+        return self.path
+    
+    def _flush_due(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._flush_locked()
+    
+    def _flush_locked(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        data = "\n".join(self._buffer) + "\n"
+        self._buffer.clear()
+        with self.path.open("a", encoding="utf-8") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            size = f.tell()
+        if size >= self.max_bytes:
+            stamp = int(time.time() * 1000)
+            while (self.directory / f"{self.name}.{stamp}.jsonl").exists():
+                stamp += 1
+            self.path.rename(self.directory / f"{self.name}.{stamp}.jsonl")
+    
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._flush_locked()
+    
+    def __len__(self) -> int:
+        self.flush()
+        with self._lock:
+            total = 0
+            for path in self.paths():
+                with path.open("r", encoding="utf-8") as f:
+                    total += sum(1 for line in f if line.strip())
+            return total
+    
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Every record in the journal, oldest first (flushes the buffer)."""
+        self.flush()
+        for path in self.paths():
+            with path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+    
+    def compact(self, resolved: Collection[str] = ()) -> int:
+        """
+        Rewrite the journal as one file: drop records whose cache key is in
+        `resolved` and keep only the latest record per remaining key.
+        
+        Returns the number of records kept.
+        """
+        with self._lock:
+            self._flush_locked()
+            paths = self.paths()
+            latest: "OrderedDict[str, str]" = OrderedDict()
+            for path in paths:
+                with path.open("r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        key = json.loads(line)["cache_key"]
+                        if key in resolved:
+                            continue
+                        latest.pop(key, None)
+                        latest[key] = line.rstrip("\n")
+            tmp = self.directory / f".{self.name}.compact.tmp"
+            tmp.write_text("".join(line + "\n" for line in latest.values()), encoding="utf-8")
+            for path in paths:
+                path.unlink()
+            if latest:
+                os.replace(tmp, self.path)
+            else:
+                tmp.unlink()
+            return len(latest)
+
+
+# ============================================================================
+# Providers
+# ============================================================================
+
+
+class LLMProvider(Protocol):
+    """
+    Wire format of one LLM API.
+    
+    A provider only builds request bodies and parses replies; LLMClient
+    does the transport, so pooling, caching, retries, hedging and metrics
+    work the same whichever provider is plugged in.
+    """
+    
+    name: str
+    
+    def headers(self) -> Dict[str, str]: ...
+    
+    def request(
+        self, req: LLMRequest, host: str, *, stream: bool = False
+    ) -> Tuple[str, Dict[str, Any]]: ...
+    
+    def parse(self, data: Mapping[str, Any]) -> ProviderReply: ...
+    
+    def parse_stream_line(
+        self, line: bytes
+    ) -> Tuple[str, bool, Optional[GenerationStats]]: ...
+    
+    def preload_request(
+        self, model: str, host: str, *, keep_alive: Optional[Union[str, float]] = None
+    ) -> Optional[Tuple[str, Dict[str, Any]]]: ...
+
+
+class OllamaProvider:
+    """Ollama's native /api/generate endpoint (the default provider)."""
+    
+    name = "ollama"
+    
+    def __init__(self, *, keep_alive: Optional[Union[str, float]] = None) -> None:
+        self.keep_alive = keep_alive
+    
+    def headers(self) -> Dict[str, str]:
+        return {"Content-Type": "application/json"}
+    
+    def request(
+        self, req: LLMRequest, host: str, *, stream: bool = False
+    ) -> Tuple[str, Dict[str, Any]]:
+        """(url, JSON body) for one generation."""
+        if req.n != 1:
+            raise PermanentError(
+                "Ollama returns one completion per request; use OpenAICompatibleProvider for n > 1",
+                reason="unsupported",
+            )
+        payload = build_generate_payload(req, keep_alive=self.keep_alive)
+        payload["stream"] = stream
+        return f"{host}/api/generate", payload
+    
+    def parse(self, data: Mapping[str, Any]) -> ProviderReply:
+        return ProviderReply(data.get("response", ""), GenerationStats.from_ollama(data))
+    
+    def parse_stream_line(self, line: bytes) -> Tuple[str, bool, Optional[GenerationStats]]:
+        """(text piece, done, usage) from one newline-delimited JSON chunk."""
+        data = json.loads(line)
+        if data.get("error"):
+            raise TransientError(f"Stream error: {data['error']}", reason="server_error")
+        done = bool(data.get("done"))
+        return data.get("response", ""), done, GenerationStats.from_ollama(data) if done else None
+    
+    def preload_request(
+        self, model: str, host: str, *, keep_alive: Optional[Union[str, float]] = None
+    ) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """An empty generate loads the model; keep_alive=0 unloads it."""
+        payload: Dict[str, Any] = {"model": model}
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        return f"{host}/api/generate", payload
+
+
+class OpenAICompatibleProvider:
+    """
+    An OpenAI-style /v1/chat/completions endpoint (vLLM, llama.cpp server,
+    LM Studio, hosted APIs).
+    
+    LLMRequest.n is sent as `n`, so one request samples several completions
+    server-side; they come back in LLMResponse.choices. `extra` is merged
+    into every request body for server-specific parameters (top_p, seed,
+    response_format, vLLM's best_of, ...). `host` may be given with or
+    without the trailing /v1.
+    
+    Example:
+        provider = OpenAICompatibleProvider(api_key="...", extra={"top_p": 0.9})
+        with LLMClient("http://localhost:8000", provider=provider) as client:
+            response = client.call(LLMRequest(model="qwen2.5-7b", prompt="Hi", n=4))
+            print(response.choices)
+    """
+    
+    name = "openai"
+    
+    def __init__(
+        self,
+        *,
+        api_key: Optional[str] = None,
+        extra: Optional[Mapping[str, Any]] = None,
+    ) -> None:
+        # Falls back to $OPENAI_API_KEY; local servers usually need none
+        self.api_key = api_key if api_key is not None else os.environ.get("OPENAI_API_KEY")
+        self.extra = dict(extra or {})
+    
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+    
+    @staticmethod
+    def url(host: str) -> str:
+        base = host.rstrip("/")
+        if not base.endswith("/v1"):
+            base += "/v1"
+        return f"{base}/chat/completions"
+    
+    def request(
+        self, req: LLMRequest, host: str, *, stream: bool = False
+    ) -> Tuple[str, Dict[str, Any]]:
+        """(url, JSON body) for one chat completion."""
+        messages = []
+        if req.system_prompt:
+            messages.append({"role": "system", "content": req.system_prompt})
+        messages.append({"role": "user", "content": req.prompt})
+        payload: Dict[str, Any] = {
+            **self.extra,
+            "model": req.model,
+            "messages": messages,
+            "temperature": req.temperature,
+            "max_tokens": req.max_tokens,
+            "stream": stream,
+        }
+        if req.n != 1:
+            if stream:
+                raise PermanentError("Streaming supports n=1 only", reason="unsupported")
+            payload["n"] = req.n
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return self.url(host), payload
+    
+    def parse(self, data: Mapping[str, Any]) -> ProviderReply:
+        choices = sorted(data.get("choices") or [], key=lambda c: c.get("index", 0))
+        texts = tuple((c.get("message") or {}).get("content") or "" for c in choices)
+        if not texts:
+            raise TransientError("Completion had no choices", reason="server_error")
+        return ProviderReply(
+            texts[0],
+            GenerationStats.from_openai(data),
+            texts if len(texts) > 1 else (),
+        )
+    
+    def parse_stream_line(self, line: bytes) -> Tuple[str, bool, Optional[GenerationStats]]:
+        """(text piece, done, usage) from one server-sent event line."""
+        text = line.decode("utf-8").strip()
+        if not text.startswith("data:"):
+            return "", False, None
+        body = text[len("data:"):].strip()
+        if body == "[DONE]":
+            return "", True, None
+        data = json.loads(body)
+        if data.get("error"):
+            raise TransientError(f"Stream error: {data['error']}", reason="server_error")
+        piece = ""
+        for choice in data.get("choices") or []:
+            piece += (choice.get("delta") or {}).get("content") or ""
+        return piece, False, GenerationStats.from_openai(data)
+    
+    def preload_request(
+        self, model: str, host: str, *, keep_alive: Optional[Union[str, float]] = None
+    ) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Models are loaded when the server starts; nothing to do."""
+        return None
+
+
+PROVIDERS: Dict[str, Callable[..., LLMProvider]] = {
+    OllamaProvider.name: OllamaProvider,
+    OpenAICompatibleProvider.name: OpenAICompatibleProvider,
+}
+
+
+def make_provider(name: str, **kwargs: Any) -> LLMProvider:
+    """Provider by name ("ollama" or "openai"), for CLI flags."""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown provider {name!r}; expected one of {sorted(PROVIDERS)}")
+    return PROVIDERS[name](**kwargs)
+
+
+def cache_value(req: LLMRequest, reply: ProviderReply) -> str:
+    """
+    What the response cache stores for a reply: its text, or for n > 1 all
+    choices as a JSON list (even if the server returned only one).
+    """
+    if req.n > 1:
+        return json.dumps(list(reply.choices or (reply.text,)), ensure_ascii=False)
+    return reply.text
+
+
+def reply_from_cache(req: LLMRequest, value: str) -> ProviderReply:
+    """Inverse of cache_value() for a request's cached value."""
+    if req.n > 1:
+        try:
+            decoded = json.loads(value)
+        except ValueError:
+            decoded = None
+        # Older entries stored a lone choice as plain text
+        if not isinstance(decoded, list) or not decoded or not all(
+            isinstance(c, str) for c in decoded
+        ):
+            decoded = [value]
+        choices = tuple(decoded)
+        return ProviderReply(choices[0], choices=choices)
+    return ProviderReply(value)
+
+
+def iter_stream_lines(resp: "requests.Response") -> Iterator[bytes]:
+    """
+    Non-empty lines of a streamed response body, each as soon as it arrives.
+    
+    requests' iter_lines() waits for a full read buffer, so with a
+    close-delimited body (no chunked framing) the first lines of a stream
+    show up late and all at once, which skews time-to-first-token.
+    read1() returns whatever bytes are already available instead.
+    """
+    raw = resp.raw
+    if not hasattr(raw, "read1"):  # urllib3 < 2.3
+        yield from (line for line in resp.iter_lines(chunk_size=None) if line)
+        return
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+    
+    buffer = b""
+    while True:
+        try:
+            data = raw.read1(64 * 1024, decode_content=True)
+        except ReadTimeoutError as e:
+            raise TransientError(f"Stream read timed out: {e}", reason="timeout") from e
+        except ProtocolError as e:
+            raise TransientError(f"Stream broken: {e}", reason="connection") from e
+        if not data:
+            break
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line:
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+# ============================================================================
+# LLM Client
+# ============================================================================
+
+
+class LLMClient:
+    """
+    Production-ready LLM client with reliability features.
+    
+    Features:
+    - Configurable timeouts (connect and read)
+    - Automatic retries with exponential backoff and jitter
+    - Rate limit handling (respects Retry-After header)
+    - Response caching (bounded LRU memory, file or SQLite-backed)
+    - Structured logging with request IDs
+    - Keep-alive connection pool (pass `pool=` to share one across clients)
+    - Optional metrics (pass `metrics=MetricsRegistry()`)
+    - Record/replay of provider replies (pass `cassette=Cassette(...)`)
+    - Pluggable wire format (pass `provider=OpenAICompatibleProvider()`;
+      Ollama by default)
+    
+    Example:
+        with LLMClient(host="http://localhost:11434") as client:
+            response = client.call(LLMRequest(
+                model="llama3.1",
+                prompt="Hello!",
+                temperature=0.0
+            ))
+            if response.ok:
+                print(response.text)
+    """
+    
+    def __init__(
+        self,
+        host: str = "http://localhost:11434",
+        *,
         timeout_s: float = 30.0,
         max_retries: int = 3,
-        cache: Optional[SimpleMemoryCache] = None,
+        cache: Optional[ResponseCache] = None,
         rate_limiter: Optional[TokenBucket] = None,
         output_dir: Optional[Path] = None,
+        pool: Optional[ConnectionPool] = None,
+        pool_maxsize: int = 10,
+        coalesce: bool = True,
+        rate_limit_cost: Optional[Callable[[LLMRequest], float]] = None,
+        deadline_s: Optional[float] = None,
+        concurrency: Optional[AdaptiveConcurrencyLimit] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        endpoints: Optional[EndpointPool] = None,
+        hedge: Optional[HedgePolicy] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        cassette: Optional[Cassette] = None,
+        failure_journal: Optional[FailureJournal] = None,
+        keep_alive: Optional[Union[str, float]] = None,
+        provider: Optional[LLMProvider] = None,
     ) -> None:
+        # With an endpoint pool, `host` is only used as a label/fallback.
+        if endpoints is not None:
+            host = endpoints.hosts[0]
         self.host = host
         self.timeout_s = timeout_s
         self.max_retries = max_retries
-        self._cache = cache or SimpleMemoryCache()
+        # Budget for all attempts + backoff sleeps of one call (None = unbounded)
+        self.deadline_s = deadline_s
+        # Request/reply format; `keep_alive` configures the default Ollama provider
+        self._provider = provider if provider is not None else OllamaProvider(keep_alive=keep_alive)
+        # How long Ollama keeps a model loaded after each request (None = server default)
+        self.keep_alive = keep_alive if keep_alive is not None else getattr(provider, "keep_alive", None)
+        self._cache = cache if cache is not None else LRUCache()
         self._rate_limiter = rate_limiter
+        # Tokens charged per request; defaults to a flat 1 per request.
+        self._rate_limit_cost = rate_limit_cost
         self._output_dir = output_dir or Path("output")
         self._output_dir.mkdir(parents=True, exist_ok=True)
+        # persist_failure() appends here; flushed on close()
+        self._journal = failure_journal or FailureJournal(self._output_dir)
+        # A pool passed in is shared with other clients, so we don't close it.
+        self._owns_pool = pool is None
+        self._pool = pool or ConnectionPool(
+            maxsize=pool_maxsize,
+            max_hosts=max(4, len(endpoints.hosts) if endpoints else 1),
+        )
+        # Identical requests already in flight wait for that result instead
+        # of calling the provider again.
+        self._inflight: Optional[SingleFlight[LLMResponse]] = SingleFlight() if coalesce else None
+        # Optional AIMD gate in front of every provider attempt
+        self._concurrency = concurrency
+        # Optional per-host breaker; share one instance across clients
+        self._breaker = circuit_breaker
+        # Optional set of hosts to balance across and fail over between
+        self._endpoints = endpoints
+        self._router = HostRouter(host, endpoints=endpoints, breaker=circuit_breaker)
+        # Optional hedging; backup attempts run on a small dedicated executor
+        self._hedge = hedge
+        self._hedge_executor = (
+            ThreadPoolExecutor(max_workers=2 * pool_maxsize, thread_name_prefix="llm-hedge")
+            if hedge is not None else None
+        )
+        # Optional counters/histograms; share one registry across clients
+        self._metrics = LLMMetrics(metrics) if metrics is not None else None
+        if self._metrics is not None and concurrency is not None:
+            self._metrics.observe_concurrency(concurrency.limit)
+        # Optional record/replay of provider replies (replay skips the network)
+        self._cassette = cassette
     
-    def _provider_call(self, req: LLMRequest, *, timeout_s: float) -> str:
+    def pool_stats(self) -> Dict[str, Any]:
+        """Connection pool occupancy (in-flight requests, idle connections)."""
+        return self._pool.stats()
+    
+    def endpoint_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-endpoint health, outstanding requests and EWMA latency."""
+        if self._endpoints is None:
+            return {}
+        return self._endpoints.stats()
+    
+    def cache_key(self, req: LLMRequest) -> str:
+        """The response-cache key for `req` under this client's provider."""
+        return make_cache_key(req, provider=self._provider)
+    
+    def cache_store(self, req: LLMRequest, text: str) -> None:
+        """Cache `text` as the answer to `req`, as a successful call() would."""
+        cache_store(self._cache, self.cache_key(req), text, model=req.model)
+    
+    def _pick_host(self, failed_hosts: Collection[str]) -> str:
+        return self._router.pick(failed_hosts)
+    
+    @staticmethod
+    def _retry_wait(
+        step: RetryStep,
+        request_id: str,
+        req: LLMRequest,
+        deadline: Optional[Deadline],
+        attempt: int,
+    ) -> bool:
+        """Carry out a plan_retry() step; False means stop retrying."""
+        if step.action == "stop":
+            if step.out_of_time:
+                log_deadline_exhausted(request_id, req, deadline, step.delay_s, attempt)
+            return False
+        if step.action == "backoff":
+            if deadline is not None:
+                deadline.sleep(step.delay_s)
+            else:
+                time.sleep(step.delay_s)
+        return True
+    
+    def close(self) -> None:
+        """Flush the failure journal and release pooled connections owned by this client."""
+        self._journal.flush()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False, cancel_futures=True)
+        if self._owns_pool:
+            self._pool.close()
+    
+    def hedge_stats(self) -> Dict[str, Any]:
+        """Hedging counters (attempts, hedges sent, hedge wins)."""
+        return self._hedge.stats() if self._hedge is not None else {}
+    
+    def __enter__(self) -> "LLMClient":
+        return self
+    
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+    
+    def _resolve_deadline(
+        self, deadline_s: Optional[float], deadline: Optional[Deadline]
+    ) -> Optional[Deadline]:
+        """The caller's deadline, narrowed by deadline_s (or the client default)."""
+        deadline_s = deadline_s if deadline_s is not None else self.deadline_s
+        if deadline is not None:
+            return deadline.child(deadline_s) if deadline_s is not None else deadline
+        return Deadline(deadline_s) if deadline_s is not None else None
+    
+    def _admit(self, req: LLMRequest, *, timeout_s: float) -> float:
+        """
+        Wait for the client-side rate limiter and return what is left of
+        timeout_s; raise if it can't admit in time.
+        """
+        if self._rate_limiter is None:
+            return timeout_s
+        t0 = time.monotonic()
+        cost = self._rate_limit_cost(req) if self._rate_limit_cost else 1.0
+        admitted = self._rate_limiter.acquire(cost, timeout_s=timeout_s)
+        left_s = timeout_s - (time.monotonic() - t0)
+        if not admitted or left_s <= 0:
+            raise TransientError("Rate limit exceeded (client-side)", reason="client_rate_limit")
+        return left_s
+    
+    def _take_slot(self, *, timeout_s: float) -> Tuple[Optional[float], float]:
+        """
+        Wait for an adaptive-limit slot, if one is configured.
+        
+        Returns (started_at for _release_slot(), what is left of timeout_s);
+        raises if no slot frees up in time.
+        """
+        if self._concurrency is None:
+            return None, timeout_s
+        t0 = time.monotonic()
+        started_at = self._concurrency.acquire(timeout_s=timeout_s)
+        if started_at is None:
+            raise TransientError("Concurrency limit reached", reason="concurrency")
+        left_s = timeout_s - (started_at - t0)
+        if left_s <= 0:
+            self._release_slot(started_at, "concurrency")
+            raise TransientError("Concurrency limit reached", reason="concurrency")
+        return started_at, left_s
+    
+    def _release_slot(self, started_at: Optional[float], reason: Optional[str]) -> None:
+        if started_at is None:
+            return
+        self._concurrency.release(started_at, reason=reason)
+        if self._metrics is not None:
+            self._metrics.observe_concurrency(self._concurrency.limit)
+    
+    def _record_reply(
+        self, req: LLMRequest, reply: ProviderReply, latency_s: float, **kwargs: Any
+    ) -> None:
+        if self._cassette is not None:
+            self._cassette.record(req, reply, latency_s, key=self.cache_key(req), **kwargs)
+    
+    def _attempt(
+        self, req: LLMRequest, *, timeout_s: float, host: str, record: bool = True
+    ) -> ProviderReply:
+        """
+        One provider call behind the circuit breaker and adaptive limit, if set.
+        
+        With record=False the reply isn't written to the cassette; hedged
+        attempts record only the copy that wins.
+        """
+        if self._cassette is not None and self._cassette.replaying:
+            return self._cassette.play(req, key=self.cache_key(req))
+        # Client-side waits come first and share the attempt's timeout; the
+        # rate limiter is passed before taking a concurrency slot, so
+        # throttling isn't measured as server latency.
+        timeout_s = self._admit(req, timeout_s=timeout_s)
+        if self._breaker is not None:
+            self._breaker.before_call(host)
+        if self._endpoints is not None:
+            self._endpoints.begin(host)
+        t0 = time.monotonic()
+        started_at: Optional[float] = None
+        reason: Optional[str] = "cancelled"
+        try:
+            started_at, timeout_s = self._take_slot(timeout_s=timeout_s)
+            call_t0 = time.monotonic()
+            if self._endpoints is None:
+                reply = self._provider_call(req, timeout_s=timeout_s)
+            else:
+                reply = self._provider_call(req, timeout_s=timeout_s, host=host)
+            reason = None
+            # Overrides written before ProviderReply existed return plain text
+            if isinstance(reply, str):
+                reply = ProviderReply(reply)
+            if record:
+                self._record_reply(req, reply, time.monotonic() - call_t0)
+            return reply
+        except Exception as e:
+            reason = classify_exception(e).reason
+            raise
+        finally:
+            self._release_slot(started_at, reason)
+            if self._breaker is not None:
+                self._breaker.record(host, reason)
+            if self._endpoints is not None:
+                self._endpoints.end(host, latency_s=time.monotonic() - t0, reason=reason)
+    
+    def _timed_attempt(
+        self, req: LLMRequest, *, timeout_s: float, host: str, record: bool = True
+    ) -> Tuple[ProviderReply, float]:
+        t0 = time.monotonic()
+        reply = self._attempt(req, timeout_s=timeout_s, host=host, record=record)
+        return reply, time.monotonic() - t0
+    
+    def _hedged_attempt(
+        self, req: LLMRequest, *, timeout_s: float, host: str
+    ) -> Tuple[ProviderReply, str]:
+        """
+        Run one attempt, sending a backup copy if it is slower than usual.
+        
+        Returns (reply, host that answered). The slower copy is cancelled if it
+        hasn't started; otherwise it runs to completion and its result is
+        dropped (a blocking HTTP call can't be interrupted from outside).
+        The hedge delay and the primary's timeout count from when the
+        primary starts running, not from when it was queued, so a busy
+        executor doesn't set off hedges on its own. Once a backup is sent,
+        only the winning reply is recorded to the cassette.
+        """
+        assert self._hedge is not None and self._hedge_executor is not None
+        delay_s = self._hedge.delay_s()
+        if delay_s is None or delay_s >= timeout_s:
+            reply, latency_s = self._timed_attempt(req, timeout_s=timeout_s, host=host)
+            self._hedge.observe(latency_s)
+            return reply, host
+        
+        submitted_at = time.monotonic()
+        started = threading.Event()
+        started_at = [submitted_at]
+        
+        def run_primary() -> Tuple[ProviderReply, float]:
+            started_at[0] = time.monotonic()
+            started.set()
+            left_s = timeout_s - (started_at[0] - submitted_at)
+            if left_s <= 0:
+                raise TransientError("Hedge executor busy past the timeout", reason="concurrency")
+            return self._timed_attempt(req, timeout_s=left_s, host=host, record=False)
+        
+        primary = self._hedge_executor.submit(run_primary)
+        if not started.wait(timeout=timeout_s):
+            if primary.cancel():
+                raise TransientError("Hedge executor busy past the timeout", reason="concurrency")
+            started.wait()
+        done, _ = wait([primary], timeout=max(0.0, started_at[0] + delay_s - time.monotonic()))
+        if done:
+            reply, latency_s = primary.result()
+            self._hedge.observe(latency_s)
+            self._record_reply(req, reply, latency_s)
+            return reply, host
+        
+        hedge_host = self._pick_host({host}) if self._endpoints is not None else host
+        backup = self._hedge_executor.submit(
+            self._timed_attempt,
+            req,
+            timeout_s=max(MIN_ATTEMPT_TIMEOUT_S, submitted_at + timeout_s - time.monotonic()),
+            host=hedge_host,
+            record=False,
+        )
+        logger.info(
+            "llm_hedge_sent",
+            extra={"model": req.model, "host": host, "hedge_host": hedge_host, "delay_s": delay_s}
+        )
+        hosts: Dict["Future[Tuple[ProviderReply, float]]", str] = {primary: host, backup: hedge_host}
+        pending = set(hosts)
+        first_err: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                err = future.exception()
+                if err is not None:
+                    first_err = first_err or err
+                    continue
+                for loser in pending:
+                    loser.cancel()
+                reply, latency_s = future.result()
+                self._hedge.observe(latency_s)
+                self._hedge.record_hedge(won=future is backup)
+                self._record_reply(req, reply, latency_s)
+                return reply, hosts[future]
+        self._hedge.record_hedge(won=False)
+        assert first_err is not None
+        raise first_err
+    
+    def _provider_call(
+        self, req: LLMRequest, *, timeout_s: float, host: Optional[str] = None
+    ) -> ProviderReply:
         """
         Make the actual HTTP call to the LLM provider.
         
-        Override this method to support different providers (OpenAI, Anthropic, etc.)
+        The body and reply format come from the client's LLMProvider; pass
+        `provider=` rather than overriding this (overrides still work).
+        `host` is only passed when the client balances across an EndpointPool.
+        Returning a plain string is still accepted (usage is then None).
         """
-        url = f"{self.host}/api/generate"
-        payload = {
-            "model": req.model,
-            "prompt": req.prompt,
-            "system": req.system_prompt,
-            "stream": False,
-            "options": {
-                "temperature": req.temperature,
-                "num_predict": req.max_tokens,
-            },
-        }
+        url, payload = self._provider.request(req, host or self.host)
+        data = self._post_json(url, payload, timeout_s=timeout_s)
+        return self._provider.parse(data)
+    
+    def _post_json(self, url: str, payload: Dict[str, Any], *, timeout_s: float) -> Dict[str, Any]:
+        """POST through the pool; map failures to TransientError/PermanentError."""
+        errors = http_errors()
+        try:
+            resp = self._pool.post(
+                url,
+                json=payload,
+                timeout=timeout_s,
+                headers=self._provider.headers()
+            )
+            resp.raise_for_status()
+            return resp.json()
+        
+        except errors.Timeout as e:
+            raise TransientError(f"Request timed out after {timeout_s}s", reason="timeout") from e
+        except errors.ConnectionError as e:
+            raise TransientError(f"Connection failed: {url}", reason="connection") from e
+        except errors.HTTPError as e:
+            if e.response is None:
+                raise PermanentError("HTTP error: unknown", reason="unknown") from e
+            raise error_for_status(e.response.status_code, e.response.headers) from e
+    
+    def preload(
+        self,
+        model: str,
+        *,
+        keep_alive: Optional[Union[str, float]] = None,
+        timeout_s: Optional[float] = None,
+    ) -> Dict[str, float]:
+        """
+        Load `model` into memory on every endpoint without generating text.
+        
+        Call before a batch so the first request doesn't pay the load time.
+        `keep_alive` defaults to the client's. Returns seconds taken per host
+        (empty for providers whose servers keep models loaded).
+        """
+        keep_alive = keep_alive if keep_alive is not None else self.keep_alive
+        hosts = self._endpoints.hosts if self._endpoints is not None else [self.host]
+        timings: Dict[str, float] = {}
+        for host in hosts:
+            preload = self._provider.preload_request(model, host, keep_alive=keep_alive)
+            if preload is None:
+                continue
+            url, payload = preload
+            t0 = time.monotonic()
+            self._post_json(url, payload, timeout_s=timeout_s or self.timeout_s)
+            timings[host] = time.monotonic() - t0
+            logger.info(
+                "llm_model_preloaded",
+                extra={"model": model, "host": host, "load_s": timings[host], "keep_alive": keep_alive}
+            )
+        return timings
+    
+    def unload(self, model: str, *, timeout_s: Optional[float] = None) -> None:
+        """Ask every endpoint to drop `model` from memory now (keep_alive=0)."""
+        self.preload(model, keep_alive=0, timeout_s=timeout_s)
+    
+    def _provider_stream(
+        self,
+        req: LLMRequest,
+        *,
+        timeout_s: float,
+        host: Optional[str] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """
+        Stream text chunks from the provider's streaming reply.
+        
+        If `meta` is given, the reported counters are stored in
+        meta["usage"] as GenerationStats.
+        """
+        host = host or self.host
+        url, payload = self._provider.request(req, host, stream=True)
+        
+        errors = http_errors()
+        try:
+            resp = self._pool.post(
+                url,
+                json=payload,
+                timeout=timeout_s,
+                stream=True,
+                headers=self._provider.headers()
+            )
+            usage: Optional[GenerationStats] = None
+            with resp:
+                resp.raise_for_status()
+                for line in iter_stream_lines(resp):
+                    piece, done, line_usage = self._provider.parse_stream_line(line)
+                    usage = line_usage or usage
+                    if piece:
+                        yield piece
+                    if done:
+                        if meta is not None:
+                            meta["usage"] = usage
+                        return
+            raise TransientError("Stream ended before completion", reason="connection")
+        
+        except errors.Timeout as e:
+            raise TransientError(f"Request timed out after {timeout_s}s", reason="timeout") from e
+        except (errors.ConnectionError, errors.ChunkedEncodingError) as e:
+            raise TransientError(f"Connection failed: {host}", reason="connection") from e
+        except errors.HTTPError as e:
+            if e.response is None:
+                raise PermanentError("HTTP error: unknown", reason="unknown") from e
+            raise error_for_status(e.response.status_code, e.response.headers) from e
+    
+    def stream(
+        self,
+        req: LLMRequest,
+        *,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        deadline_s: Optional[float] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> LLMStream:
+        """
+        Stream the completion chunk by chunk.
+        
+        Failures before the first chunk are retried like call(); once text
+        has been yielded a failure ends the stream with ok=False. The full
+        text is cached only when the stream completes. Requests with n > 1
+        can't be streamed.
+        
+        Example:
+            stream = client.stream(LLMRequest(model="llama3.1", prompt="Hi"))
+            for chunk in stream:
+                print(chunk, end="", flush=True)
+            print(stream.response.ttft_s)
+        """
+        if req.n != 1:
+            raise ValueError("stream() supports n=1 only; use call() for several choices")
+        out = LLMStream()
+        out._chunks = self._stream_chunks(
+            req,
+            out,
+            timeout_s=timeout_s or self.timeout_s,
+            max_retries=max_retries if max_retries is not None else self.max_retries,
+            deadline=self._resolve_deadline(deadline_s, deadline),
+        )
+        return out
+    
+    def call_stream(
+        self,
+        req: LLMRequest,
+        on_chunk: Callable[[str], None],
+        *,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+    ) -> LLMResponse:
+        """Stream the completion, calling on_chunk per chunk; returns the final response."""
+        out = self.stream(req, timeout_s=timeout_s, max_retries=max_retries)
+        for chunk in out:
+            on_chunk(chunk)
+        assert out.response is not None
+        return out.response
+    
+    def _stream_chunks(
+        self,
+        req: LLMRequest,
+        out: LLMStream,
+        *,
+        timeout_s: float,
+        max_retries: int,
+        deadline: Optional[Deadline] = None,
+    ) -> Iterator[str]:
+        request_id = str(uuid.uuid4())[:8]
+        started = time.monotonic()
+        
+        # Check cache
+        cache_key = self.cache_key(req)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            logger.info(
+                "llm_cache_hit",
+                extra={"request_id": request_id, "model": req.model}
+            )
+            out.response = LLMResponse(
+                ok=True,
+                text=cached,
+                model=req.model,
+                latency_s=0.0,
+                request_id=request_id,
+                cached=True,
+            )
+            if self._metrics is not None:
+                self._metrics.observe_call(out.response, time.monotonic() - started)
+            if cached:
+                yield cached
+            return
         
-        # Check rate limiter
-        if self._rate_limiter and not self._rate_limiter.allow():
-            raise TransientError("Rate limit exceeded (client-side)")
+        # Retry loop (only until the first chunk has been handed out)
+        last_err: Optional[Exception] = None
+        out_of_time = False
+        parts: List[str] = []
+        failed_hosts: set = set()
+        for attempt in range(max_retries + 1):
+            if deadline is not None and deadline.expired():
+                out_of_time = True
+                log_deadline_exhausted(request_id, req, deadline, 0.0, attempt)
+                break
+            if attempt and self._metrics is not None and last_err is not None:
+                self._metrics.observe_retry(req.model, classify_exception(last_err).reason)
+            t0 = time.monotonic()
+            first_at: Optional[float] = None
+            last_at = t0
+            gaps: List[float] = []
+            host = self._pick_host(failed_hosts)
+            if self._endpoints is not None:
+                self._endpoints.begin(host)
+            stream_reason: Optional[str] = "cancelled"
+            # Set while a breaker admission (maybe a half-open trial slot) is unreported
+            breaker_pending = False
+            slot_started_at: Optional[float] = None
+            meta: Dict[str, Any] = {}
+            replaying = self._cassette is not None and self._cassette.replaying
+            try:
+                attempt_timeout_s = deadline.clamp(timeout_s) if deadline else timeout_s
+                # Same gates and order as _attempt(): rate limiter, breaker,
+                # then an adaptive-limit slot held until the stream ends
+                if not replaying:
+                    attempt_timeout_s = self._admit(req, timeout_s=attempt_timeout_s)
+                if self._breaker is not None:
+                    self._breaker.before_call(host)
+                    breaker_pending = True
+                if not replaying:
+                    slot_started_at, attempt_timeout_s = self._take_slot(
+                        timeout_s=attempt_timeout_s
+                    )
+                if replaying:
+                    pieces = self._cassette.play_stream(req, key=cache_key, meta=meta)
+                elif self._endpoints is None:
+                    pieces = self._provider_stream(req, timeout_s=attempt_timeout_s, meta=meta)
+                else:
+                    pieces = self._provider_stream(
+                        req, timeout_s=attempt_timeout_s, host=host, meta=meta
+                    )
+                for piece in pieces:
+                    now = time.monotonic()
+                    if first_at is None:
+                        first_at = now
+                    else:
+                        gaps.append(now - last_at)
+                    last_at = now
+                    parts.append(piece)
+                    yield piece
+                
+                latency_s = time.monotonic() - t0
+                ttft_s = (first_at - t0) if first_at is not None else latency_s
+                text = "".join(parts)
+                usage: Optional[GenerationStats] = meta.get("usage")
+                stream_reason = None
+                if breaker_pending:
+                    breaker_pending = False
+                    self._breaker.record(host, None)
+                
+                logger.info(
+                    "llm_stream_ok",
+                    extra={
+                        "request_id": request_id,
+                        "model": req.model,
+                        "latency_s": latency_s,
+                        "ttft_s": ttft_s,
+                        "chunks": len(parts),
+                        "attempt": attempt,
+                        **(usage.log_fields() if usage else {}),
+                    }
+                )
+                
+                # Cache only a completed stream
+                cache_store(self._cache, cache_key, text, model=req.model)
+                self._record_reply(req, ProviderReply(text, usage), latency_s, ttft_s=ttft_s)
+                
+                out.response = LLMResponse(
+                    ok=True,
+                    text=text,
+                    model=req.model,
+                    latency_s=latency_s,
+                    request_id=request_id,
+                    ttft_s=ttft_s,
+                    inter_token_mean_s=sum(gaps) / len(gaps) if gaps else 0.0,
+                    inter_token_max_s=max(gaps, default=0.0),
+                    usage=usage,
+                )
+                if self._metrics is not None:
+                    self._metrics.observe_call(out.response, time.monotonic() - started)
+                return
+            
+            except Exception as e:
+                last_err = e
+                step = plan_retry(
+                    e,
+                    attempt=attempt,
+                    max_retries=max_retries,
+                    deadline=deadline,
+                    router=self._router,
+                    host=host,
+                    failed_hosts=failed_hosts,
+                    partial=bool(parts),
+                )
+                decision = step.decision
+                stream_reason = decision.reason
+                if breaker_pending:
+                    breaker_pending = False
+                    self._breaker.record(host, decision.reason)
+                
+                logger.warning(
+                    "llm_stream_failed",
+                    extra={
+                        "request_id": request_id,
+                        "model": req.model,
+                        "latency_s": time.monotonic() - t0,
+                        "attempt": attempt,
+                        "chunks": len(parts),
+                        "error_type": type(e).__name__,
+                        "reason": decision.reason,
+                        "retryable": decision.should_retry,
+                    }
+                )
+                if not self._retry_wait(step, request_id, req, deadline, attempt):
+                    out_of_time = step.out_of_time
+                    break
+            
+            finally:
+                # An abandoned generator (GeneratorExit) reports "cancelled",
+                # which frees a half-open trial slot without judging the host
+                self._release_slot(slot_started_at, stream_reason)
+                if breaker_pending:
+                    self._breaker.record(host, stream_reason)
+                if self._endpoints is not None:
+                    self._endpoints.end(
+                        host, latency_s=time.monotonic() - t0, reason=stream_reason
+                    )
+                if self._metrics is not None:
+                    self._metrics.observe_attempt(
+                        req.model, host, time.monotonic() - t0, stream_reason
+                    )
         
-        try:
-            resp = requests.post(
-                url,
-                json=payload,
-                timeout=timeout_s,
-                headers={"Content-Type": "application/json"}
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            return data.get("response", "")
-        
-        except Timeout as e:
-            raise TransientError(f"Request timed out after {timeout_s}s") from e
-        except ConnectionError as e:
-            raise TransientError(f"Connection failed: {self.host}") from e
-        except HTTPError as e:
-            if e.response is not None and e.response.status_code == 429:
-                retry_after = e.response.headers.get("Retry-After")
-                if retry_after:
-                    wait_s = parse_retry_after(retry_after)
-                    if wait_s:
-                        raise TransientError(f"Rate limited, retry after {wait_s}s") from e
-                raise TransientError("Rate limited (429)") from e
-            if e.response is not None and 500 <= e.response.status_code < 600:
-                raise TransientError(f"Server error: {e.response.status_code}") from e
-            raise PermanentError(f"HTTP error: {e.response.status_code if e.response else 'unknown'}") from e
+        out.response = failed_response(
+            req, request_id, last_err, deadline if out_of_time else None, text="".join(parts)
+        )
+        if self._metrics is not None:
+            self._metrics.observe_call(out.response, time.monotonic() - started)
     
     def call(
         self,
@@ -336,45 +3826,148 @@ class LLMClient:
         *,
         timeout_s: Optional[float] = None,
         max_retries: Optional[int] = None,
+        deadline_s: Optional[float] = None,
+        deadline: Optional[Deadline] = None,
     ) -> LLMResponse:
         """
         Call the LLM with caching, retries, and logging.
         
         Args:
             req: The LLM request payload
-            timeout_s: Override default timeout
+            timeout_s: Override default per-attempt timeout
             max_retries: Override default max retries
+            deadline_s: Override default total budget across all attempts
+            deadline: Caller's Deadline (e.g. a pipeline's); attempts,
+                hedges and backoff sleeps are sized to what is left of it
         
         Returns:
             LLMResponse with result or error details
         """
+        t0 = time.monotonic()
+        response = self._call(
+            req,
+            timeout_s=timeout_s,
+            max_retries=max_retries,
+            deadline=self._resolve_deadline(deadline_s, deadline),
+        )
+        if self._metrics is not None:
+            self._metrics.observe_call(response, time.monotonic() - t0)
+        return response
+    
+    def _call(
+        self,
+        req: LLMRequest,
+        *,
+        timeout_s: Optional[float],
+        max_retries: Optional[int],
+        deadline: Optional[Deadline],
+    ) -> LLMResponse:
         request_id = str(uuid.uuid4())[:8]
         timeout_s = timeout_s or self.timeout_s
         max_retries = max_retries if max_retries is not None else self.max_retries
         
         # Check cache
-        cache_key = make_cache_key(req)
-        cached = self._cache.get(cache_key)
-        if cached is not None:
-            logger.info(
-                "llm_cache_hit",
-                extra={"request_id": request_id, "model": req.model}
+        cache_key = self.cache_key(req)
+        hit = self._cached_response(req, cache_key, request_id)
+        if hit is not None:
+            return hit
+        
+        if self._inflight is None:
+            return self._call_uncached(
+                req,
+                request_id=request_id,
+                cache_key=cache_key,
+                timeout_s=timeout_s,
+                max_retries=max_retries,
+                deadline=deadline,
             )
-            return LLMResponse(
-                ok=True,
-                text=cached,
-                model=req.model,
-                latency_s=0.0,
+        
+        def lead() -> LLMResponse:
+            # A leader that finished after our lookup may have filled the cache
+            hit = self._cached_response(req, cache_key, request_id)
+            if hit is not None:
+                return hit
+            return self._call_uncached(
+                req,
                 request_id=request_id,
-                cached=True,
+                cache_key=cache_key,
+                timeout_s=timeout_s,
+                max_retries=max_retries,
+                deadline=deadline,
             )
         
+        while True:
+            try:
+                # A follower waits no longer than its own deadline allows
+                response, shared = self._inflight.do(
+                    cache_key, lead, timeout_s=deadline.remaining() if deadline else None
+                )
+            except TimeoutError as e:
+                return failed_response(req, request_id, e, deadline)
+            # The leader ran out of its own budget (or was cancelled); that
+            # says nothing about ours, so go again rather than share it
+            if not (shared and response.error_type == "DeadlineExceeded"):
+                break
+        if shared:
+            logger.info(
+                "llm_call_coalesced",
+                extra={"request_id": request_id, "model": req.model, "leader_id": response.request_id}
+            )
+            return replace(response, request_id=request_id, coalesced=True)
+        return response
+    
+    def _cached_response(
+        self, req: LLMRequest, cache_key: str, request_id: str
+    ) -> Optional[LLMResponse]:
+        """The cached answer to `req` as a response, or None on a miss."""
+        cached = self._cache.get(cache_key)
+        if cached is None:
+            return None
+        logger.info(
+            "llm_cache_hit",
+            extra={"request_id": request_id, "model": req.model}
+        )
+        reply = reply_from_cache(req, cached)
+        return LLMResponse(
+            ok=True,
+            text=reply.text,
+            model=req.model,
+            latency_s=0.0,
+            request_id=request_id,
+            cached=True,
+            choices=reply.choices,
+        )
+    
+    def _call_uncached(
+        self,
+        req: LLMRequest,
+        *,
+        request_id: str,
+        cache_key: str,
+        timeout_s: float,
+        max_retries: int,
+        deadline: Optional[Deadline] = None,
+    ) -> LLMResponse:
+        """Run the retry loop against the provider and cache a success."""
         # Retry loop
         last_err: Optional[Exception] = None
+        out_of_time = False
+        failed_hosts: set = set()
         for attempt in range(max_retries + 1):
+            if deadline is not None and deadline.expired():
+                out_of_time = True
+                log_deadline_exhausted(request_id, req, deadline, 0.0, attempt)
+                break
+            if attempt and self._metrics is not None and last_err is not None:
+                self._metrics.observe_retry(req.model, classify_exception(last_err).reason)
             t0 = time.time()
+            host = self._pick_host(failed_hosts)
             try:
-                text = self._provider_call(req, timeout_s=timeout_s)
+                attempt_timeout_s = deadline.clamp(timeout_s) if deadline else timeout_s
+                if self._hedge is None:
+                    reply = self._attempt(req, timeout_s=attempt_timeout_s, host=host)
+                else:
+                    reply, host = self._hedged_attempt(req, timeout_s=attempt_timeout_s, host=host)
                 latency_s = time.time() - t0
                 
                 logger.info(
@@ -382,73 +3975,878 @@ class LLMClient:
                     extra={
                         "request_id": request_id,
                         "model": req.model,
+                        "host": host,
                         "latency_s": latency_s,
                         "attempt": attempt,
+                        **(reply.usage.log_fields() if reply.usage else {}),
                     }
                 )
+                if self._metrics is not None:
+                    self._metrics.observe_attempt(req.model, host, latency_s)
                 
                 # Cache successful response
-                self._cache.set(cache_key, text)
+                cache_store(self._cache, cache_key, cache_value(req, reply), model=req.model)
                 
                 return LLMResponse(
                     ok=True,
-                    text=text,
+                    text=reply.text,
                     model=req.model,
                     latency_s=latency_s,
                     request_id=request_id,
+                    usage=reply.usage,
+                    choices=reply.choices,
                 )
             
             except Exception as e:
                 last_err = e
                 latency_s = time.time() - t0
-                decision = classify_exception(e)
+                step = plan_retry(
+                    e,
+                    attempt=attempt,
+                    max_retries=max_retries,
+                    deadline=deadline,
+                    router=self._router,
+                    host=host,
+                    failed_hosts=failed_hosts,
+                )
+                decision = step.decision
                 
                 logger.warning(
                     "llm_call_failed",
                     extra={
                         "request_id": request_id,
                         "model": req.model,
+                        "host": host,
                         "latency_s": latency_s,
                         "attempt": attempt,
                         "error_type": type(e).__name__,
+                        "reason": decision.reason,
                         "retryable": decision.should_retry,
                     }
                 )
-                
-                # Don't retry permanent errors
-                if not decision.should_retry:
+                if self._metrics is not None:
+                    self._metrics.observe_attempt(req.model, host, latency_s, decision.reason)
+                if not self._retry_wait(step, request_id, req, deadline, attempt):
+                    out_of_time = step.out_of_time
                     break
-                
-                # Don't sleep after last attempt
-                if attempt < max_retries:
-                    delay = add_jitter(backoff_delay(attempt + 1))
-                    time.sleep(delay)
         
         # All retries exhausted
+        # An attempt cut short by the deadline clamp is the deadline's doing too
+        out_of_time = out_of_time or (deadline is not None and deadline.expired())
+        return failed_response(req, request_id, last_err, deadline if out_of_time else None)
+    
+    def _call_safely(self, req: LLMRequest, **call_kwargs: Any) -> LLMResponse:
+        """call() that turns unexpected exceptions into a failed LLMResponse."""
+        try:
+            return self.call(req, **call_kwargs)
+        except Exception as e:
+            return LLMResponse(
+                ok=False,
+                text="",
+                model=req.model,
+                latency_s=0.0,
+                request_id=str(uuid.uuid4())[:8],
+                error=str(e),
+                error_type=type(e).__name__,
+            )
+    
+    def iter_many(
+        self,
+        reqs: Iterable[LLMRequest],
+        *,
+        max_workers: int = 8,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        schedule: str = "fifo",
+        max_model_run: Optional[int] = 32,
+    ) -> Iterator[Tuple[int, LLMResponse]]:
+        """
+        Run requests concurrently and yield (input_index, response) as they complete.
+        
+        Requests with the same cache key are sent once; every duplicate
+        index receives a copy of that response. Failures are returned as
+        ok=False responses, never raised.
+        
+        schedule="by_model" sends requests in per-model runs of up to
+        `max_model_run` (see schedule_by_model) so a server holding one
+        model at a time swaps weights less; "fifo" keeps input order.
+        """
+        if schedule not in ("fifo", "by_model"):
+            raise ValueError(f"schedule must be 'fifo' or 'by_model', got {schedule!r}")
+        if max_model_run is not None and max_model_run < 1:
+            raise ValueError(f"max_model_run must be >= 1 or None, got {max_model_run!r}")
+        reqs = list(reqs)
+        by_key: Dict[str, List[int]] = {}
+        for i, req in enumerate(reqs):
+            by_key.setdefault(make_cache_key(req), []).append(i)
+        groups = list(by_key.values())
+        if schedule == "by_model":
+            order = schedule_by_model([reqs[g[0]] for g in groups], max_run=max_model_run)
+            groups = [groups[i] for i in order]
+        
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            # The executor's queue is FIFO, so submission order is start order.
+            futures = {
+                pool.submit(
+                    self._call_safely,
+                    reqs[indices[0]],
+                    timeout_s=timeout_s,
+                    max_retries=max_retries,
+                ): indices
+                for indices in groups
+            }
+            for future in as_completed(futures):
+                response = future.result()
+                indices = futures[future]
+                yield indices[0], response
+                for i in indices[1:]:
+                    yield i, replace(response)
+    
+    def call_many(
+        self,
+        reqs: Iterable[LLMRequest],
+        *,
+        max_workers: int = 8,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        schedule: str = "fifo",
+        max_model_run: Optional[int] = 32,
+    ) -> BatchResult:
+        """
+        Run requests concurrently and return responses in input order.
+        
+        Args:
+            reqs: Requests to run
+            max_workers: Number of concurrent worker threads
+            timeout_s: Override default timeout
+            max_retries: Override default max retries
+            schedule: "fifo", or "by_model" to group requests per model
+            max_model_run: Fairness bound for "by_model" (None = group fully)
+        
+        Returns:
+            BatchResult with one LLMResponse per input and aggregate BatchStats
+        """
+        reqs = list(reqs)
+        unique = len({make_cache_key(req) for req in reqs})
+        responses: List[Optional[LLMResponse]] = [None] * len(reqs)
+        t0 = time.time()
+        for i, response in self.iter_many(
+            reqs,
+            max_workers=max_workers,
+            timeout_s=timeout_s,
+            max_retries=max_retries,
+            schedule=schedule,
+            max_model_run=max_model_run,
+        ):
+            responses[i] = response
+        wall_s = time.time() - t0
+        
+        done = [r for r in responses if r is not None]
+        stats = BatchStats.from_responses(done, unique=unique, wall_s=wall_s)
+        logger.info("llm_batch_done", extra=asdict(stats))
+        return BatchResult(responses=done, stats=stats)
+    
+    def is_cached(self, req: LLMRequest) -> bool:
+        """Whether call(req) would be answered from the cache."""
+        return self._cache.has(self.cache_key(req))
+    
+    def persist_failure(self, req: LLMRequest, response: LLMResponse) -> Path:
+        """Append a failure record to the journal; returns the journal file."""
+        return self._journal.append(req, response)
+
+
+def request_from_record(record: Mapping[str, Any]) -> LLMRequest:
+    """Rebuild the LLMRequest stored in a FailureJournal record."""
+    return LLMRequest(**record["request"])
+
+
+def replay_failures(
+    client: LLMClient,
+    journal: FailureJournal,
+    *,
+    max_workers: int = 8,
+    timeout_s: Optional[float] = None,
+    max_retries: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Re-run journaled failures concurrently, then compact the journal.
+    
+    Each distinct request is sent once; requests the client's cache can
+    already answer are skipped. Recovered (and skipped) requests are
+    dropped from the journal; requests that fail again stay, once each.
+    New failures are journaled by the client as usual, so pass a client
+    whose journal is `journal` (or whose output_dir is its directory).
+    """
+    pending: "OrderedDict[str, LLMRequest]" = OrderedDict()
+    records = 0
+    for record in journal.records():
+        records += 1
+        pending[record["cache_key"]] = request_from_record(record)
+    
+    resolved = {key for key, req in pending.items() if client.is_cached(req)}
+    to_run = [(key, req) for key, req in pending.items() if key not in resolved]
+    
+    recovered = 0
+    for i, response in client.iter_many(
+        [req for _, req in to_run],
+        max_workers=max_workers,
+        timeout_s=timeout_s,
+        max_retries=max_retries,
+    ):
+        key, req = to_run[i]
+        if response.ok:
+            recovered += 1
+            resolved.add(key)
+        else:
+            client.persist_failure(req, response)
+    
+    kept = journal.compact(resolved)
+    summary = {
+        "records": records,
+        "unique": len(pending),
+        "skipped_cached": len(pending) - len(to_run),
+        "replayed": len(to_run),
+        "recovered": recovered,
+        "still_failing": kept,
+    }
+    logger.info("llm_failures_replayed", extra=summary)
+    return summary
+
+
+@dataclass
+class WarmupProgress:
+    """Counters for a warm_cache() run; `total` excludes skipped requests."""
+    total: int = 0
+    skipped: int = 0
+    done: int = 0
+    ok: int = 0
+    failed: int = 0
+    elapsed_s: float = 0.0
+    
+    @property
+    def rate_rps(self) -> float:
+        return self.done / self.elapsed_s if self.elapsed_s > 0 else 0.0
+    
+    @property
+    def eta_s(self) -> Optional[float]:
+        rate = self.rate_rps
+        return (self.total - self.done) / rate if rate > 0 else None
+
+
+def warm_cache(
+    client: LLMClient,
+    reqs: Iterable[LLMRequest],
+    *,
+    max_workers: int = 8,
+    timeout_s: Optional[float] = None,
+    max_retries: Optional[int] = None,
+    on_progress: Optional[Callable[[WarmupProgress], None]] = None,
+) -> WarmupProgress:
+    """
+    Fill the client's cache with responses for `reqs`.
+    
+    Duplicates and requests already cached are skipped, so re-running after
+    an interruption only sends what is still missing (use a persistent
+    cache). At most 2 * max_workers requests are queued at a time, so
+    Ctrl-C stops promptly; calls already running finish and are cached.
+    Failures go to the client's failure journal. `on_progress` is called
+    after every completed request.
+    """
+    pending: "OrderedDict[str, LLMRequest]" = OrderedDict()
+    progress = WarmupProgress()
+    for req in reqs:
+        key = make_cache_key(req)
+        if key in pending:
+            continue
+        if client.is_cached(req):
+            progress.skipped += 1
+            continue
+        pending[key] = req
+    progress.total = len(pending)
+    
+    todo = iter(pending.values())
+    t0 = time.monotonic()
+    pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="llm-warmup")
+    in_flight: Dict["Future[LLMResponse]", LLMRequest] = {}
+    try:
+        while True:
+            while len(in_flight) < 2 * max(1, max_workers):
+                req = next(todo, None)
+                if req is None:
+                    break
+                future = pool.submit(
+                    client._call_safely, req, timeout_s=timeout_s, max_retries=max_retries
+                )
+                in_flight[future] = req
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                req = in_flight.pop(future)
+                response = future.result()
+                progress.done += 1
+                if response.ok:
+                    progress.ok += 1
+                else:
+                    progress.failed += 1
+                    client.persist_failure(req, response)
+                progress.elapsed_s = time.monotonic() - t0
+                if on_progress is not None:
+                    on_progress(progress)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        progress.elapsed_s = time.monotonic() - t0
+        logger.info("llm_cache_warmed", extra=asdict(progress))
+    return progress
+
+
+# ============================================================================
+# Prompt Packing
+# ============================================================================
+
+
+PACK_INSTRUCTIONS = (
+    "Answer each numbered item below on its own; the items are unrelated. "
+    "Reply with only a JSON object mapping each item number (as a string) "
+    'to its answer, e.g. {"1": "...", "2": "..."}, with no other text.'
+)
+
+
+def pack_prompt(reqs: Sequence[LLMRequest]) -> str:
+    """One numbered multi-item prompt holding every request's prompt."""
+    parts = [PACK_INSTRUCTIONS]
+    for number, req in enumerate(reqs, 1):
+        parts.append(f"### Item {number}\n{req.prompt}")
+    return "\n\n".join(parts)
+
+
+def unpack_reply(text: str, count: int) -> Dict[int, str]:
+    """
+    Per-item answers from a packed reply, keyed by 0-based item index.
+    
+    Tolerates a code fence or chatter around the JSON object. Items that
+    are missing, out of range or empty are left out, so the caller can
+    retry just those; a reply that isn't JSON yields {}.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    answers: Dict[int, str] = {}
+    for key, value in data.items():
+        try:
+            number = int(str(key).strip().lstrip("#"))
+        except ValueError:
+            continue
+        if not 1 <= number <= count or value is None:
+            continue
+        # Structured answers (e.g. an extraction object) are kept as JSON text
+        answer = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        if answer.strip():
+            answers[number - 1] = answer
+    return answers
+
+
+class PromptPacker:
+    """
+    Opt-in layer over LLMClient that fuses many small requests into one.
+    
+    Requests with the same model, system prompt and temperature whose
+    prompts are short (at most `max_item_tokens`) are packed, up to
+    `max_items` per pack and `max_prompt_tokens` of prompt (instructions
+    and system prompt included), into a single numbered prompt (see
+    pack_prompt). The JSON reply is split back into one LLMResponse per
+    item, and each answer is cached under the item's own cache key, so
+    later unpacked calls hit it. Items the reply doesn't answer, and every
+    item of a pack that failed, fall back to individual calls. Cached,
+    long and n > 1 requests are always sent individually.
+    
+    Packing trades answer isolation for fewer round trips; use it for
+    short independent tasks (one-line extraction, classification).
+    
+    Example:
+        packer = PromptPacker(client, max_prompt_tokens=2048)
+        result = packer.call_many(requests)
+        print(packer.stats())
+    """
+    
+    def __init__(
+        self,
+        client: "LLMClient",
+        *,
+        max_prompt_tokens: int = 2048,
+        max_items: int = 16,
+        max_item_tokens: int = 256,
+        max_completion_tokens: int = 4096,
+    ) -> None:
+        if max_items < 2:
+            raise ValueError("max_items must be at least 2")
+        self.client = client
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_items = max_items
+        self.max_item_tokens = max_item_tokens
+        # Cap on the packed request's max_tokens (items' max_tokens are summed)
+        self.max_completion_tokens = max_completion_tokens
+        self._lock = threading.Lock()
+        self._packs = 0
+        self._packed_items = 0
+        self._fallbacks = 0
+    
+    def packable(self, req: LLMRequest) -> bool:
+        """Whether `req` may share a pack (cached requests aren't worth packing)."""
+        return (
+            req.n == 1
+            and estimate_text_tokens(req.prompt) <= self.max_item_tokens
+            and not self.client.is_cached(req)
+        )
+    
+    def plan(self, reqs: Sequence[LLMRequest]) -> Tuple[List[List[int]], List[int]]:
+        """
+        (packs, singles): indices into `reqs` grouped into packs of 2+
+        compatible requests, and the indices to send on their own.
+        """
+        groups: "OrderedDict[Tuple[str, str, float], List[int]]" = OrderedDict()
+        singles: List[int] = []
+        for i, req in enumerate(reqs):
+            if self.packable(req):
+                groups.setdefault((req.model, req.system_prompt, req.temperature), []).append(i)
+            else:
+                singles.append(i)
+        
+        packs: List[List[int]] = []
+        for (_, system_prompt, _), indices in groups.items():
+            # Every pack repeats the instructions and the shared system prompt
+            overhead = estimate_text_tokens(PACK_INSTRUCTIONS, system_prompt)
+            current: List[int] = []
+            used = overhead
+            for i in indices:
+                # "### Item N" header plus separators is a handful of tokens
+                cost = estimate_text_tokens(reqs[i].prompt) + 4
+                if current and (len(current) >= self.max_items or used + cost > self.max_prompt_tokens):
+                    packs.append(current)
+                    current, used = [], overhead
+                current.append(i)
+                used += cost
+            if current:
+                packs.append(current)
+        
+        singles.extend(pack[0] for pack in packs if len(pack) == 1)
+        return [pack for pack in packs if len(pack) > 1], sorted(singles)
+    
+    def packed_request(self, items: Sequence[LLMRequest]) -> LLMRequest:
+        first = items[0]
+        return LLMRequest(
+            model=first.model,
+            prompt=pack_prompt(items),
+            system_prompt=first.system_prompt,
+            temperature=first.temperature,
+            max_tokens=min(self.max_completion_tokens, sum(r.max_tokens for r in items)),
+        )
+    
+    def _run_pack(
+        self, items: Sequence[LLMRequest], **call_kwargs: Any
+    ) -> Tuple[Dict[int, LLMResponse], List[int]]:
+        """Send one pack; return (answers by item position, positions to retry alone)."""
+        response = self.client._call_safely(self.packed_request(items), **call_kwargs)
+        answers = unpack_reply(response.text, len(items)) if response.ok else {}
+        results: Dict[int, LLMResponse] = {}
+        for position, answer in answers.items():
+            req = items[position]
+            self.client.cache_store(req, answer)
+            results[position] = LLMResponse(
+                ok=True,
+                text=answer,
+                model=req.model,
+                latency_s=response.latency_s,
+                request_id=response.request_id,
+                packed=True,
+            )
+        missing = [p for p in range(len(items)) if p not in results]
+        with self._lock:
+            self._packs += 1
+            self._packed_items += len(results)
+            self._fallbacks += len(missing)
+        logger.info(
+            "llm_pack_done",
+            extra={
+                "request_id": response.request_id,
+                "model": items[0].model,
+                "items": len(items),
+                "answered": len(results),
+                "fallback": len(missing),
+                "ok": response.ok,
+                "latency_s": response.latency_s,
+            }
+        )
+        return results, missing
+    
+    def call_many(
+        self,
+        reqs: Iterable[LLMRequest],
+        *,
+        max_workers: int = 8,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+    ) -> BatchResult:
+        """
+        Like LLMClient.call_many, packing small compatible requests.
+        
+        Returns one LLMResponse per input, in input order; answers that
+        came out of a pack have packed=True.
+        """
+        reqs = list(reqs)
+        t0 = time.time()
+        # Identical requests are answered once and copied
+        by_key: "OrderedDict[str, List[int]]" = OrderedDict()
+        for i, req in enumerate(reqs):
+            by_key.setdefault(make_cache_key(req), []).append(i)
+        groups = list(by_key.values())
+        unique = [reqs[g[0]] for g in groups]
+        responses: List[Optional[LLMResponse]] = [None] * len(reqs)
+        call_kwargs = {"timeout_s": timeout_s, "max_retries": max_retries}
+        
+        def settle(u: int, response: LLMResponse) -> None:
+            first, *rest = groups[u]
+            responses[first] = response
+            for i in rest:
+                responses[i] = replace(response)
+        
+        packs, singles = self.plan(unique)
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            pending: Dict[Future, Any] = {}
+            for pack in packs:
+                future = pool.submit(self._run_pack, [unique[u] for u in pack], **call_kwargs)
+                pending[future] = pack
+            for u in singles:
+                pending[pool.submit(self.client._call_safely, unique[u], **call_kwargs)] = u
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    if isinstance(job, int):
+                        settle(job, future.result())
+                        continue
+                    answered, missing = future.result()
+                    for position, response in answered.items():
+                        settle(job[position], response)
+                    for position in missing:
+                        u = job[position]
+                        pending[pool.submit(self.client._call_safely, unique[u], **call_kwargs)] = u
+        wall_s = time.time() - t0
+        
+        done_responses = [r for r in responses if r is not None]
+        stats = BatchStats.from_responses(done_responses, unique=len(unique), wall_s=wall_s)
+        logger.info("llm_batch_done", extra={**asdict(stats), **self.stats()})
+        return BatchResult(responses=done_responses, stats=stats)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Packs sent, items answered from packs, and items that fell back."""
+        with self._lock:
+            return {
+                "packs": self._packs,
+                "packed_items": self._packed_items,
+                "fallbacks": self._fallbacks,
+            }
+
+
+# ============================================================================
+# Priority Scheduling
+# ============================================================================
+
+
+SHED_POLICIES = ("reject", "defer")
+
+
+@dataclass(frozen=True)
+class PriorityClass:
+    """
+    One traffic class of a PriorityScheduler.
+    
+    `weight` is the class's share of dispatch slots while several classes
+    have work queued (interactive=8, batch=1 gives interactive 8 of every 9).
+    `shed` says what happens to new work of this class while the estimated
+    queue wait is above the scheduler's latency target: "reject" fails it
+    at once, "defer" holds it back until the queue drains, None always
+    admits it.
+    """
+    name: str
+    weight: float = 1.0
+    shed: Optional[str] = None
+
+
+class PriorityScheduler:
+    """
+    Weighted fair queue with admission control in front of an LLMClient.
+    
+    `max_in_flight` worker threads take queued requests in weighted-fair
+    order: each request gets a virtual finish time of
+    max(now_virtual, class_last_finish) + 1/weight, and the smallest runs
+    next, so a backlog in one class can't starve another. The expected
+    queue wait is estimated from the queued and in-flight requests and an
+    EWMA of service times; while it is above `latency_target_s`, classes
+    with a `shed` policy are rejected (ok=False, error_type
+    "SchedulerRejected") or deferred. Deferred work of a class keeps its
+    order: new work of that class queues behind it. Until the first call
+    completes, the service time is taken as `initial_service_s` (default:
+    `latency_target_s`), so a cold-start burst is shed by queue depth too.
+    
+    Example:
+        with PriorityScheduler(client, [
+            PriorityClass("interactive", weight=8),
+            PriorityClass("backfill", weight=1, shed="defer"),
+        ], max_in_flight=4, latency_target_s=2.0) as scheduler:
+            future = scheduler.submit(req, priority="backfill")
+            response = scheduler.call(other_req, priority="interactive")
+            print(scheduler.stats())
+    """
+    
+    def __init__(
+        self,
+        client: "LLMClient",
+        classes: Sequence[PriorityClass],
+        *,
+        max_in_flight: int = 4,
+        latency_target_s: Optional[float] = None,
+        initial_service_s: Optional[float] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        wait_window: int = 1024,
+    ) -> None:
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        if not classes:
+            raise ValueError("at least one PriorityClass is required")
+        for cls in classes:
+            if cls.weight <= 0:
+                raise ValueError(f"weight of {cls.name!r} must be positive")
+            if cls.shed is not None and cls.shed not in SHED_POLICIES:
+                raise ValueError(f"shed must be one of {SHED_POLICIES} or None, got {cls.shed!r}")
+        self.client = client
+        self.classes: Dict[str, PriorityClass] = {cls.name: cls for cls in classes}
+        self.max_in_flight = max_in_flight
+        self.latency_target_s = latency_target_s
+        # Service-time guess used until the first completion is measured
+        self.initial_service_s = (
+            initial_service_s if initial_service_s is not None else latency_target_s
+        )
+        self._cond = threading.Condition()
+        # (virtual finish, sequence, class, request, call kwargs, future, enqueued_at)
+        self._heap: List[Tuple[float, int, str, LLMRequest, Dict[str, Any], "Future[LLMResponse]", float]] = []
+        self._deferred: Dict[str, "deque[Tuple[LLMRequest, Dict[str, Any], Future[LLMResponse], float]]"] = {
+            name: deque() for name in self.classes
+        }
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {name: 0.0 for name in self.classes}
+        self._service_ewma_s: Optional[float] = None
+        self._closed = False
+        self._in_flight: Dict[str, int] = {name: 0 for name in self.classes}
+        self._counts: Dict[str, Dict[str, int]] = {
+            name: {"admitted": 0, "deferred": 0, "rejected": 0, "completed": 0}
+            for name in self.classes
+        }
+        self._waits: Dict[str, "deque[float]"] = {name: deque(maxlen=wait_window) for name in self.classes}
+        self._admissions = metrics.counter(
+            "llm_scheduler_admissions_total", "Scheduler admission decisions", ("class", "outcome")
+        ) if metrics is not None else None
+        self._wait_hist = metrics.histogram(
+            "llm_scheduler_wait_seconds", "Time spent queued before dispatch", ("class",)
+        ) if metrics is not None else None
+        self._workers = [
+            threading.Thread(target=self._work, name=f"llm-sched-{i}", daemon=True)
+            for i in range(max_in_flight)
+        ]
+        for worker in self._workers:
+            worker.start()
+    
+    def estimated_wait_s(self) -> float:
+        """Expected queue wait for work admitted now."""
+        with self._cond:
+            return self._estimated_wait_locked()
+    
+    def _estimated_wait_locked(self) -> float:
+        service_s = self._service_ewma_s
+        if service_s is None:
+            service_s = self.initial_service_s
+        if service_s is None:
+            return 0.0
+        # New work starts once everything queued, plus one request, has
+        # finished beyond what the idle workers can take right away
+        in_flight = sum(self._in_flight.values())
+        ahead = max(0, len(self._heap) + in_flight - self.max_in_flight + 1)
+        return ahead * service_s / self.max_in_flight
+    
+    def _overloaded_locked(self) -> bool:
+        return (
+            self.latency_target_s is not None
+            and self._estimated_wait_locked() > self.latency_target_s
+        )
+    
+    def _enqueue_locked(
+        self, name: str, req: LLMRequest, call_kwargs: Dict[str, Any],
+        future: "Future[LLMResponse]", enqueued_at: float,
+    ) -> None:
+        weight = self.classes[name].weight
+        finish = max(self._virtual_time, self._last_finish[name]) + 1.0 / weight
+        self._last_finish[name] = finish
+        self._seq += 1
+        heapq.heappush(self._heap, (finish, self._seq, name, req, call_kwargs, future, enqueued_at))
+        self._counts[name]["admitted"] += 1
+        if self._admissions is not None:
+            self._admissions.inc(name, "admitted")
+        self._cond.notify()
+    
+    def _promote_deferred_locked(self) -> None:
+        """Move deferred work into the queue, by class weight, while under target."""
+        for cls in sorted(self.classes.values(), key=lambda c: -c.weight):
+            queue = self._deferred[cls.name]
+            while queue and not self._overloaded_locked():
+                self._enqueue_locked(cls.name, *queue.popleft())
+    
+    def submit(self, req: LLMRequest, *, priority: str, **call_kwargs: Any) -> "Future[LLMResponse]":
+        """
+        Queue `req` in class `priority`; the future resolves to its LLMResponse.
+        
+        `call_kwargs` (timeout_s, max_retries, deadline, ...) go to
+        LLMClient.call. Rejected work resolves at once with ok=False.
+        """
+        if priority not in self.classes:
+            raise ValueError(f"Unknown priority class {priority!r}; expected one of {sorted(self.classes)}")
+        future: "Future[LLMResponse]" = Future()
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("PriorityScheduler is closed")
+            shed = self.classes[priority].shed
+            behind_deferred = shed == "defer" and bool(self._deferred[priority])
+            if shed is not None and (behind_deferred or self._overloaded_locked()):
+                outcome = "rejected" if shed == "reject" else "deferred"
+                self._counts[priority][outcome] += 1
+                if self._admissions is not None:
+                    self._admissions.inc(priority, outcome)
+                if shed == "defer":
+                    # Older deferred work of this class goes first
+                    self._deferred[priority].append((req, call_kwargs, future, now))
+                    self._promote_deferred_locked()
+                    return future
+                wait_s = self._estimated_wait_locked()
+            else:
+                self._enqueue_locked(priority, req, call_kwargs, future, now)
+                return future
+        logger.warning(
+            "llm_scheduler_rejected",
+            extra={"model": req.model, "priority": priority, "estimated_wait_s": wait_s}
+        )
+        future.set_result(self._rejection(req, priority, wait_s))
+        return future
+    
+    def _rejection(self, req: LLMRequest, priority: str, wait_s: float) -> LLMResponse:
         return LLMResponse(
             ok=False,
             text="",
             model=req.model,
             latency_s=0.0,
-            request_id=request_id,
-            error=str(last_err),
-            error_type=type(last_err).__name__ if last_err else "unknown",
+            request_id=str(uuid.uuid4())[:8],
+            error=(
+                f"Rejected {priority!r} request: estimated queue wait {wait_s:.2f}s "
+                f"is over the {self.latency_target_s}s target"
+            ),
+            error_type="SchedulerRejected",
         )
     
-    def persist_failure(self, req: LLMRequest, response: LLMResponse) -> Path:
-        """Persist a failure record to output directory."""
-        record = {
-            "request": asdict(req),
-            "response": {
-                "ok": response.ok,
-                "error": response.error,
-                "error_type": response.error_type,
-                "request_id": response.request_id,
-            },
-        }
-        path = self._output_dir / f"failure_{response.request_id}.json"
-        path.write_text(json.dumps(record, indent=2), encoding="utf-8")
-        return path
+    def call(self, req: LLMRequest, *, priority: str, **call_kwargs: Any) -> LLMResponse:
+        """submit() and wait for the response."""
+        return self.submit(req, priority=priority, **call_kwargs).result()
+    
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._heap or self._closed)
+                if not self._heap:
+                    return
+                finish, _, name, req, call_kwargs, future, enqueued_at = heapq.heappop(self._heap)
+                self._virtual_time = max(self._virtual_time, finish)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                wait_s = time.monotonic() - enqueued_at
+                self._waits[name].append(wait_s)
+                self._in_flight[name] += 1
+            if self._wait_hist is not None:
+                self._wait_hist.observe(wait_s, name)
+            
+            t0 = time.monotonic()
+            try:
+                response = self.client._call_safely(req, **call_kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                response = None
+            service_s = time.monotonic() - t0
+            if response is not None:
+                future.set_result(response)
+            
+            with self._cond:
+                self._in_flight[name] -= 1
+                self._counts[name]["completed"] += 1
+                # Cache hits say nothing about how long the server takes
+                if response is None or not response.cached:
+                    self._service_ewma_s = (
+                        service_s if self._service_ewma_s is None
+                        else 0.8 * self._service_ewma_s + 0.2 * service_s
+                    )
+                self._promote_deferred_locked()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Per-class queue depth, in-flight, admission counts and wait-time percentiles."""
+        with self._cond:
+            queued: Dict[str, int] = {name: 0 for name in self.classes}
+            for entry in self._heap:
+                queued[entry[2]] += 1
+            classes = {}
+            for name, cls in self.classes.items():
+                waits = list(self._waits[name])
+                classes[name] = {
+                    "weight": cls.weight,
+                    "queued": queued[name],
+                    "deferred_waiting": len(self._deferred[name]),
+                    "in_flight": self._in_flight[name],
+                    **self._counts[name],
+                    "wait_p50_s": percentile(waits, 50),
+                    "wait_p95_s": percentile(waits, 95),
+                    "wait_max_s": max(waits, default=0.0),
+                }
+            return {
+                "estimated_wait_s": self._estimated_wait_locked(),
+                "service_ewma_s": self._service_ewma_s,
+                "classes": classes,
+            }
+    
+    def close(self, *, wait: bool = True) -> None:
+        """
+        Stop accepting work. Queued requests still run; deferred ones are
+        rejected. With wait=True, block until the workers finish.
+        """
+        with self._cond:
+            self._closed = True
+            leftovers = [(name, item) for name, queue in self._deferred.items() for item in queue]
+            for queue in self._deferred.values():
+                queue.clear()
+            self._cond.notify_all()
+        for name, (req, _, future, _) in leftovers:
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._rejection(req, name, self.estimated_wait_s()))
+        if wait:
+            for worker in self._workers:
+                worker.join()
+    
+    def __enter__(self) -> "PriorityScheduler":
+        return self
+    
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
 
 
 # ============================================================================
@@ -467,12 +4865,14 @@ def call_ollama(
     """
     Simple one-off call to Ollama.
     
+    Connections are reused across calls through the process-wide shared_pool().
+    
     Raises:
         ConnectionError: If Ollama service is not reachable
         TimeoutError: If request exceeds timeout
         ValueError: If model not found
     """
-    client = LLMClient(host=host, timeout_s=timeout_s, max_retries=0)
+    client = LLMClient(host=host, timeout_s=timeout_s, max_retries=0, pool=shared_pool())
     response = client.call(LLMRequest(
         model=model,
         prompt=prompt,
@@ -481,7 +4881,7 @@ def call_ollama(
     
     if not response.ok:
         if response.error_type == "ConnectionError":
-            raise ConnectionError(f"Cannot connect to Ollama at {host}")
+            raise http_errors().ConnectionError(f"Cannot connect to Ollama at {host}")
         if response.error_type == "Timeout":
             raise TimeoutError(f"Request timed out after {timeout_s}s")
         raise ValueError(response.error or "Unknown error")
@@ -494,7 +4894,8 @@ def call_ollama(
 # ============================================================================
 
 
-if __name__ == "__main__":
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Command-line entry point; run it through llm_cli.py for a fast start."""
     import argparse
     
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
@@ -505,7 +4906,21 @@ if __name__ == "__main__":
     parser.add_argument("--host", default="http://localhost:11434", help="Ollama host")
     parser.add_argument("--timeout", type=float, default=60.0, help="Timeout in seconds")
     parser.add_argument("--temperature", type=float, default=0.0, help="Temperature")
-    args = parser.parse_args()
+    parser.add_argument("--stream", action="store_true", help="Print tokens as they arrive")
+    args = parser.parse_args(argv)
+    
+    if args.stream:
+        with LLMClient(host=args.host, timeout_s=args.timeout, max_retries=0) as client:
+            response = client.call_stream(
+                LLMRequest(model=args.model, prompt=args.prompt, temperature=args.temperature),
+                lambda chunk: print(chunk, end="", flush=True),
+            )
+        print()
+        if not response.ok:
+            print(f"Error: {response.error}")
+            return 1
+        print(f"[ttft {response.ttft_s:.3f}s, total {response.latency_s:.3f}s]")
+        return 0
     
     try:
         result = call_ollama(
@@ -518,4 +4933,10 @@ if __name__ == "__main__":
         print(result)
     except Exception as e:
         print(f"Error: {e}")
-        exit(1)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # Works, but recompiles this whole module on every run; llm_cli.py doesn't
+    sys.exit(main())
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Maintenance commands for LLMClient's on-disk state.
+
+Commands:
+    replay-failures   Re-run the failure journal and compact it
+    cache-stats       Size, hit counts, per-model totals and age histogram
+    cache-compact     Compress old entries and reclaim free space
+    cache-prune       Delete entries by model or age, or down to a size budget
+    warmup            Pre-fill the cache from a JSONL manifest of requests
+    startup-cost      Time each CLI's --help start-up against an import budget
+    hedge-bench       Tail latency with and without hedging against a stalling stub
+
+Usage:
+    python llm_tools.py replay-failures --output-dir output --cache output/cache.db
+    python llm_tools.py cache-stats --cache output/cache.db
+    python llm_tools.py cache-prune --cache output/cache.db --older-than 30d --max-size 200MB
+    python llm_tools.py warmup manifest.jsonl --cache output/cache.db --workers 16
+    python llm_tools.py startup-cost --budget-ms 150
+    python llm_tools.py hedge-bench --requests 400 --stall-ratio 0.1 --stall-s 1.0
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import random
+import subprocess
+import sys
+import time
+from dataclasses import fields
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from llm_client import (
+    FailureJournal,
+    HedgePolicy,
+    LLMClient,
+    LLMRequest,
+    ResponseCache,
+    SimpleFileCache,
+    SQLiteCache,
+    cache_report,
+    make_provider,
+    percentile,
+    prune_cache,
+    replay_failures,
+    warm_cache,
+)
+
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+_SIZE_UNITS = {
+    "": 1, "B": 1,
+    "K": 1024, "KB": 1024,
+    "M": 1024 ** 2, "MB": 1024 ** 2,
+    "G": 1024 ** 3, "GB": 1024 ** 3,
+}
+
+# CLIs `startup-cost` checks when none are given, relative to this file
+DEFAULT_STARTUP_CLIS = (
+    "llm_cli.py",
+    "llm_tools.py",
+    "extract_template.py",
+    "../old_v1/week_06/run_capstone.py",
+)
+
+
+def open_cache(path: Optional[str]) -> Optional[ResponseCache]:
+    """SimpleFileCache for *.json, SQLiteCache for anything else, None without a path."""
+    if not path:
+        return None
+    cache_path = Path(path).expanduser()
+    if cache_path.suffix == ".json":
+        return SimpleFileCache(cache_path)
+    return SQLiteCache(cache_path)
+
+
+def parse_duration(text: str) -> float:
+    """'90s', '15m', '12h', '7d', '2w' (or plain seconds) -> seconds."""
+    text = text.strip().lower()
+    if text and text[-1] in _DURATION_UNITS:
+        return float(text[:-1]) * _DURATION_UNITS[text[-1]]
+    return float(text)
+
+
+def read_manifest(
+    path: Path, *, model: Optional[str] = None, prompt_field: str = "prompt"
+) -> Iterator[LLMRequest]:
+    """
+    LLMRequests from a JSONL file, one JSON object per line.
+    
+    Keys matching LLMRequest fields are used and others ignored; the prompt
+    is read from `prompt_field` and `model` fills lines that have none.
+    """
+    names = {f.name for f in fields(LLMRequest)}
+    with Path(path).open("r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row: Dict[str, Any] = json.loads(line)
+            kwargs = {k: v for k, v in row.items() if k in names and k != "prompt"}
+            if prompt_field in row:
+                kwargs["prompt"] = row[prompt_field]
+            if model is not None:
+                kwargs.setdefault("model", model)
+            if "prompt" not in kwargs or "model" not in kwargs:
+                raise ValueError(f"{path}:{line_no}: needs '{prompt_field}' and 'model' (or --model)")
+            yield LLMRequest(**kwargs)
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """Top-level module -> cumulative microseconds from `python -X importtime` output."""
+    totals: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue  # the header line
+        # Nesting is shown by indentation; top-level imports have one space
+        name = parts[2].rstrip()
+        if name.startswith(" ") and not name.startswith("  "):
+            totals[name.strip()] = cumulative
+    return totals
+
+
+def measure_startup(
+    argv: Sequence[str], *, repeat: int = 5
+) -> Tuple[float, Dict[str, int], Optional[str]]:
+    """
+    Fastest wall time (ms) of `python -X importtime *argv` over `repeat`
+    runs, its imports, and an error (exit code and stderr) if it failed.
+    """
+    best_ms, best_imports = float("inf"), {}
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", *argv], capture_output=True, text=True
+        )
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        if proc.returncode != 0:
+            stderr = "\n".join(
+                line for line in proc.stderr.splitlines() if not line.startswith("import time:")
+            )
+            return elapsed_ms, parse_importtime(proc.stderr), f"exit {proc.returncode}: {stderr.strip()}"
+        if elapsed_ms < best_ms:
+            best_ms, best_imports = elapsed_ms, parse_importtime(proc.stderr)
+    return best_ms, best_imports, None
+
+
+def parse_size(text: str) -> int:
+    """'500K', '200MB', '1.5GB' (or plain bytes) -> bytes; an argparse type."""
+    text = text.strip().upper()
+    number = text.rstrip("KMGB")
+    unit = text[len(number):]
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError(
+            f"invalid size {text!r}; use bytes or a K/KB, M/MB or G/GB suffix"
+        ) from None
+
+
+def existing_path(text: str) -> str:
+    """argparse type for a file that must already exist (not be created)."""
+    if not Path(text).expanduser().exists():
+        raise argparse.ArgumentTypeError(f"{text} does not exist")
+    return text
+
+
+# ============================================================================
+# Commands
+# ============================================================================
+
+
+def cmd_replay_failures(args: argparse.Namespace) -> int:
+    output_dir = Path(args.output_dir)
+    journal = FailureJournal(output_dir)
+    with LLMClient(
+        host=args.host,
+        timeout_s=args.timeout,
+        max_retries=args.max_retries,
+        cache=open_cache(args.cache),
+        output_dir=output_dir,
+        failure_journal=journal,
+        provider=make_provider(args.provider),
+    ) as client:
+        summary = replay_failures(client, journal, max_workers=args.workers)
+    print(json.dumps(summary, indent=2))
+    return 0 if summary["still_failing"] == 0 else 1
+
+
+def cmd_cache_stats(args: argparse.Namespace) -> int:
+    print(json.dumps(cache_report(open_cache(args.cache)), indent=2))
+    return 0
+
+
+def cmd_cache_compact(args: argparse.Namespace) -> int:
+    cache = open_cache(args.cache)
+    before = cache.stats()["file_bytes"]
+    cache.compact()
+    after = cache.stats()["file_bytes"]
+    print(json.dumps({"file_bytes_before": before, "file_bytes_after": after}, indent=2))
+    return 0
+
+
+def cmd_cache_prune(args: argparse.Namespace) -> int:
+    if args.model is None and args.older_than is None and args.max_size is None:
+        print("Error: give at least one of --model, --older-than, --max-size")
+        return 2
+    removed = prune_cache(
+        open_cache(args.cache),
+        model=args.model,
+        older_than_s=parse_duration(args.older_than) if args.older_than else None,
+        max_bytes=args.max_size,
+    )
+    print(json.dumps({"removed": removed}, indent=2))
+    return 0
+
+
+def cmd_warmup(args: argparse.Namespace) -> int:
+    reqs = list(read_manifest(Path(args.manifest), model=args.model, prompt_field=args.prompt_field))
+    last_print = 0.0
+    
+    def report(progress: Any) -> None:
+        nonlocal last_print
+        now = time.monotonic()
+        if progress.done < progress.total and now - last_print < 1.0:
+            return
+        last_print = now
+        eta = f"{progress.eta_s:.0f}s" if progress.eta_s is not None else "?"
+        print(
+            f"\r[{progress.done}/{progress.total}] {progress.rate_rps:.1f} req/s, "
+            f"ok {progress.ok}, failed {progress.failed}, ETA {eta}   ",
+            end="", file=sys.stderr, flush=True,
+        )
+    
+    with LLMClient(
+        host=args.host,
+        timeout_s=args.timeout,
+        max_retries=args.max_retries,
+        cache=open_cache(args.cache),
+        output_dir=Path(args.output_dir),
+        pool_maxsize=args.workers,
+        provider=make_provider(args.provider),
+    ) as client:
+        try:
+            progress = warm_cache(client, reqs, max_workers=args.workers, on_progress=report)
+        except KeyboardInterrupt:
+            print("\nInterrupted; run the same command again to resume.", file=sys.stderr)
+            return 130
+    print(file=sys.stderr)
+    print(json.dumps({
+        "manifest": len(reqs),
+        "skipped_cached": progress.skipped,
+        "sent": progress.done,
+        "ok": progress.ok,
+        "failed": progress.failed,
+        "elapsed_s": round(progress.elapsed_s, 3),
+        "throughput_rps": round(progress.rate_rps, 3),
+    }, indent=2))
+    return 0 if progress.failed == 0 else 1
+
+
+def cmd_startup_cost(args: argparse.Namespace) -> int:
+    here = Path(__file__).resolve().parent
+    clis = [Path(c) for c in args.cli] or [
+        here / c for c in DEFAULT_STARTUP_CLIS if (here / c).exists()
+    ]
+    base_ms, base_imports, _ = measure_startup(["-c", "pass"], repeat=args.repeat)
+    report: List[Dict[str, Any]] = []
+    for cli in clis:
+        wall_ms, imports, error = measure_startup([str(cli.resolve()), "--help"], repeat=args.repeat)
+        own = {name: us for name, us in imports.items() if name not in base_imports}
+        heaviest = sorted(own.items(), key=lambda kv: kv[1], reverse=True)[:args.top]
+        report.append({
+            "cli": str(cli),
+            "wall_ms": round(wall_ms, 1),
+            "startup_ms": round(wall_ms - base_ms, 1),
+            "import_ms": round(sum(own.values()) / 1000, 1),
+            "heaviest_imports_ms": {name: round(us / 1000, 1) for name, us in heaviest},
+            # A CLI that fails to start is never within budget
+            "within_budget": error is None and wall_ms - base_ms <= args.budget_ms,
+        })
+        if error is not None:
+            report[-1]["error"] = error
+    print(json.dumps({
+        "interpreter_ms": round(base_ms, 1),
+        "budget_ms": args.budget_ms,
+        "clis": report,
+    }, indent=2))
+    return 0 if all(r["within_budget"] for r in report) else 1
+
+
+def start_stall_server(
+    *, latency_s: float, stall_ratio: float, stall_s: float, seed: int
+) -> Tuple[Any, str]:
+    """
+    A local stub of Ollama's /api/generate on a free port: each request
+    takes latency_s, or stall_s with probability stall_ratio.
+    
+    Returns (server, host URL); call server.shutdown() when done.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with rng_lock:
+                stalled = rng.random() < stall_ratio
+            time.sleep(stall_s if stalled else latency_s)
+            body = json.dumps({"response": "ok", "done": True}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+    
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def cmd_hedge_bench(args: argparse.Namespace) -> int:
+    server, host = start_stall_server(
+        latency_s=args.latency_s, stall_ratio=args.stall_ratio, stall_s=args.stall_s, seed=args.seed
+    )
+    report: Dict[str, Any] = {
+        "requests": args.requests,
+        "stall_ratio": args.stall_ratio,
+        "stall_s": args.stall_s,
+    }
+    try:
+        for label, hedge in (
+            ("no_hedge", None),
+            (f"hedge_p{args.percentile:g}", HedgePolicy(percentile=args.percentile)),
+        ):
+            # Distinct prompts so every call reaches the server
+            reqs = [
+                LLMRequest(model="bench", prompt=f"{label} {i}") for i in range(args.requests)
+            ]
+            with LLMClient(host, max_retries=0, hedge=hedge, output_dir=Path(args.output_dir)) as client:
+                result = client.call_many(reqs, max_workers=args.workers)
+                latencies = [r.latency_s for r in result.responses if r.ok]
+                report[label] = {
+                    "ok": len(latencies),
+                    "p50_s": round(percentile(latencies, 50), 3),
+                    "p95_s": round(percentile(latencies, 95), 3),
+                    "p99_s": round(percentile(latencies, 99), 3),
+                    **client.hedge_stats(),
+                }
+    finally:
+        server.shutdown()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="llm_tools", description=__doc__.split("\n")[1])
+    parser.add_argument("--verbose", "-v", action="store_true", help="Enable verbose logging")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    replay = sub.add_parser("replay-failures", help="Re-run journaled failures, then compact")
+    replay.add_argument("--output-dir", "-o", default="output", help="Directory holding the journal")
+    replay.add_argument("--cache", help="Persistent cache (.json file or SQLite db) to check and fill")
+    replay.add_argument("--host", default="http://localhost:11434", help="LLM server URL")
+    replay.add_argument("--provider", choices=["ollama", "openai"], default="ollama", help="API the server speaks")
+    replay.add_argument("--workers", type=int, default=8, help="Concurrent requests")
+    replay.add_argument("--timeout", type=float, default=60.0, help="Per-attempt timeout in seconds")
+    replay.add_argument("--max-retries", type=int, default=2, help="Retries per request")
+    replay.set_defaults(func=cmd_replay_failures)
+
+    stats = sub.add_parser("cache-stats", help="Report cache size, hits and entry ages")
+    stats.add_argument("--cache", required=True, type=existing_path, help="Cache file (.json or SQLite db)")
+    stats.set_defaults(func=cmd_cache_stats)
+
+    compact = sub.add_parser("cache-compact", help="Compress old entries and reclaim space")
+    compact.add_argument("--cache", required=True, type=existing_path, help="Cache file (.json or SQLite db)")
+    compact.set_defaults(func=cmd_cache_compact)
+
+    prune = sub.add_parser("cache-prune", help="Delete entries by model, age or size budget")
+    prune.add_argument("--cache", required=True, type=existing_path, help="Cache file (.json or SQLite db)")
+    prune.add_argument("--model", help="Delete entries written for this model")
+    prune.add_argument("--older-than", help="Delete entries older than this (e.g. 12h, 30d)")
+    prune.add_argument("--max-size", type=parse_size, help="Then evict least recently used down to this (e.g. 200MB)")
+    prune.set_defaults(func=cmd_cache_prune)
+
+    warmup = sub.add_parser("warmup", help="Pre-fill the cache from a JSONL request manifest")
+    warmup.add_argument("manifest", help="JSONL file of LLMRequest fields")
+    warmup.add_argument("--cache", required=True, help="Persistent cache (.json file or SQLite db)")
+    warmup.add_argument("--model", help="Model for lines that don't name one")
+    warmup.add_argument("--prompt-field", default="prompt", help="Key holding the prompt text")
+    warmup.add_argument("--output-dir", "-o", default="output", help="Where failures are journaled")
+    warmup.add_argument("--host", default="http://localhost:11434", help="LLM server URL")
+    warmup.add_argument("--provider", choices=["ollama", "openai"], default="ollama", help="API the server speaks")
+    warmup.add_argument("--workers", type=int, default=8, help="Concurrent requests")
+    warmup.add_argument("--timeout", type=float, default=60.0, help="Per-attempt timeout in seconds")
+    warmup.add_argument("--max-retries", type=int, default=2, help="Retries per request")
+    warmup.set_defaults(func=cmd_warmup)
+
+    startup = sub.add_parser(
+        "startup-cost",
+        help="Time each CLI's --help start-up (beyond bare interpreter start) against a budget",
+    )
+    startup.add_argument("cli", nargs="*", help="Scripts to time (default: the course CLIs)")
+    startup.add_argument("--budget-ms", type=float, default=150.0, help="Allowed start-up per CLI")
+    startup.add_argument("--repeat", type=int, default=5, help="Runs per CLI; the fastest counts")
+    startup.add_argument("--top", type=int, default=5, help="Heaviest imports to list per CLI")
+    startup.set_defaults(func=cmd_startup_cost)
+
+    bench = sub.add_parser(
+        "hedge-bench", help="Compare tail latency with and without hedging against a local stub"
+    )
+    bench.add_argument("--requests", type=int, default=400, help="Calls per run")
+    bench.add_argument("--workers", type=int, default=4, help="Concurrent calls")
+    bench.add_argument("--latency-s", type=float, default=0.05, help="Normal response time")
+    bench.add_argument("--stall-ratio", type=float, default=0.1, help="Share of responses that stall")
+    bench.add_argument("--stall-s", type=float, default=1.0, help="Response time of a stall")
+    bench.add_argument("--percentile", type=float, default=80.0, help="HedgePolicy percentile")
+    bench.add_argument("--seed", type=int, default=0, help="Seed for which responses stall")
+    bench.add_argument("--output-dir", "-o", default="output", help="Client output directory")
+    bench.set_defaults(func=cmd_hedge_bench)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(levelname)s: %(message)s",
+    )
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())